@@ -0,0 +1 @@
+"""Бенчмарки работы с базой данных"""
@@ -0,0 +1,228 @@
+"""
+Бенчмарк горячих методов Database на синтетических данных разного масштаба.
+
+Для каждого размера базы (по умолчанию 10 тыс., 100 тыс. и 1 млн пользователей) база заполняется
+генератором benchmarks.synthetic_data, после чего каждый метод вызывается последовательно
+на случайных входных данных: get_user, get_active_daily_task, рейтинги по городу, рангу
+и реферальному коду, get_user_rating_position, get_unsent_notifications и approve_task.
+Для метода считаются среднее, p50/p95/p99, максимум, вызовы в секунду и среднее ожидание
+соединения (по db_metrics). Результаты пишутся в JSON для сравнения между версиями.
+
+SQLite-базы создаются во временном каталоге или в --data-dir, где заполненная база одного размера
+переиспользуется следующими запусками. approve_task замеряется на одноразовой копии базы, поэтому
+сама заполненная база не меняется между запусками. С --postgres используется база из настроек PostgreSQL
+(POSTGRES_*): таблицы с данными должны быть пустыми или очищаются при --reset;
+approve_task в этом режиме не замеряется (одобрение заданий реализовано только для SQLite).
+
+Запуск: python -m benchmarks.database_methods [--users 10000,100000,1000000] [--months 3]
+        [--iterations 200] [--data-dir DIR] [--output results.json] [--postgres [--reset]]
+"""
+import argparse
+import asyncio
+import datetime
+import json
+import os
+import platform
+import random
+import sqlite3
+import statistics
+import sys
+import tempfile
+import time
+
+from benchmarks.synthetic_data import TABLES, seed_postgres, seed_sqlite
+from database import Database
+from db_metrics import DB_METRICS, summarize
+from query_layer import Query
+
+_Q_SAMPLE_USERS = Query('SELECT telegram_id, city, referral_code FROM users ORDER BY telegram_id')
+_Q_RANKS = Query('SELECT DISTINCT rank FROM user_stats')
+_Q_SUBMITTED_TASKS = Query("SELECT id FROM daily_tasks WHERE status = 'submitted' ORDER BY id LIMIT ?")
+_Q_USERS_COUNT = Query('SELECT COUNT(*) FROM users')
+
+MODERATOR_ID = 1
+
+
+def _percentile(samples: list[float], p: int) -> float:
+    return statistics.quantiles(samples, n=100, method='inclusive')[p - 1] if len(samples) > 1 else samples[0]
+
+
+async def measure(db: Database, name: str, make_call, iterations: int, warmup: int) -> dict:
+    """Последовательные вызовы метода; make_call(i) возвращает корутину i-го вызова"""
+    for i in range(warmup):
+        await make_call(i)
+    DB_METRICS.reset()
+    samples = []
+    for i in range(warmup, warmup + iterations):
+        started = time.perf_counter()
+        await make_call(i)
+        samples.append((time.perf_counter() - started) * 1000)
+    wait = next((item['wait_ms'] / item['calls'] for item in summarize(DB_METRICS.methods)
+                 if item['method'] == name), 0.0)
+    total = sum(samples)
+    return {
+        'iterations': len(samples),
+        'mean_ms': round(total / len(samples), 3),
+        'p50_ms': round(_percentile(samples, 50), 3),
+        'p95_ms': round(_percentile(samples, 95), 3),
+        'p99_ms': round(_percentile(samples, 99), 3),
+        'max_ms': round(max(samples), 3),
+        'ops_per_sec': round(len(samples) / total * 1000, 1),
+        'connection_wait_ms': round(wait, 3),
+    }
+
+
+async def run_methods(db: Database, iterations: int, warmup: int, seed: int,
+                      approve_db: Database = None) -> dict:
+    """Замер горячих методов на заполненной базе; approve_task - на approve_db (копии базы)"""
+    rng = random.Random(seed)
+    users = await db.queries.fetch(_Q_SAMPLE_USERS)
+    picks = [users[rng.randrange(len(users))] for _ in range(warmup + iterations)]
+    user_ids = [row[0] for row in picks]
+    cities = [row[1] for row in picks]
+    referral_codes = [row[2] for row in picks if row[2]] or ['']
+    ranks = [row[0] for row in await db.queries.fetch(_Q_RANKS)]
+
+    methods = {
+        'get_user': lambda i: db.get_user(user_ids[i]),
+        'get_active_daily_task': lambda i: db.get_active_daily_task(user_ids[i]),
+        'get_top_users_by_city': lambda i: db.get_top_users_by_city(cities[i], 10),
+        'get_top_users_by_rank': lambda i: db.get_top_users_by_rank(ranks[i % len(ranks)], 10),
+        'get_top_users_by_referral_code': lambda i: db.get_top_users_by_referral_code(
+            referral_codes[i % len(referral_codes)], 10),
+        'get_user_rating_position': lambda i: db.get_user_rating_position(user_ids[i]),
+        'get_unsent_notifications': lambda i: db.get_unsent_notifications(limit=100),
+    }
+    results = {}
+    for name, make_call in methods.items():
+        results[name] = await measure(db, name, make_call, iterations, warmup)
+        print(f"  {name:<32} p50 {results[name]['p50_ms']:>8.2f} мс  p95 {results[name]['p95_ms']:>8.2f} мс  "
+              f"p99 {results[name]['p99_ms']:>8.2f} мс", file=sys.stderr)
+
+    if approve_db is None:
+        results['approve_task'] = {'skipped': "одобрение заданий реализовано только для SQLite"}
+        return results
+    task_ids = [row[0] for row in await approve_db.queries.fetch(_Q_SUBMITTED_TASKS, warmup + iterations)]
+    if len(task_ids) <= warmup:
+        results['approve_task'] = {'skipped': "недостаточно заданий на проверке"}
+        return results
+    results['approve_task'] = await measure(
+        approve_db, 'approve_task', lambda i: approve_db.approve_task(task_ids[i], MODERATOR_ID),
+        len(task_ids) - warmup, warmup
+    )
+    print(f"  {'approve_task':<32} p50 {results['approve_task']['p50_ms']:>8.2f} мс", file=sys.stderr)
+    return results
+
+
+async def bench_sqlite(users: int, args, data_dir: str) -> dict:
+    path = os.path.join(data_dir, f"bench_{users}_{args.months}m_s{args.seed}.db")
+    seed_seconds = None
+    rows = None
+    if not os.path.exists(path):
+        db = Database(path)
+        await db.init_db()
+        await db.close()
+        started = time.perf_counter()
+        rows = seed_sqlite(path, users, args.months, args.seed)
+        seed_seconds = round(time.perf_counter() - started, 2)
+    if rows is None:
+        conn = sqlite3.connect(path)
+        rows = {table: conn.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0] for table in TABLES}
+        conn.close()
+
+    # Одобрение меняет базу, поэтому замеряется на копии, которая удаляется после замера
+    copy_path = os.path.join(os.path.dirname(path), f"approve_{os.path.basename(path)}")
+    source, target = sqlite3.connect(path), sqlite3.connect(copy_path)
+    try:
+        source.backup(target)
+    finally:
+        source.close()
+        target.close()
+
+    db = Database(path)
+    await db.init_db()
+    approve_db = Database(copy_path)
+    try:
+        methods = await run_methods(db, args.iterations, args.warmup, args.seed, approve_db)
+    finally:
+        await db.close()
+        await approve_db.close()
+        for suffix in ('', '-wal', '-shm'):
+            if os.path.exists(copy_path + suffix):
+                os.remove(copy_path + suffix)
+    return {'users': users, 'seed_seconds': seed_seconds, 'rows': rows,
+            'db_size_mb': round(os.path.getsize(path) / 2 ** 20, 1), 'methods': methods}
+
+
+async def bench_postgres(users: int, args) -> dict:
+    db = Database(use_postgres=True)
+    await db.init_db()
+    try:
+        if await db.queries.fetchval(_Q_USERS_COUNT):
+            if not args.reset:
+                raise SystemExit("В базе PostgreSQL уже есть пользователи; для очистки запустите с --reset")
+            async with db.queries.acquire() as conn:
+                await conn.execute(f"TRUNCATE {', '.join(TABLES)} CASCADE")
+        started = time.perf_counter()
+        async with db.queries.acquire() as conn:
+            rows = await seed_postgres(conn, users, args.months, args.seed)
+        seed_seconds = round(time.perf_counter() - started, 2)
+        methods = await run_methods(db, args.iterations, args.warmup, args.seed)
+    finally:
+        await db.close()
+    return {'users': users, 'seed_seconds': seed_seconds, 'rows': rows, 'methods': methods}
+
+
+async def run(args) -> dict:
+    # Медленные вызовы в бенчмарке ожидаемы, журнал не нужен
+    DB_METRICS.slow_query_ms = float('inf')
+    scales = [int(value) for value in args.users.split(',')]
+    results = []
+    with tempfile.TemporaryDirectory() as temp_dir:
+        data_dir = args.data_dir or temp_dir
+        os.makedirs(data_dir, exist_ok=True)
+        for users in scales:
+            print(f"Пользователей: {users}", file=sys.stderr)
+            result = await (bench_postgres(users, args) if args.postgres else bench_sqlite(users, args, data_dir))
+            results.append(result)
+    return {
+        'meta': {
+            'started_at': datetime.datetime.now().isoformat(timespec='seconds'),
+            'backend': 'postgres' if args.postgres else 'sqlite',
+            'sqlite_version': sqlite3.sqlite_version,
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'months': args.months,
+            'seed': args.seed,
+            'iterations': args.iterations,
+            'warmup': args.warmup,
+        },
+        'results': results,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Бенчмарк методов Database на синтетических данных")
+    parser.add_argument('--users', default='10000,100000,1000000', help="размеры базы через запятую")
+    parser.add_argument('--months', type=int, default=3, help="месяцев истории заданий")
+    parser.add_argument('--iterations', type=int, default=200, help="замеряемых вызовов на метод")
+    parser.add_argument('--warmup', type=int, default=20, help="вызовов на прогрев")
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--data-dir', help="каталог для переиспользуемых SQLite-баз")
+    parser.add_argument('--output', help="файл для JSON с результатами (по умолчанию stdout)")
+    parser.add_argument('--postgres', action='store_true', help="PostgreSQL из настроек POSTGRES_*")
+    parser.add_argument('--reset', action='store_true', help="очистить таблицы PostgreSQL перед заполнением")
+    args = parser.parse_args()
+
+    report = asyncio.run(run(args))
+    text = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as file:
+            file.write(text)
+        print(f"Результаты записаны в {args.output}", file=sys.stderr)
+    else:
+        print(text)
+
+
+if __name__ == '__main__':
+    main()
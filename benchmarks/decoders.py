@@ -0,0 +1,130 @@
+"""
+Микро-бенчмарк декодирования строк users в модель User.
+
+Сравнивает прежний способ (dict(row) + row.get() + проверки isinstance на каждое поле,
+dataclass с __dict__) с генерируемым декодером из row_decoders и dataclass(slots=True).
+Строки читаются из временной SQLite базы в памяти.
+
+Запуск: python -m benchmarks.decoders [количество строк]
+"""
+import datetime
+import sqlite3
+import sys
+import time
+import tracemalloc
+from dataclasses import fields, make_dataclass, field
+from datetime import date
+
+from models import User
+from row_decoders import decode_rows
+
+# User в прежнем виде: тот же набор полей, но без __slots__
+LegacyUser = make_dataclass(
+    'LegacyUser',
+    [(f.name, f.type, field(default=f.default)) for f in fields(User)]
+)
+
+
+def legacy_decode(row) -> LegacyUser:
+    """Преобразование строки так, как это делалось до row_decoders"""
+    row = dict(row)
+    birth_date = None
+    if row.get('birth_date'):
+        if isinstance(row['birth_date'], date):
+            birth_date = row['birth_date']
+        elif isinstance(row['birth_date'], str):
+            try:
+                birth_date = date.fromisoformat(row['birth_date'])
+            except ValueError:
+                pass
+
+    subscription_start = row.get('subscription_start')
+    subscription_end = row.get('subscription_end')
+    if isinstance(subscription_start, datetime.datetime):
+        subscription_start = int(subscription_start.timestamp())
+    elif subscription_start is None:
+        subscription_start = None
+    if isinstance(subscription_end, datetime.datetime):
+        subscription_end = int(subscription_end.timestamp())
+    elif subscription_end is None:
+        subscription_end = None
+
+    return LegacyUser(
+        telegram_id=row['telegram_id'],
+        language=row.get('language', 'ru'),
+        name=row.get('name', ''),
+        birth_date=birth_date,
+        height=row.get('height'),
+        weight=row.get('weight'),
+        city=row.get('city'),
+        referral_code=row.get('referral_code'),
+        goal=row.get('goal'),
+        subscription_active=bool(row.get('subscription_active', False)),
+        subscription_start=subscription_start,
+        subscription_end=subscription_end,
+        referral_count=row.get('referral_count', 0)
+    )
+
+
+def make_rows(count: int) -> list:
+    """Синтетическая таблица users нужного размера"""
+    conn = sqlite3.connect(':memory:')
+    conn.row_factory = sqlite3.Row
+    conn.execute('''
+        CREATE TABLE users (
+            telegram_id INTEGER PRIMARY KEY, language TEXT, name TEXT, birth_date TEXT,
+            height REAL, weight REAL, city TEXT, referral_code TEXT, goal TEXT,
+            subscription_active BOOLEAN, subscription_start INTEGER, subscription_end INTEGER,
+            referral_count INTEGER, created_at TIMESTAMP, updated_at TIMESTAMP
+        )
+    ''')
+    now = int(time.time())
+    conn.executemany(
+        'INSERT INTO users VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, CURRENT_TIMESTAMP, CURRENT_TIMESTAMP)',
+        (
+            (i, 'ru', f'user{i}', '1990-05-17', 180.0, 75.5, 'Москва', f'CODE{i % 50}', 'Похудеть',
+             i % 2, now, now + 30 * 86400, i % 7)
+            for i in range(1, count + 1)
+        )
+    )
+    rows = conn.execute('SELECT * FROM users').fetchall()
+    conn.close()
+    return rows
+
+
+def measure(name: str, decode_all, rows: list) -> dict:
+    """Время декодирования всех строк и память, занимаемая результатом"""
+    start = time.perf_counter()
+    decode_all(rows)
+    elapsed = time.perf_counter() - start
+
+    tracemalloc.start()
+    result = decode_all(rows)
+    memory, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del result
+
+    return {
+        'name': name,
+        'rows_per_sec': round(len(rows) / elapsed),
+        'seconds': round(elapsed, 3),
+        'memory_mb': round(memory / 1024 / 1024, 1),
+    }
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 100_000
+    rows = make_rows(count)
+
+    results = [
+        measure('до: dict(row) + dataclass', lambda r: [legacy_decode(row) for row in r], rows),
+        measure('после: декодер + slots', lambda r: decode_rows(User, r), rows),
+    ]
+
+    print(f"Строк: {count}")
+    for r in results:
+        print(f"{r['name']:<30} {r['rows_per_sec']:>10} строк/с  {r['seconds']:>7} с  {r['memory_mb']:>7} МБ")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,133 @@
+"""
+Бенчмарк записи в SQLite из двух процессов одновременно (как основной и модераторский боты).
+
+Сравнивает прежний способ (отдельное соединение и COMMIT на каждую запись, журнал по
+умолчанию) с профилем производительности (WAL, PRAGMA, единая задача записи с групповой
+фиксацией через QueryExecutor). Каждый процесс выполняет заданное число UPDATE из
+нескольких корутин; считаются записи в секунду и ошибки "database is locked".
+
+Запуск: python -m benchmarks.sqlite_writes [записей на процесс] [корутин на процесс]
+"""
+import asyncio
+import multiprocessing
+import os
+import sqlite3
+import sys
+import tempfile
+import time
+
+import aiosqlite
+
+from query_layer import Query, QueryExecutor
+
+USERS = 1000
+_Q_ADD_EXPERIENCE = Query("UPDATE user_stats SET experience = experience + 1 WHERE user_id = ?")
+
+
+def make_database(path: str, wal: bool):
+    """Таблица user_stats с USERS строками"""
+    conn = sqlite3.connect(path)
+    if wal:
+        conn.execute("PRAGMA journal_mode = WAL")
+    conn.execute("CREATE TABLE user_stats (user_id INTEGER PRIMARY KEY, experience INTEGER DEFAULT 0)")
+    conn.executemany("INSERT INTO user_stats (user_id) VALUES (?)", ((i,) for i in range(1, USERS + 1)))
+    conn.commit()
+    conn.close()
+
+
+async def legacy_writes(path: str, writes: int, workers: int) -> int:
+    """Запись как в методах Database: соединение и фиксация на каждое изменение"""
+    errors = 0
+
+    async def worker(offset: int):
+        nonlocal errors
+        for i in range(offset, writes, workers):
+            try:
+                async with aiosqlite.connect(path) as db:
+                    await db.execute(_Q_ADD_EXPERIENCE.sql(False), (i % USERS + 1,))
+                    await db.commit()
+            except sqlite3.OperationalError:
+                errors += 1
+
+    await asyncio.gather(*(worker(w) for w in range(workers)))
+    return errors
+
+
+async def profile_writes(path: str, writes: int, workers: int) -> int:
+    """Запись через QueryExecutor в профиле производительности"""
+    executor = QueryExecutor(path, use_postgres=False)
+    executor.sqlite_profile = True
+    errors = 0
+
+    async def worker(offset: int):
+        nonlocal errors
+        for i in range(offset, writes, workers):
+            try:
+                await executor.execute(_Q_ADD_EXPERIENCE, i % USERS + 1)
+            except sqlite3.OperationalError:
+                errors += 1
+
+    try:
+        await asyncio.gather(*(worker(w) for w in range(workers)))
+    finally:
+        await executor.close()
+    return errors
+
+
+def run_process(mode: str, path: str, writes: int, workers: int, start, results):
+    start.wait()
+    write = legacy_writes if mode == 'legacy' else profile_writes
+    results.put(asyncio.run(write(path, writes, workers)))
+
+
+def measure(name: str, mode: str, writes: int, workers: int) -> dict:
+    """Два процесса пишут в одну базу одновременно"""
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'bench.db')
+        make_database(path, wal=(mode == 'profile'))
+
+        start = multiprocessing.Event()
+        results = multiprocessing.Queue()
+        processes = [
+            multiprocessing.Process(target=run_process, args=(mode, path, writes, workers, start, results))
+            for _ in range(2)
+        ]
+        for process in processes:
+            process.start()
+        started = time.perf_counter()
+        start.set()
+        errors = sum(results.get() for _ in processes)
+        for process in processes:
+            process.join()
+        elapsed = time.perf_counter() - started
+
+        conn = sqlite3.connect(path)
+        applied = conn.execute("SELECT SUM(experience) FROM user_stats").fetchone()[0]
+        conn.close()
+
+    return {
+        'name': name,
+        'writes_per_sec': round(applied / elapsed),
+        'seconds': round(elapsed, 2),
+        'applied': applied,
+        'errors': errors,
+    }
+
+
+def main():
+    writes = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    workers = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+
+    results = [
+        measure('до: соединение + COMMIT', 'legacy', writes, workers),
+        measure('после: WAL + групповая фиксация', 'profile', writes, workers),
+    ]
+
+    print(f"Процессов: 2, записей на процесс: {writes}, корутин на процесс: {workers}")
+    for r in results:
+        print(f"{r['name']:<34} {r['writes_per_sec']:>8} записей/с  {r['seconds']:>7} с  "
+              f"применено {r['applied']:>6}  ошибок {r['errors']:>5}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,283 @@
+"""
+Генератор синтетических данных для бенчмарков базы данных.
+
+Заполняет пустую базу (SQLite или PostgreSQL, схема создается Database.init_db) N пользователями
+с подписками, player_stats, user_stats и историей daily_tasks и notifications за несколько месяцев.
+Распределения приближены к реальным:
+- города и реферальные коды блогеров - по закону Ципфа (несколько крупных, длинный хвост);
+- активна примерно треть пользователей, остальные перестали заходить после регистрации;
+- дни с заданиями у пользователя - случайный процесс с личной вероятностью активности
+  (бета-распределение), поэтому у большинства мало заданий, у немногих - почти каждый день;
+- опыт, уровень, ранг и стрики вычисляются по сгенерированным одобренным заданиям;
+- уведомления создаются на каждое проверенное задание, неотправленные - только за последние сутки.
+Генерация детерминирована при одинаковом seed.
+
+Запуск: python -m benchmarks.synthetic_data [пользователей] [месяцев] [путь к SQLite]
+"""
+import asyncio
+import datetime
+import json
+import math
+import os
+import random
+import sqlite3
+import sys
+import time
+from itertools import accumulate
+from typing import Iterator
+
+from rank_config import get_rank_by_experience
+
+DAY = 86400
+# Идентификаторы синтетических пользователей не пересекаются с реальными Telegram ID
+FIRST_USER_ID = 9_000_000_000
+ACTIVE_SHARE = 0.35
+# Пользователей в одной пачке вставки
+BATCH_USERS = 5000
+
+CITIES = (
+    "Москва", "Санкт-Петербург", "Новосибирск", "Екатеринбург", "Казань", "Нижний Новгород",
+    "Челябинск", "Красноярск", "Самара", "Уфа", "Ростов-на-Дону", "Омск", "Краснодар", "Воронеж",
+    "Пермь", "Волгоград", "Саратов", "Тюмень", "Тольятти", "Барнаул", "Ижевск", "Махачкала",
+    "Хабаровск", "Ульяновск", "Иркутск", "Владивосток", "Ярославль", "Севастополь", "Томск", "Калининград",
+)
+NAMES = ("Александр", "Мария", "Дмитрий", "Анна", "Максим", "Елена", "Иван", "Ольга", "Артем", "Наталья")
+GOALS = ("Похудеть", "Набрать мышечную массу", "Стать выносливее", "Улучшить гибкость", "Поддерживать форму")
+TASKS = (
+    "Сделайте 50 приседаний", "Пробегите 3 км", "Планка 2 минуты", "30 отжиманий",
+    "Прогулка 10 000 шагов", "Растяжка 15 минут", "Скакалка 500 прыжков", "Йога 20 минут",
+)
+TIMEZONES = ("Asia/Yekaterinburg", "Asia/Novosibirsk", "Europe/Samara", "Asia/Vladivostok")
+
+# Колонки, которые в PostgreSQL имеют тип TIMESTAMP/DATE, а в SQLite хранятся как unix timestamp
+_POSTGRES_TIMESTAMPS = {
+    'daily_tasks': ('created_at', 'expires_at', 'completed_at'),
+    'notifications': ('sent_at',),
+}
+_POSTGRES_DATES = {
+    'user_stats': ('last_task_date',),
+}
+TABLES = ('users', 'subscriptions', 'player_stats', 'user_stats', 'daily_tasks', 'notifications')
+
+
+def _zipf_weights(count: int, exponent: float = 1.1) -> list[float]:
+    return list(accumulate(1 / (rank + 1) ** exponent for rank in range(count)))
+
+
+def _streaks(days: list[int]) -> tuple[int, int]:
+    """Текущая (заканчивающаяся последним днем) и лучшая серия подряд идущих дней"""
+    best = current = 0
+    previous = None
+    for day in days:
+        current = current + 1 if previous is not None and day == previous + 1 else 1
+        best = max(best, current)
+        previous = day
+    return current, best
+
+
+def generate(users: int, months: int = 3, seed: int = 1, now: int = None) -> Iterator[dict[str, list[dict]]]:
+    """Пачки строк {таблица: [строка, ...]} на каждые BATCH_USERS пользователей"""
+    rng = random.Random(seed)
+    now = now or int(time.time())
+    today = now - now % DAY
+    history_days = months * 30
+    city_weights = _zipf_weights(len(CITIES))
+    bloggers = [f"BLOG{index:05d}" for index in range(max(10, users // 2000))]
+    blogger_weights = _zipf_weights(len(bloggers))
+
+    batch = {table: [] for table in TABLES}
+    for index in range(users):
+        user_id = FIRST_USER_ID + index
+        active = rng.random() < ACTIVE_SHARE
+        joined = rng.randrange(history_days + 1)  # дней назад
+        # Ушедшие пользователи выполняли задания недолго после регистрации
+        last_day = 0 if active else max(0, joined - 1 - int(rng.expovariate(1 / 14)))
+        activity = rng.betavariate(2, 3) if active else rng.betavariate(1, 8)
+
+        # Дни с заданиями до вчерашнего: промежутки между ними - геометрическое распределение
+        task_days = []
+        day = joined
+        while True:
+            day -= 1 + int(math.log(1 - rng.random()) / math.log(1 - activity))
+            if day < max(last_day, 1):
+                break
+            task_days.append(day)
+        if active and rng.random() < activity:
+            task_days.append(0)  # задание на сегодня
+
+        approved_days = []
+        experience = 0
+        last_task_time = None
+        for days_ago in task_days:
+            created_at = today - days_ago * DAY + rng.randrange(6 * 3600, 12 * 3600)
+            task = {
+                'user_id': user_id, 'task_description': rng.choice(TASKS), 'created_at': created_at,
+                'expires_at': created_at + DAY, 'status': 'pending', 'completed_at': None,
+                'submitted_media_path': None, 'moderator_comment': None,
+            }
+            if days_ago == 0:
+                task['status'] = 'submitted' if rng.random() < 0.4 else 'pending'
+            else:
+                outcome = rng.random()
+                if outcome < 0.72:
+                    task['status'] = 'approved'
+                elif outcome < 0.8:
+                    task['status'] = 'rejected'
+                    task['moderator_comment'] = "Выполнение не видно на видео"
+                else:
+                    task['status'] = 'expired'
+            if task['status'] in ('approved', 'rejected'):
+                task['completed_at'] = created_at + rng.randrange(3600, 20 * 3600)
+                approved = task['status'] == 'approved'
+                if approved:
+                    reward = rng.randrange(10, 31)
+                    experience += reward
+                    approved_days.append(-days_ago)
+                    last_task_time = created_at
+                sent = task['completed_at'] < now - DAY or rng.random() < 0.9
+                batch['notifications'].append({
+                    'user_id': user_id,
+                    'type': 'task_approved' if approved else 'task_rejected',
+                    'title': "Задание одобрено" if approved else "Задание отклонено",
+                    'message': task['task_description'],
+                    'data': json.dumps({'experience': reward}) if approved else None,
+                    'is_sent': sent,
+                    'created_at': task['completed_at'],
+                    'sent_at': task['completed_at'] + rng.randrange(1, 60) if sent else None,
+                })
+            batch['daily_tasks'].append(task)
+
+        approved_days.sort()
+        current_streak, best_streak = _streaks(approved_days)
+        batch['user_stats'].append({
+            'user_id': user_id, 'level': experience // 100 + 1, 'experience': experience,
+            'rank': get_rank_by_experience(experience).value, 'current_streak': current_streak,
+            'best_streak': best_streak, 'total_tasks_completed': len(approved_days),
+            'last_task_date': last_task_time,
+        })
+        batch['player_stats'].append({
+            'user_id': user_id, 'nickname': f"player{index}", 'experience': experience,
+            **{stat: max(1, min(100, int(rng.gauss(50, 12))))
+               for stat in ('strength', 'agility', 'endurance', 'intelligence', 'charisma')},
+            'created_at': today - joined * DAY,
+        })
+
+        subscription_active = False
+        if rng.random() < (0.7 if active else 0.15):
+            months_paid = rng.choice((1, 1, 1, 3, 6, 12))
+            start_date = today - rng.randrange(joined + 1) * DAY
+            end_date = start_date + months_paid * 30 * DAY
+            subscription_active = end_date > now
+            batch['subscriptions'].append({
+                'user_id': user_id, 'months': months_paid,
+                'subscription_level': rng.choices((1, 2, 3), (0.6, 0.3, 0.1))[0],
+                'start_date': start_date, 'end_date': end_date,
+                'status': 'active' if subscription_active else 'expired',
+            })
+
+        batch['users'].append({
+            'telegram_id': user_id, 'language': 'ru' if rng.random() < 0.9 else 'en',
+            'name': rng.choice(NAMES), 'birth_date': (
+                datetime.date.today() - datetime.timedelta(days=int(365 * max(14, min(70, rng.gauss(28, 7)))))
+            ).isoformat(),
+            'height': round(rng.gauss(172, 9), 1), 'weight': round(rng.gauss(72, 13), 1),
+            'city': rng.choices(CITIES, cum_weights=city_weights)[0],
+            'referral_code': rng.choices(bloggers, cum_weights=blogger_weights)[0] if rng.random() < 0.25 else None,
+            'goal': rng.choice(GOALS), 'subscription_active': subscription_active,
+            'timezone': rng.choice(TIMEZONES) if rng.random() < 0.05 else None,
+        })
+
+        if len(batch['users']) >= BATCH_USERS:
+            yield batch
+            batch = {table: [] for table in TABLES}
+    if batch['users']:
+        yield batch
+
+
+def _insert_order(batch: dict[str, list[dict]]):
+    # Пользователи вставляются раньше строк, ссылающихся на них
+    for table in TABLES:
+        if batch[table]:
+            yield table, batch[table]
+
+
+def seed_sqlite(path: str, users: int, months: int = 3, seed: int = 1) -> dict[str, int]:
+    """Заполнение SQLite базы (схема уже создана); возвращает количество строк по таблицам"""
+    conn = sqlite3.connect(path)
+    # Заполнение одноразовое: надежность фиксации не нужна
+    conn.execute("PRAGMA synchronous = OFF")
+    columns = {table: {row[1] for row in conn.execute(f"PRAGMA table_info({table})")} for table in TABLES}
+    counts = dict.fromkeys(TABLES, 0)
+    try:
+        for batch in generate(users, months, seed):
+            for table, rows in _insert_order(batch):
+                names = [name for name in rows[0] if name in columns[table]]
+                conn.executemany(
+                    f"INSERT INTO {table} ({', '.join(names)}) VALUES ({', '.join('?' * len(names))})",
+                    ([row[name] for name in names] for row in rows)
+                )
+                counts[table] += len(rows)
+            conn.commit()
+        conn.execute("ANALYZE")
+    finally:
+        conn.close()
+    return counts
+
+
+def _to_postgres(table: str, row: dict) -> dict:
+    for name in _POSTGRES_TIMESTAMPS.get(table, ()):
+        if row[name] is not None:
+            row[name] = datetime.datetime.fromtimestamp(row[name])
+    for name in _POSTGRES_DATES.get(table, ()):
+        if row[name] is not None:
+            row[name] = datetime.date.fromtimestamp(row[name])
+    return row
+
+
+async def seed_postgres(conn, users: int, months: int = 3, seed: int = 1) -> dict[str, int]:
+    """Заполнение PostgreSQL (схема уже создана) через COPY; возвращает количество строк по таблицам"""
+    rows = await conn.fetch('''
+        SELECT table_name, column_name FROM information_schema.columns
+        WHERE table_schema = current_schema() AND table_name = ANY($1::text[])
+    ''', list(TABLES))
+    columns = {table: set() for table in TABLES}
+    for row in rows:
+        columns[row['table_name']].add(row['column_name'])
+
+    counts = dict.fromkeys(TABLES, 0)
+    for batch in generate(users, months, seed):
+        async with conn.transaction():
+            for table, table_rows in _insert_order(batch):
+                names = [name for name in table_rows[0] if name in columns[table]]
+                await conn.copy_records_to_table(
+                    table, columns=names,
+                    records=[tuple(row[name] for name in names)
+                             for row in (_to_postgres(table, row) for row in table_rows)],
+                )
+                counts[table] += len(table_rows)
+    await conn.execute(f"ANALYZE {', '.join(TABLES)}")
+    return counts
+
+
+async def _main():
+    from database import Database
+
+    users = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    months = int(sys.argv[2]) if len(sys.argv) > 2 else 3
+    path = sys.argv[3] if len(sys.argv) > 3 else f"bench_{users}.db"
+    if os.path.exists(path):
+        print(f"Файл {path} уже существует")
+        return
+
+    db = Database(path)
+    await db.init_db()
+    await db.close()
+    started = time.perf_counter()
+    counts = seed_sqlite(path, users, months)
+    print(f"База {path} заполнена за {time.perf_counter() - started:.1f} с")
+    for table, count in counts.items():
+        print(f"  {table:<14} {count:>10}")
+
+
+if __name__ == '__main__':
+    asyncio.run(_main())
@@ -3,6 +3,7 @@ import logging
 import aiohttp
 import aiosqlite
 import datetime
+import html
 import os
 from datetime import date
 import textwrap
@@ -10,14 +11,30 @@ from typing import Optional
 
 from aiogram import Bot, Dispatcher, Router, F
 from aiogram.client.default import DefaultBotProperties
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
 from aiogram.enums import ParseMode
+from aiogram.exceptions import TelegramForbiddenError, TelegramRetryAfter
 from aiogram.filters import Command, CommandStart
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
+from aiogram.fsm.storage.base import StorageKey
 from aiogram.types import Message, ReplyKeyboardMarkup, KeyboardButton, ReplyKeyboardRemove, InlineKeyboardMarkup, InlineKeyboardButton, CallbackQuery, FSInputFile
 
-from config import BOT_TOKEN, USE_POSTGRES, DATABASE_PATH
+from config import (
+    BOT_TOKEN, USE_POSTGRES, DATABASE_PATH, DB_ITER_BATCH_SIZE, DB_STATEMENT_CACHE_SIZE, DB_POOL_SIZE, DB_REPLICA_DSN,
+    DB_READ_YOUR_WRITES_SECONDS, TELEGRAM_API_URL, TELEGRAM_API_LOCAL,
+    USE_WEBHOOK, WEBHOOK_BASE_URL, WEBHOOK_PATH, WEBHOOK_SECRET, WEBAPP_HOST, WEBAPP_PORT, WEBHOOK_WORKERS,
+    PAYMENT_POLL_INTERVAL, NOTIFICATION_SEND_INTERVAL, EXPERIENCE_RESET_INTERVAL, SUBSCRIPTION_WARNING_INTERVAL,
+    LEADER_RETRY_INTERVAL, LEADER_LOCK_FILE, METRICS_PORT, METRICS_SNAPSHOT_INTERVAL, NOTIFICATION_BATCH_SIZE, NOTIFICATION_RATE_LIMIT,
+    DAILY_TASK_EXPIRY_INTERVAL, DAILY_TASK_SUBMISSION_TTL_HOURS, RETENTION_DAYS, ARCHIVE_CRON, ARCHIVE_BATCH_SIZE
+)
 from database import Database
+from streaks import STREAK_TIMEZONE
+from scheduler import Scheduler
+from leader_election import LeaderElection, create_leader_lock
+from db_metrics import MetricsReporter
+from user_context import UserContext, UserContextMiddleware
 from models import User, Payment, PaymentStatus, Subscription, SubscriptionStatus, PlayerStats, Rank, DailyTask, UserStats, TaskStatus, Prize, PrizeType
 from polza_config import (
     POLZA_API_KEY, POLZA_BASE_URL, DEFAULT_MODEL, VISION_MODEL, SYSTEM_PROMPT,
@@ -56,14 +73,39 @@ class UserRegistration(StatesGroup):
     changing_goal = State()
 
 # Инициализация бота и диспетчера
-bot = Bot(token=BOT_TOKEN, default=DefaultBotProperties(parse_mode=ParseMode.HTML))
+# Если задан TELEGRAM_API_URL, запросы идут на указанный Bot API сервер (локальный или тестовый)
+bot_session = None
+if TELEGRAM_API_URL:
+    bot_session = AiohttpSession(api=TelegramAPIServer.from_base(TELEGRAM_API_URL, is_local=TELEGRAM_API_LOCAL))
+bot = Bot(token=BOT_TOKEN, session=bot_session, default=DefaultBotProperties(parse_mode=ParseMode.HTML))
 dp = Dispatcher()
 
+# Эндпоинт и сохранение метрик БД процесса (создается при запуске)
+metrics_reporter = None
+
+# Очереди процессов-обработчиков в режиме webhook (None в режиме polling)
+webhook_queues = None
+webhook_worker_index = 0
+
 # Логируем настройки базы данных для отладки
 logger.info(f"USE_POSTGRES из config: {USE_POSTGRES}")
 logger.info(f"DATABASE_PATH: {DATABASE_PATH}")
 
-db = Database(db_path=DATABASE_PATH, use_postgres=USE_POSTGRES)
+db = Database(db_path=DATABASE_PATH, use_postgres=USE_POSTGRES, replica_dsn=DB_REPLICA_DSN or None)
+db.iter_batch_size = DB_ITER_BATCH_SIZE
+db.queries.statement_cache_size = DB_STATEMENT_CACHE_SIZE
+db.queries.pool_size = DB_POOL_SIZE
+db.read_your_writes_window = DB_READ_YOUR_WRITES_SECONDS
+db.retention_days = RETENTION_DAYS
+# Планировщик фоновых задач (задачи регистрируются декоратором @scheduler.job)
+scheduler = Scheduler(db)
+# Планировщик работает только в ведущем экземпляре бота
+leader_election = LeaderElection(
+    create_leader_lock(db, LEADER_LOCK_FILE or None),
+    on_elected=scheduler.start,
+    on_lost=scheduler.stop,
+    retry_interval=LEADER_RETRY_INTERVAL
+)
 
 # Создание роутера для обработки сообщений
 router = Router()
@@ -1848,13 +1890,13 @@ async def process_player_photo_invalid(message: Message):
 # Обработчики главного меню
 
 @router.message(F.text == "🎯 Получить задание")
-async def handle_get_task(message: Message, state: FSMContext):
+async def handle_get_task(message: Message, state: FSMContext, user_ctx: UserContext):
     """Обработка получения задания"""
     user_id = message.from_user.id
     logger.info(f"Пользователь {user_id} запросил получение задания")
 
     # Проверяем активную подписку
-    is_active, error_msg = await check_user_subscription(user_id)
+    is_active, error_msg = await check_user_subscription(user_id, user_ctx)
     if not is_active:
         await message.answer(
             error_msg,
@@ -1886,7 +1928,7 @@ async def handle_get_task(message: Message, state: FSMContext):
         return
 
     # Получаем цель пользователя для генерации задания
-    user = await db.get_user(user_id)
+    user = await user_ctx.get_user()
     if not user:
         logger.error(f"Пользователь {user_id} не найден в базе данных")
         await message.answer(
@@ -1951,12 +1993,12 @@ async def handle_get_task(message: Message, state: FSMContext):
     )
 
 @router.message(F.text == "📋 Активные задания")
-async def handle_active_tasks(message: Message, state: FSMContext):
+async def handle_active_tasks(message: Message, state: FSMContext, user_ctx: UserContext):
     """Обработка просмотра активных заданий"""
     user_id = message.from_user.id
 
     # Проверяем активную подписку
-    is_active, error_msg = await check_user_subscription(user_id)
+    is_active, error_msg = await check_user_subscription(user_id, user_ctx)
     if not is_active:
         await message.answer(
             error_msg,
@@ -2021,14 +2063,14 @@ async def handle_active_tasks(message: Message, state: FSMContext):
     )
 
 @router.message(F.text == "👤 Профиль")
-async def handle_profile(message: Message, state: FSMContext):
+async def handle_profile(message: Message, state: FSMContext, user_ctx: UserContext):
     """Обработка просмотра профиля"""
     user_id = message.from_user.id
 
     # Получаем данные пользователя
-    user = await db.get_user(user_id)
-    player_stats = await db.get_player_stats(user_id)
-    user_statistics = await db.get_user_stats(user_id)
+    user = await user_ctx.get_user()
+    player_stats = await user_ctx.get_player_stats()
+    user_statistics = await user_ctx.get_user_stats()
 
     if not user or not player_stats or not user_statistics:
         await message.answer(
@@ -2103,15 +2145,15 @@ async def handle_profile(message: Message, state: FSMContext):
     )
 
 @router.callback_query(lambda c: c.data == "go_to_profile")
-async def handle_go_to_profile(callback: CallbackQuery, state: FSMContext):
+async def handle_go_to_profile(callback: CallbackQuery, state: FSMContext, user_ctx: UserContext):
     """Обработка перехода в профиль из команды /start"""
     await callback.answer()
     user_id = callback.from_user.id
     
     # Получаем данные пользователя
-    user = await db.get_user(user_id)
-    player_stats = await db.get_player_stats(user_id)
-    user_statistics = await db.get_user_stats(user_id)
+    user = await user_ctx.get_user()
+    player_stats = await user_ctx.get_player_stats()
+    user_statistics = await user_ctx.get_user_stats()
     
     if not user or not player_stats or not user_statistics:
         await callback.message.answer(
@@ -2294,63 +2336,77 @@ async def get_profile_text(user, player_stats, user_statistics, db) -> str:
         f"🎮 <b>Выберите действие:</b>"
     )
 
-@router.message(F.text == "🎁 Призы")
-async def handle_prizes(message: Message, state: FSMContext):
-    """Обработка просмотра призов"""
-    user_id = message.from_user.id
-
-    # Получаем данные пользователя
-    user = await db.get_user(user_id)
+# Кэш отрендеренных списков призов: (referral_code, subscription_level) -> (версия каталога, текст)
+_prize_text_cache: dict[tuple, tuple[int, str]] = {}
+
+def format_prize_list(prizes: list[Prize]) -> str:
+    """Форматирование списка призов для показа пользователю"""
+    text = ""
+    level_names = {2: "Продвинутый", 3: "Мастер"}
+    for prize in prizes:
+        text += f"{prize.emoji} <b>{prize.title}</b>"
+        if prize.subscription_level:
+            text += f" <i>(для уровня {prize.subscription_level} - {level_names.get(prize.subscription_level, '')})</i>"
+        text += "\n"
+        if prize.description:
+            text += f"   └ {prize.description}\n"
+        text += f"   └ Достижение: {get_achievement_description(prize.achievement_type, prize.achievement_value, prize.custom_condition)}\n\n"
+    return text
 
-    # Получаем активную подписку пользователя
-    active_subscription = await db.get_active_subscription(user_id)
-    subscription_level = active_subscription.subscription_level if active_subscription else None
+async def render_prize_sections(referral_code: Optional[str], subscription_level: Optional[int]) -> str:
+    """
+    Текст разделов призов (от главного модератора и от блогера).
+    Результат кэшируется до изменения версии каталога призов.
+    """
+    version = await db.get_prize_catalog_version()
+    key = (referral_code, subscription_level)
+    cached = _prize_text_cache.get(key)
+    if cached and cached[0] == version:
+        return cached[1]
 
     # Получаем призы от главного модератора (для всех и для уровня подписки пользователя)
     admin_prizes = await db.get_prizes(prize_type=PrizeType.ADMIN, is_active=True, subscription_level=subscription_level)
 
     # Получаем призы от блогера (если есть реферальный код)
     blogger_prizes = []
-    if user and user.referral_code:
-        blogger_prizes = await db.get_prizes(prize_type=PrizeType.BLOGGER, referral_code=user.referral_code, is_active=True, subscription_level=subscription_level)
-
-    prize_text = "🎁 <b>Текущие призы</b>\n\n"
+    if referral_code:
+        blogger_prizes = await db.get_prizes(prize_type=PrizeType.BLOGGER, referral_code=referral_code, is_active=True, subscription_level=subscription_level)
 
     # Призы от главного модератора
+    text = "👑 <b>Призы от главного модератора:</b>\n"
     if admin_prizes:
-        prize_text += "👑 <b>Призы от главного модератора:</b>\n"
-        for prize in admin_prizes:
-            prize_text += f"{prize.emoji} <b>{prize.title}</b>"
-            if prize.subscription_level:
-                level_names = {2: "Продвинутый", 3: "Мастер"}
-                prize_text += f" <i>(для уровня {prize.subscription_level} - {level_names.get(prize.subscription_level, '')})</i>"
-            prize_text += "\n"
-            if prize.description:
-                prize_text += f"   └ {prize.description}\n"
-            prize_text += f"   └ Достижение: {get_achievement_description(prize.achievement_type, prize.achievement_value, prize.custom_condition)}\n\n"
+        text += format_prize_list(admin_prizes)
     else:
-        prize_text += "👑 <b>Призы от главного модератора:</b>\n"
-        prize_text += "   └ Пока нет активных призов\n\n"
+        text += "   └ Пока нет активных призов\n\n"
 
     # Призы от блогера
-    if user and user.referral_code:
+    if referral_code:
+        text += f"📣 <b>Призы от блогера '{referral_code}':</b>\n"
         if blogger_prizes:
-            prize_text += f"📣 <b>Призы от блогера '{user.referral_code}':</b>\n"
-            for prize in blogger_prizes:
-                prize_text += f"{prize.emoji} <b>{prize.title}</b>"
-                if prize.subscription_level:
-                    level_names = {2: "Продвинутый", 3: "Мастер"}
-                    prize_text += f" <i>(для уровня {prize.subscription_level} - {level_names.get(prize.subscription_level, '')})</i>"
-                prize_text += "\n"
-                if prize.description:
-                    prize_text += f"   └ {prize.description}\n"
-                prize_text += f"   └ Достижение: {get_achievement_description(prize.achievement_type, prize.achievement_value, prize.custom_condition)}\n\n"
+            text += format_prize_list(blogger_prizes)
         else:
-            prize_text += f"📣 <b>Призы от блогера '{user.referral_code}':</b>\n"
-            prize_text += "   └ Пока нет активных призов\n\n"
+            text += "   └ Пока нет активных призов\n\n"
     else:
-        prize_text += "📣 <b>Призы от блогера:</b>\n"
-        prize_text += "   └ Укажите реферальный код блогера в профиле для просмотра его призов\n\n"
+        text += "📣 <b>Призы от блогера:</b>\n"
+        text += "   └ Укажите реферальный код блогера в профиле для просмотра его призов\n\n"
+
+    _prize_text_cache[key] = (version, text)
+    return text
+
+@router.message(F.text == "🎁 Призы")
+async def handle_prizes(message: Message, state: FSMContext, user_ctx: UserContext):
+    """Обработка просмотра призов"""
+
+    # Получаем данные пользователя
+    user = await user_ctx.get_user()
+
+    # Получаем активную подписку пользователя
+    active_subscription = await user_ctx.get_active_subscription()
+    subscription_level = active_subscription.subscription_level if active_subscription else None
+
+    referral_code = user.referral_code if user else None
+    prize_text = "🎁 <b>Текущие призы</b>\n\n"
+    prize_text += await render_prize_sections(referral_code, subscription_level)
 
     prize_text += "🏆 <b>Система достижений:</b>\n"
     prize_text += "Призы начисляются автоматически при достижении целей!\n\n"
@@ -2379,21 +2435,21 @@ async def handle_support(message: Message, state: FSMContext):
 
 # Обработчики медиафайлов для сдачи заданий
 @router.message(F.photo)
-async def handle_task_submission_photo(message: Message, state: FSMContext):
+async def handle_task_submission_photo(message: Message, state: FSMContext, user_ctx: UserContext):
     """Обработка отправки фото для сдачи задания"""
-    await handle_task_submission(message, state, "photo")
+    await handle_task_submission(message, state, "photo", user_ctx)
 
 @router.message(F.video)
-async def handle_task_submission_video(message: Message, state: FSMContext):
+async def handle_task_submission_video(message: Message, state: FSMContext, user_ctx: UserContext):
     """Обработка отправки видео для сдачи задания"""
-    await handle_task_submission(message, state, "video")
+    await handle_task_submission(message, state, "video", user_ctx)
 
-async def handle_task_submission(message: Message, state: FSMContext, media_type: str):
+async def handle_task_submission(message: Message, state: FSMContext, media_type: str, user_ctx: UserContext):
     """Обработка отправки медиафайла для сдачи задания"""
     user_id = message.from_user.id
 
     # Проверяем активную подписку
-    is_active, error_msg = await check_user_subscription(user_id)
+    is_active, error_msg = await check_user_subscription(user_id, user_ctx)
     if not is_active:
         await message.answer(
             error_msg,
@@ -2499,14 +2555,14 @@ def calculate_rank(level: int, best_streak: int, total_tasks: int) -> Rank:
 # Обработчики подменю профиля
 
 @router.callback_query(lambda c: c.data == "rating")
-async def handle_rating(callback: CallbackQuery, state: FSMContext):
+async def handle_rating(callback: CallbackQuery, state: FSMContext, user_ctx: UserContext):
     """Обработка просмотра рейтинга"""
     await callback.answer()
     user_id = callback.from_user.id
 
     # Получаем данные пользователя
-    user = await db.get_user(user_id)
-    user_stats = await db.get_user_stats(user_id)
+    user = await user_ctx.get_user()
+    user_stats = await user_ctx.get_user_stats()
 
     if not user or not user_stats:
         await callback.message.edit_text(
@@ -2519,27 +2575,27 @@ async def handle_rating(callback: CallbackQuery, state: FSMContext):
         return
 
     # Получаем активную подписку пользователя
-    active_subscription = await db.get_active_subscription(user_id)
+    active_subscription = await user_ctx.get_active_subscription()
     subscription_level = active_subscription.subscription_level if active_subscription else None
 
     # Получаем топ пользователей по городу
-    city_rating = await db.get_top_users_by_city(user.city, 10)
+    city_rating = await db.get_top_users_by_city(user.city, 10, viewer_id=user_id)
 
     # Получаем топ пользователей по рангу
-    rank_rating = await db.get_top_users_by_rank(user_stats.rank.value, 10)
+    rank_rating = await db.get_top_users_by_rank(user_stats.rank.value, 10, viewer_id=user_id)
 
     # Получаем топ пользователей среди подписчиков блогера (если есть реферальный код)
     referral_rating = None
     if user.referral_code:
-        referral_rating = await db.get_top_users_by_referral_code(user.referral_code, 10)
+        referral_rating = await db.get_top_users_by_referral_code(user.referral_code, 10, viewer_id=user_id)
 
     # Получаем рейтинг по уровню подписки для уровней 2 и 3
     level_2_rating = None
     level_3_rating = None
     if subscription_level and subscription_level >= 2:
-        level_2_rating = await db.get_top_users_by_subscription_level(2, 10)
+        level_2_rating = await db.get_top_users_by_subscription_level(2, 10, viewer_id=user_id)
     if subscription_level and subscription_level >= 3:
-        level_3_rating = await db.get_top_users_by_subscription_level(3, 10)
+        level_3_rating = await db.get_top_users_by_subscription_level(3, 10, viewer_id=user_id)
 
     rating_text = "📊 <b>Рейтинг</b>\n\n"
 
@@ -2601,15 +2657,14 @@ async def handle_rating(callback: CallbackQuery, state: FSMContext):
     )
 
 @router.callback_query(lambda c: c.data == "back_to_profile")
-async def handle_back_to_profile(callback: CallbackQuery, state: FSMContext):
+async def handle_back_to_profile(callback: CallbackQuery, state: FSMContext, user_ctx: UserContext):
     """Обработка возврата в профиль"""
     await callback.answer()
-    user_id = callback.from_user.id
 
     # Получаем данные пользователя
-    user = await db.get_user(user_id)
-    player_stats = await db.get_player_stats(user_id)
-    user_statistics = await db.get_user_stats(user_id)
+    user = await user_ctx.get_user()
+    player_stats = await user_ctx.get_player_stats()
+    user_statistics = await user_ctx.get_user_stats()
 
     if not user or not player_stats or not user_statistics:
         await callback.message.edit_text(
@@ -2659,13 +2714,12 @@ async def handle_back_to_profile(callback: CallbackQuery, state: FSMContext):
         )
 
 @router.callback_query(lambda c: c.data == "my_privileges")
-async def handle_my_privileges(callback: CallbackQuery, state: FSMContext):
+async def handle_my_privileges(callback: CallbackQuery, state: FSMContext, user_ctx: UserContext):
     """Обработка просмотра привилегий подписки"""
     await callback.answer()
-    user_id = callback.from_user.id
     
     # Получаем активную подписку пользователя
-    active_subscription = await db.get_active_subscription(user_id)
+    active_subscription = await user_ctx.get_active_subscription()
     
     if not active_subscription:
         await callback.message.answer(
@@ -2739,19 +2793,17 @@ async def handle_change_photo(callback: CallbackQuery, state: FSMContext):
     await state.update_data(is_photo_change=True)
 
 @router.callback_query(lambda c: c.data == "profile")
-async def handle_profile_callback(callback: CallbackQuery, state: FSMContext):
+async def handle_profile_callback(callback: CallbackQuery, state: FSMContext, user_ctx: UserContext):
     """Обработка возврата в профиль из различных состояний"""
     await callback.answer()
 
     # Очищаем состояние, если оно было установлено для замены фото
     await state.clear()
 
-    user_id = callback.from_user.id
-
     # Получаем данные пользователя
-    user = await db.get_user(user_id)
-    player_stats = await db.get_player_stats(user_id)
-    user_statistics = await db.get_user_stats(user_id)
+    user = await user_ctx.get_user()
+    player_stats = await user_ctx.get_player_stats()
+    user_statistics = await user_ctx.get_user_stats()
 
     if not user or not player_stats or not user_statistics:
         await callback.message.edit_text(
@@ -2798,13 +2850,12 @@ async def handle_profile_callback(callback: CallbackQuery, state: FSMContext):
         )
 
 @router.callback_query(lambda c: c.data == "payment_info")
-async def handle_payment_info(callback: CallbackQuery, state: FSMContext):
+async def handle_payment_info(callback: CallbackQuery, state: FSMContext, user_ctx: UserContext):
     """Обработка информации об оплате"""
     await callback.answer()
-    user_id = callback.from_user.id
 
     # Получаем данные о подписке
-    user = await db.get_user(user_id)
+    user = await user_ctx.get_user()
 
     if not user or not user.subscription_active or not user.subscription_end:
         await callback.message.answer(
@@ -2904,15 +2955,15 @@ async def process_goal_change(message: Message, state: FSMContext):
         )
 
 @router.callback_query(lambda c: c.data == "stats")
-async def handle_stats(callback: CallbackQuery, state: FSMContext):
+async def handle_stats(callback: CallbackQuery, state: FSMContext, user_ctx: UserContext):
     """Обработка просмотра статистики"""
     await callback.answer()
     user_id = callback.from_user.id
 
     # Получаем данные пользователя
-    user = await db.get_user(user_id)
-    user_stats = await db.get_user_stats(user_id)
-    player_stats = await db.get_player_stats(user_id)
+    user = await user_ctx.get_user()
+    user_stats = await user_ctx.get_user_stats()
+    player_stats = await user_ctx.get_player_stats()
 
     if not user or not user_stats or not player_stats:
         await callback.message.edit_text(
@@ -2985,13 +3036,12 @@ async def handle_stats(callback: CallbackQuery, state: FSMContext):
     )
 
 @router.callback_query(lambda c: c.data == "subscription")
-async def handle_subscription(callback: CallbackQuery, state: FSMContext):
+async def handle_subscription(callback: CallbackQuery, state: FSMContext, user_ctx: UserContext):
     """Обработка просмотра подписки"""
     await callback.answer()
-    user_id = callback.from_user.id
 
     # Получаем данные пользователя
-    user = await db.get_user(user_id)
+    user = await user_ctx.get_user()
 
     if not user:
         await callback.message.edit_text(
@@ -3165,6 +3215,29 @@ async def cmd_subscribe(message: Message, state: FSMContext):
     )
     await state.set_state(UserRegistration.waiting_for_subscription)
 
+@router.message(Command("timezone"))
+async def cmd_timezone(message: Message):
+    """Обработчик команды /timezone: часовой пояс для подсчета стриков"""
+    user_id = message.from_user.id
+    if not await db.get_user(user_id):
+        await message.answer("❌ Пользователь не найден. Используйте /start для начала регистрации.")
+        return
+
+    parts = message.text.split(maxsplit=1)
+    if len(parts) < 2:
+        await message.answer(
+            "🕐 Стрик считается по календарным дням в вашем часовом поясе.\n\n"
+            "Укажите его в формате IANA, например: <code>/timezone Asia/Yekaterinburg</code>\n"
+            f"Сбросить на часовой пояс по умолчанию ({STREAK_TIMEZONE}): <code>/timezone reset</code>"
+        )
+        return
+
+    timezone = None if parts[1].strip().lower() == 'reset' else parts[1].strip()
+    if not await db.set_user_timezone(user_id, timezone):
+        await message.answer(f"❌ Неизвестный часовой пояс: {html.escape(timezone)}")
+        return
+    await message.answer(f"✅ Часовой пояс для стриков: {timezone or STREAK_TIMEZONE}")
+
 @router.message(Command("help"))
 async def cmd_help(message: Message):
     """Обработчик команды помощи"""
@@ -3175,6 +3248,7 @@ async def cmd_help(message: Message):
         "/start - Начать регистрацию или проверить статус\n"
         "/subscribe - Оформить или продлить подписку\n"
         "/cancel - Отменить текущую регистрацию\n"
+        "/timezone - Часовой пояс для подсчета стриков\n"
         "/help - Показать эту справку\n\n"
         "📝 <b>Что собирает бот для персонализации:</b>\n"
         "• Предпочитаемый язык\n"
@@ -3218,149 +3292,134 @@ async def handle_unknown(message: Message, state: FSMContext):
             "Неизвестная команда. Используйте /start для начала регистрации или /help для справки."
         )
 
+@scheduler.job(interval=PAYMENT_POLL_INTERVAL, jitter=5, timeout=600)
 async def payment_polling_task():
     """Фоновая задача для периодической проверки неоплаченных платежей"""
-    # Получаем bot_id один раз при старте задачи
-    bot_info = await bot.get_me()
+    # Данные бота кэшируются aiogram после первого запроса
+    bot_info = await bot.me()
     bot_id = bot_info.id
     
-    while True:
-        try:
-            # Получаем все неоплаченные платежи из БД
-            pending_payments = await db.get_pending_payments()
-
-            for payment in pending_payments:
-                # Проверяем статус оплаты через WATA API
-                is_paid = await wata_check_payment(payment.user_id, payment.created_at)
-
-                if is_paid:
-                    # Обновляем статус платежа в БД
-                    current_time = int(datetime.datetime.now().timestamp())
-                    await db.update_payment_status(payment.id, "paid", current_time)
-
-                    # Создаем подписку
-                    # Получаем текущего пользователя для проверки активной подписки
-                    user = await db.get_user(payment.user_id)
-
-                    # Создаем подписку с учетом активной подписки (суммируем время)
-                    subscription_start = current_time
-
-                    # Базовое время новой подписки
-                    new_subscription_duration = payment.months * 30 * 24 * 60 * 60  # Примерно в секундах
-
-                    # Если есть активная подписка, добавляем оставшееся время
-                    if user and user.subscription_active and user.subscription_end and user.subscription_end > current_time:
-                        remaining_time = user.subscription_end - current_time
-                        subscription_end = subscription_start + new_subscription_duration + remaining_time
-                        logger.info(f"Суммируем подписку: {remaining_time} сек осталось + {new_subscription_duration} сек новой = {subscription_end - subscription_start} сек")
-                    else:
-                        subscription_end = subscription_start + new_subscription_duration
-
-                    # Используем уровень подписки из платежа
-                    subscription_level = payment.subscription_level if payment.subscription_level else 1
-                    
-                    subscription = Subscription(
-                        user_id=payment.user_id,
-                        payment_id=payment.id,
-                        start_date=subscription_start,
-                        end_date=subscription_end,
-                        months=payment.months,
-                        subscription_level=subscription_level,
-                        status=SubscriptionStatus.ACTIVE,
-                        auto_renew=False,
-                        created_at=current_time,
-                        updated_at=current_time
-                    )
+    # Обходим неоплаченные платежи пачками, не загружая все в память
+    async for payment in db.iter_pending_payments():
+        # Проверяем статус оплаты через WATA API
+        is_paid = await wata_check_payment(payment.user_id, payment.created_at)
 
-                    subscription_id = await db.save_subscription(subscription)
+        if is_paid:
+            # Обновляем статус платежа в БД
+            current_time = int(datetime.datetime.now().timestamp())
+            await db.update_payment_status(payment.id, "paid", current_time)
 
-                    # Активируем подписку пользователя
-                    await db.activate_user_subscription(payment.user_id, subscription_start, subscription_end)
+            # Создаем подписку
+            # Получаем текущего пользователя для проверки активной подписки
+            user = await db.get_user(payment.user_id)
 
-                    # Проверяем, есть ли у пользователя карточка игрока
-                    player_stats = await db.get_player_stats(payment.user_id)
-                    
-                    # Уведомляем пользователя об успешной оплате
-                    try:
-                        if not player_stats:
-                            # Если карточки нет, устанавливаем состояние ожидания фото и отправляем сообщение
-                            from aiogram.fsm.storage.base import StorageKey
-                            storage_key = StorageKey(
-                                chat_id=payment.user_id,
-                                user_id=payment.user_id,
-                                bot_id=bot_id
-                            )
-                            await dp.storage.set_state(storage_key, UserRegistration.waiting_for_player_photo)
-                            
-                            await bot.send_message(
-                                payment.user_id,
-                                f"✅ Оплата получена!\n\n"
-                                f"🎉 Подписка на {payment.months} месяцев активирована!\n\n"
-                                f"📅 Дата окончания: {datetime.datetime.fromtimestamp(subscription_end).strftime('%d.%m.%Y')}\n\n"
-                                f"🎮 <b>Обязательный этап: Создание карточки игрока</b>\n\n"
-                                f"📸 Пожалуйста, загрузите ваше фото для создания игровой карточки.\n"
-                                f"ИИ проанализирует ваше фото и определит стартовые характеристики:\n"
-                                f"• 💪 Сила\n"
-                                f"• 🤸 Ловкость\n"
-                                f"• 🏃 Выносливость\n"
-                                f"• 🧠 Интеллект (базовый: 50/100)\n"
-                                f"• ✨ Харизма (базовый: 50/100)\n\n"
-                                f"После анализа будет создана ваша уникальная игровая карточка!",
-                                parse_mode="HTML"
-                            )
-                            logger.info(f"Пользователь {payment.user_id} переведен в состояние ожидания фото после успешной оплаты")
-                        else:
-                            # Если карточка уже есть, просто отправляем уведомление
-                            await bot.send_message(
-                                payment.user_id,
-                                f"✅ Оплата получена!\n\n"
-                                f"🎉 Подписка на {payment.months} месяцев активирована!\n\n"
-                                f"📅 Дата окончания: {datetime.datetime.fromtimestamp(subscription_end).strftime('%d.%m.%Y')}\n\n"
-                                f"🚀 Теперь вы можете пользоваться всеми функциями бота!"
-                            )
-                    except Exception as e:
-                        logger.error(f"Не удалось отправить уведомление пользователю {payment.user_id}: {e}")
-
-                    logger.info(f"Платеж {payment.id} для пользователя {payment.user_id} подтвержден, подписка {subscription_id} создана")
-
-            # Проверяем каждые 30 секунд
-            await asyncio.sleep(30)
+            # Создаем подписку с учетом активной подписки (суммируем время)
+            subscription_start = current_time
 
-        except Exception as e:
-            logger.error(f"[payment_polling_task] Error: {e}")
-            await asyncio.sleep(60)
+            # Базовое время новой подписки
+            new_subscription_duration = payment.months * 30 * 24 * 60 * 60  # Примерно в секундах
 
-async def notification_sender_task():
-    """Фоновая задача отправки уведомлений пользователям"""
-    logger.info("Запущена задача отправки уведомлений")
+            # Если есть активная подписка, добавляем оставшееся время
+            if user and user.subscription_active and user.subscription_end and user.subscription_end > current_time:
+                remaining_time = user.subscription_end - current_time
+                subscription_end = subscription_start + new_subscription_duration + remaining_time
+                logger.info(f"Суммируем подписку: {remaining_time} сек осталось + {new_subscription_duration} сек новой = {subscription_end - subscription_start} сек")
+            else:
+                subscription_end = subscription_start + new_subscription_duration
 
-    while True:
-        try:
-            # Получаем неотправленные уведомления
-            notifications = await db.get_unsent_notifications(limit=10)
+            # Используем уровень подписки из платежа
+            subscription_level = payment.subscription_level if payment.subscription_level else 1
+
+            subscription = Subscription(
+                user_id=payment.user_id,
+                payment_id=payment.id,
+                start_date=subscription_start,
+                end_date=subscription_end,
+                months=payment.months,
+                subscription_level=subscription_level,
+                status=SubscriptionStatus.ACTIVE,
+                auto_renew=False,
+                created_at=current_time,
+                updated_at=current_time
+            )
+
+            subscription_id = await db.save_subscription(subscription)
+
+            # Активируем подписку пользователя
+            await db.activate_user_subscription(payment.user_id, subscription_start, subscription_end)
+
+            # Проверяем, есть ли у пользователя карточка игрока
+            player_stats = await db.get_player_stats(payment.user_id)
+
+            # Уведомляем пользователя об успешной оплате
+            try:
+                if not player_stats:
+                    # Если карточки нет, устанавливаем состояние ожидания фото и отправляем сообщение
+                    await set_user_state(payment.user_id, UserRegistration.waiting_for_player_photo, bot_id)
 
-            for notification in notifications:
-                try:
-                    # Отправляем уведомление пользователю
                     await bot.send_message(
-                        chat_id=notification['user_id'],
-                        text=f"{notification['title']}\n\n{notification['message']}",
+                        payment.user_id,
+                        f"✅ Оплата получена!\n\n"
+                        f"🎉 Подписка на {payment.months} месяцев активирована!\n\n"
+                        f"📅 Дата окончания: {datetime.datetime.fromtimestamp(subscription_end).strftime('%d.%m.%Y')}\n\n"
+                        f"🎮 <b>Обязательный этап: Создание карточки игрока</b>\n\n"
+                        f"📸 Пожалуйста, загрузите ваше фото для создания игровой карточки.\n"
+                        f"ИИ проанализирует ваше фото и определит стартовые характеристики:\n"
+                        f"• 💪 Сила\n"
+                        f"• 🤸 Ловкость\n"
+                        f"• 🏃 Выносливость\n"
+                        f"• 🧠 Интеллект (базовый: 50/100)\n"
+                        f"• ✨ Харизма (базовый: 50/100)\n\n"
+                        f"После анализа будет создана ваша уникальная игровая карточка!",
                         parse_mode="HTML"
                     )
+                    logger.info(f"Пользователь {payment.user_id} переведен в состояние ожидания фото после успешной оплаты")
+                else:
+                    # Если карточка уже есть, просто отправляем уведомление
+                    await bot.send_message(
+                        payment.user_id,
+                        f"✅ Оплата получена!\n\n"
+                        f"🎉 Подписка на {payment.months} месяцев активирована!\n\n"
+                        f"📅 Дата окончания: {datetime.datetime.fromtimestamp(subscription_end).strftime('%d.%m.%Y')}\n\n"
+                        f"🚀 Теперь вы можете пользоваться всеми функциями бота!"
+                    )
+            except Exception as e:
+                logger.error(f"Не удалось отправить уведомление пользователю {payment.user_id}: {e}")
 
-                    # Отмечаем уведомление как отправленное
-                    await db.mark_notification_sent(notification['id'])
-                    logger.info(f"Уведомление {notification['id']} отправлено пользователю {notification['user_id']}")
+            logger.info(f"Платеж {payment.id} для пользователя {payment.user_id} подтвержден, подписка {subscription_id} создана")
 
-                except Exception as e:
-                    logger.error(f"Не удалось отправить уведомление {notification['id']} пользователю {notification['user_id']}: {e}")
+@scheduler.job(interval=NOTIFICATION_SEND_INTERVAL, jitter=5, timeout=300)
+async def notification_sender_task():
+    """Фоновая задача отправки уведомлений пользователям (не быстрее NOTIFICATION_RATE_LIMIT в секунду)"""
+    # Получаем неотправленные уведомления
+    notifications = await db.get_unsent_notifications(limit=NOTIFICATION_BATCH_SIZE)
 
-            # Проверяем каждые 30 секунд
-            await asyncio.sleep(30)
+    for notification in notifications:
+        try:
+            # Отправляем уведомление пользователю
+            await bot.send_message(
+                chat_id=notification['user_id'],
+                text=f"{notification['title']}\n\n{notification['message']}",
+                parse_mode="HTML"
+            )
 
+            # Отмечаем уведомление как отправленное
+            await db.mark_notification_sent(notification['id'])
+            logger.info(f"Уведомление {notification['id']} отправлено пользователю {notification['user_id']}")
+
+        except TelegramRetryAfter as e:
+            # Telegram просит подождать - остальные уведомления отправим при следующем запуске
+            logger.warning(f"Превышен лимит отправки сообщений, пауза {e.retry_after} с")
+            await asyncio.sleep(e.retry_after)
+            break
+        except TelegramForbiddenError:
+            # Пользователь заблокировал бота - уведомление снимается с очереди, чтобы не мешать остальным
+            await db.mark_notification_sent(notification['id'])
+            logger.info(f"Пользователь {notification['user_id']} заблокировал бота, уведомление {notification['id']} пропущено")
         except Exception as e:
-            logger.error(f"[notification_sender_task] Error: {e}")
-            await asyncio.sleep(60)  # При ошибке ждем минуту
+            logger.error(f"Не удалось отправить уведомление {notification['id']} пользователю {notification['user_id']}: {e}")
+
+        await asyncio.sleep(1 / NOTIFICATION_RATE_LIMIT)
 
 def get_subscription_level_by_months(months: int) -> int:
     """Определение уровня подписки по количеству месяцев"""
@@ -3376,121 +3435,82 @@ def get_subscription_level_by_months(months: int) -> int:
     else:
         return 1  # Стартовый
 
+@scheduler.job(interval=EXPERIENCE_RESET_INTERVAL, jitter=300, timeout=3600)
 async def experience_reset_task():
     """Фоновая задача для сброса опыта неактивным пользователям"""
-    logger.info("Запущена задача сброса опыта неактивным пользователям")
-    
-    while True:
-        try:
-            # Получаем всех пользователей с активной подпиской
-            subscribed_users = await db.get_all_active_subscribed_users()
-            current_time = int(datetime.datetime.now().timestamp())
-            
-            reset_count = 0
-            
-            for user_data in subscribed_users:
-                user_id = user_data['user_id']
-                subscription_level = user_data['subscription_level']
-                last_task_date = user_data['last_task_date']
-                
-                # Получаем разрешенное количество дней неактивности
-                allowed_inactivity_days = INACTIVITY_DAYS_BY_LEVEL.get(subscription_level, 2)
-                
-                # Если у пользователя нет last_task_date, пропускаем (новый пользователь)
-                if not last_task_date:
-                    continue
-                
-                # Вычисляем количество дней с последнего задания
-                days_since_last_task = (current_time - last_task_date) / (24 * 60 * 60)
-                
-                # Если прошло больше дней, чем разрешено - сбрасываем опыт
-                if days_since_last_task > allowed_inactivity_days:
-                    # Получаем текущую статистику пользователя
-                    user_stats = await db.get_user_stats(user_id)
-                    if user_stats and user_stats.experience > 0:
-                        # Сбрасываем опыт
-                        await db.reset_user_experience(user_id)
-                        reset_count += 1
-                        
-                        # Отправляем уведомление пользователю
-                        try:
-                            level_name = SUBSCRIPTION_LEVELS[subscription_level - 1]['name']
-                            await bot.send_message(
-                                chat_id=user_id,
-                                text=f"⚠️ <b>Опыт сброшен</b>\n\n"
-                                     f"Вы не выполняли задания более {allowed_inactivity_days} дней.\n"
-                                     f"Согласно правилам уровня подписки '{level_name}', ваш опыт был сброшен до 0.\n\n"
-                                     f"Начните выполнять задания снова, чтобы заработать новый опыт!",
-                                parse_mode="HTML"
-                            )
-                            logger.info(f"Опыт пользователя {user_id} сброшен. Дней неактивности: {days_since_last_task:.1f}, разрешено: {allowed_inactivity_days}")
-                        except Exception as e:
-                            logger.error(f"Не удалось отправить уведомление пользователю {user_id} о сбросе опыта: {e}")
-            
-            if reset_count > 0:
-                logger.info(f"Сброшен опыт {reset_count} неактивным пользователям")
-            
-            # Проверяем каждые 6 часов (21600 секунд)
-            await asyncio.sleep(21600)
-            
-        except Exception as e:
-            logger.error(f"[experience_reset_task] Error: {e}")
-            await asyncio.sleep(3600)  # При ошибке ждем час
+    current_time = int(datetime.datetime.now().timestamp())
 
-async def subscription_warning_task():
-    """Фоновая задача для предупреждения пользователей об окончании подписки"""
-    logger.info("Запущена задача предупреждений об окончании подписки")
-    
-    # Словарь для отслеживания отправленных предупреждений (user_id -> timestamp)
-    sent_warnings = {}
-    
-    while True:
-        try:
-            # Получаем подписки, которые истекают через 3 дня
-            expiring_subscriptions = await db.get_subscriptions_expiring_soon(days_before=3)
-            current_time = int(datetime.datetime.now().timestamp())
-            
-            for sub_data in expiring_subscriptions:
-                user_id = sub_data['user_id']
-                end_date = sub_data['end_date']
-                
-                # Вычисляем количество дней до окончания
-                days_until_expiry = (end_date - current_time) / (24 * 60 * 60)
-                
-                # Отправляем предупреждение только если до окончания 2.5-3.5 дня (чтобы не дублировать)
-                if 2.5 <= days_until_expiry <= 3.5:
-                    # Проверяем, не отправляли ли мы уже предупреждение этому пользователю
-                    last_warning_time = sent_warnings.get(user_id, 0)
-                    # Отправляем предупреждение не чаще раза в день
-                    if current_time - last_warning_time > 24 * 60 * 60:
-                        try:
-                            end_date_str = datetime.datetime.fromtimestamp(end_date).strftime('%d.%m.%Y')
-                            await bot.send_message(
-                                chat_id=user_id,
-                                text=f"⚠️ <b>Важная информация о подписке</b>\n\n"
-                                     f"Ваша подписка истекает через 3 дня ({end_date_str}).\n\n"
-                                     f"Чтобы продолжить пользоваться всеми функциями бота, необходимо продлить подписку.\n\n"
-                                     f"💎 Используйте команду /subscribe для продления подписки.",
-                                parse_mode="HTML"
-                            )
-                            sent_warnings[user_id] = current_time
-                            logger.info(f"Отправлено предупреждение об окончании подписки пользователю {user_id}")
-                        except Exception as e:
-                            logger.error(f"Не удалось отправить предупреждение пользователю {user_id}: {e}")
-            
-            # Проверяем каждые 6 часов
-            await asyncio.sleep(21600)
-            
-        except Exception as e:
-            logger.error(f"[subscription_warning_task] Error: {e}")
-            await asyncio.sleep(3600)  # При ошибке ждем час
+    reset_count = 0
+
+    # Обходим пользователей с активной подпиской пачками, не загружая всех в память
+    async for user_data in db.iter_active_subscribers():
+        user_id = user_data['user_id']
+        subscription_level = user_data['subscription_level']
+        last_task_date = user_data['last_task_date']
+
+        # Получаем разрешенное количество дней неактивности
+        allowed_inactivity_days = INACTIVITY_DAYS_BY_LEVEL.get(subscription_level, 2)
+
+        # Если у пользователя нет last_task_date, пропускаем (новый пользователь)
+        if not last_task_date:
+            continue
+
+        # Вычисляем количество дней с последнего задания
+        days_since_last_task = (current_time - last_task_date) / (24 * 60 * 60)
+
+        # Если прошло больше дней, чем разрешено - сбрасываем опыт
+        if days_since_last_task > allowed_inactivity_days:
+            # Получаем текущую статистику пользователя
+            user_stats = await db.get_user_stats(user_id)
+            if user_stats and user_stats.experience > 0:
+                # Сбрасываем опыт
+                await db.reset_user_experience(user_id)
+                reset_count += 1
+
+                # Отправляем уведомление пользователю
+                try:
+                    level_name = SUBSCRIPTION_LEVELS[subscription_level - 1]['name']
+                    await bot.send_message(
+                        chat_id=user_id,
+                        text=f"⚠️ <b>Опыт сброшен</b>\n\n"
+                             f"Вы не выполняли задания более {allowed_inactivity_days} дней.\n"
+                             f"Согласно правилам уровня подписки '{level_name}', ваш опыт был сброшен до 0.\n\n"
+                             f"Начните выполнять задания снова, чтобы заработать новый опыт!",
+                        parse_mode="HTML"
+                    )
+                    logger.info(f"Опыт пользователя {user_id} сброшен. Дней неактивности: {days_since_last_task:.1f}, разрешено: {allowed_inactivity_days}")
+                except Exception as e:
+                    logger.error(f"Не удалось отправить уведомление пользователю {user_id} о сбросе опыта: {e}")
 
-async def check_user_subscription(user_id: int) -> tuple[bool, Optional[str]]:
+    if reset_count > 0:
+        logger.info(f"Сброшен опыт {reset_count} неактивным пользователям")
+
+@scheduler.job(interval=SUBSCRIPTION_WARNING_INTERVAL, jitter=60, timeout=600)
+async def subscription_warning_task():
+    """Фоновая задача: предупреждения об окончании подписки и завершение истекших подписок"""
+    # Предупреждения и уведомления об окончании отправляет notification_sender_task
+    await db.queue_subscription_warnings(days_before=3)
+    await db.expire_subscriptions()
+
+@scheduler.job(interval=DAILY_TASK_EXPIRY_INTERVAL, jitter=30, timeout=600)
+async def daily_task_expiry_task():
+    """Фоновая задача: перевод истекших заданий в статус expired и удаление их медиафайлов"""
+    await db.expire_daily_tasks(submission_ttl=DAILY_TASK_SUBMISSION_TTL_HOURS * 60 * 60)
+    await db.delete_expired_task_media()
+
+@scheduler.job(cron=ARCHIVE_CRON, jitter=300, timeout=3 * 3600)
+async def archive_task():
+    """Фоновая задача: секции PostgreSQL на будущие месяцы, перенос старых данных в архив, обслуживание базы"""
+    await db.maintain_partitions()
+    await db.archive_old_records(batch_size=ARCHIVE_BATCH_SIZE)
+
+async def check_user_subscription(user_id: int, user_ctx: Optional[UserContext] = None) -> tuple[bool, Optional[str]]:
     """
     Проверка активной подписки пользователя
     Возвращает (is_active, error_message)
+    Если передан user_ctx, пользователь берется из кэша обновления
     """
-    user = await db.get_user(user_id)
+    user = await user_ctx.get_user() if user_ctx else await db.get_user(user_id)
     if not user:
         return False, "❌ Пользователь не найден в системе."
     
@@ -3506,37 +3526,145 @@ async def check_user_subscription(user_id: int) -> tuple[bool, Optional[str]]:
     
     return True, None
 
+async def set_user_state(user_id: int, state: State, bot_id: int):
+    """Установка FSM-состояния пользователя вне обработчика.
+
+    В режиме webhook состояние хранится в памяти процесса, который обрабатывает
+    обновления пользователя, поэтому команда отправляется в очередь этого процесса.
+    """
+    if webhook_queues:
+        from webhook_server import get_worker_index
+        owner = get_worker_index(user_id, len(webhook_queues))
+        if owner != webhook_worker_index:
+            webhook_queues[owner].put(("set_state", user_id, state.state))
+            return
+
+    storage_key = StorageKey(bot_id=bot_id, chat_id=user_id, user_id=user_id)
+    await dp.storage.set_state(storage_key, state)
+
 async def on_startup():
     """Функция, выполняемая при запуске бота"""
     # База данных уже инициализирована в main()
-    # Запускаем фоновую задачу проверки платежей
-    asyncio.create_task(payment_polling_task())
-    # Запускаем фоновую задачу отправки уведомлений
-    asyncio.create_task(notification_sender_task())
-    # Запускаем фоновую задачу сброса опыта неактивным пользователям
-    asyncio.create_task(experience_reset_task())
-    # Запускаем фоновую задачу предупреждений об окончании подписки
-    asyncio.create_task(subscription_warning_task())
+    # Планировщик фоновых задач (проверка платежей, уведомления, сброс опыта, предупреждения)
+    # запускается, когда этот экземпляр становится ведущим
+    await leader_election.start()
     logger.info("Бот запущен и готов к работе")
-    logger.info("Зарегистрированные handlers: check_payment_callback, notification_sender_task, experience_reset_task, subscription_warning_task")
+    logger.info(f"Фоновые задачи: {', '.join(scheduler.jobs)}")
 
 async def on_shutdown():
     """Функция, выполняемая при остановке бота"""
+    await leader_election.stop()
+    if metrics_reporter is not None:
+        await metrics_reporter.stop()
+    await db.close()
     logger.info("Бот остановлен")
 
+async def start_metrics_reporter(role: str, port: int):
+    """Запуск эндпоинта метрик БД процесса и их периодического сохранения в БД"""
+    global metrics_reporter
+    metrics_reporter = MetricsReporter(db, role, port, WEBAPP_HOST, METRICS_SNAPSHOT_INTERVAL)
+    await metrics_reporter.start()
+
+def setup_dispatcher():
+    """Регистрация роутера, middleware и обработчиков запуска/остановки"""
+    # Данные пользователя загружаются один раз на обновление
+    dp.update.outer_middleware(UserContextMiddleware(db))
+    dp.include_router(router)
+    dp.startup.register(on_startup)
+    dp.shutdown.register(on_shutdown)
+
+def run_webhook_worker(worker_index: int, queues: list):
+    """Точка входа процесса-обработчика обновлений в режиме webhook"""
+    asyncio.run(webhook_worker_main(worker_index, queues))
+
+async def webhook_worker_main(worker_index: int, queues: list):
+    """Обработка обновлений из очереди процесса"""
+    global webhook_queues, webhook_worker_index
+    from webhook_server import process_worker_queue
+
+    webhook_queues = queues
+    webhook_worker_index = worker_index
+    setup_dispatcher()
+    await start_metrics_reporter(f"bot-worker-{worker_index}", METRICS_PORT + worker_index if METRICS_PORT else 0)
+
+    # Фоновые задачи запускаются только в одном процессе
+    if worker_index == 0:
+        await dp.emit_startup(bot=bot)
+    logger.info(f"Процесс-обработчик {worker_index} запущен")
+
+    try:
+        await process_worker_queue(dp, bot, queues[worker_index])
+    finally:
+        if worker_index == 0:
+            await dp.emit_shutdown(bot=bot)
+        else:
+            await metrics_reporter.stop()
+        await bot.session.close()
+        logger.info(f"Процесс-обработчик {worker_index} остановлен")
+
+async def run_webhook():
+    """Запуск бота в режиме webhook с несколькими процессами-обработчиками"""
+    import multiprocessing
+    from aiohttp import web
+    from webhook_server import create_webhook_app
+
+    # spawn - чтобы в дочерних процессах были свои Bot, Dispatcher и соединения
+    ctx = multiprocessing.get_context("spawn")
+    queues = [ctx.Queue() for _ in range(WEBHOOK_WORKERS)]
+    workers = [
+        ctx.Process(target=run_webhook_worker, args=(index, queues), name=f"webhook-worker-{index}")
+        for index in range(WEBHOOK_WORKERS)
+    ]
+    for worker in workers:
+        worker.start()
+    logger.info(f"Запущено процессов-обработчиков: {WEBHOOK_WORKERS}")
+
+    app = create_webhook_app(queues, WEBHOOK_PATH, WEBHOOK_SECRET)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, WEBAPP_HOST, WEBAPP_PORT)
+    await site.start()
+    logger.info(f"Webhook-сервер слушает {WEBAPP_HOST}:{WEBAPP_PORT}{WEBHOOK_PATH}")
+
+    if WEBHOOK_BASE_URL:
+        setup_dispatcher()
+        await bot.set_webhook(
+            url=f"{WEBHOOK_BASE_URL.rstrip('/')}{WEBHOOK_PATH}",
+            secret_token=WEBHOOK_SECRET or None,
+            allowed_updates=dp.resolve_used_update_types(),
+        )
+        logger.info("Webhook зарегистрирован в Telegram")
+    else:
+        logger.warning("WEBHOOK_BASE_URL не задан, webhook в Telegram не регистрируется")
+
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await runner.cleanup()
+        # Останавливаем процессы-обработчики после обработки принятых обновлений
+        for queue in queues:
+            queue.put(None)
+        loop = asyncio.get_running_loop()
+        for worker in workers:
+            await loop.run_in_executor(None, worker.join, 30)
+            if worker.is_alive():
+                worker.terminate()
+        await bot.session.close()
+
 async def main():
     """Главная функция"""
     # Инициализируем базу данных перед запуском бота
     logger.info("Инициализация базы данных...")
     await db.init_db()
     logger.info("База данных инициализирована")
-    
-    # Регистрируем роутер
-    dp.include_router(router)
 
-    # Регистрируем обработчики запуска и остановки
-    dp.startup.register(on_startup)
-    dp.shutdown.register(on_shutdown)
+    if USE_WEBHOOK:
+        await run_webhook()
+        return
+
+    # Регистрируем роутер и обработчики запуска и остановки
+    setup_dispatcher()
+    await start_metrics_reporter("bot", METRICS_PORT)
 
     # Запускаем бота
     await dp.start_polling(bot)
@@ -14,3 +14,53 @@ WATA_TOKEN = os.getenv("WATA_TOKEN")
 # Настройки базы данных
 USE_POSTGRES = os.getenv("USE_POSTGRES", "false").lower() == "true"
 DATABASE_PATH = os.getenv("DATABASE_PATH", "bot_database.db")
+# Размер пачки при потоковом обходе больших выборок (платежи, подписчики, пользователи)
+DB_ITER_BATCH_SIZE = int(os.getenv("DB_ITER_BATCH_SIZE", "500"))
+# Кэш подготовленных выражений на соединение и размер пула PostgreSQL для слоя запросов
+DB_STATEMENT_CACHE_SIZE = int(os.getenv("DB_STATEMENT_CACHE_SIZE", "100"))
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "10"))
+# Реплика PostgreSQL для рейтингов и аналитики (DSN, пусто - чтение только с основного сервера);
+# после записи пользователя его чтения DB_READ_YOUR_WRITES_SECONDS секунд идут на основной сервер
+DB_REPLICA_DSN = os.getenv("DB_REPLICA_DSN", "")
+DB_READ_YOUR_WRITES_SECONDS = float(os.getenv("DB_READ_YOUR_WRITES_SECONDS", "10"))
+
+# Интервалы фоновых задач (секунды)
+PAYMENT_POLL_INTERVAL = int(os.getenv("PAYMENT_POLL_INTERVAL", "30"))
+NOTIFICATION_SEND_INTERVAL = int(os.getenv("NOTIFICATION_SEND_INTERVAL", "30"))
+EXPERIENCE_RESET_INTERVAL = int(os.getenv("EXPERIENCE_RESET_INTERVAL", "21600"))
+SUBSCRIPTION_WARNING_INTERVAL = int(os.getenv("SUBSCRIPTION_WARNING_INTERVAL", "3600"))
+# Перевод истекших ежедневных заданий в статус expired и удаление их медиафайлов;
+# задание на проверке истекает, если его не проверили за DAILY_TASK_SUBMISSION_TTL_HOURS после срока
+DAILY_TASK_EXPIRY_INTERVAL = int(os.getenv("DAILY_TASK_EXPIRY_INTERVAL", "600"))
+DAILY_TASK_SUBMISSION_TTL_HOURS = int(os.getenv("DAILY_TASK_SUBMISSION_TTL_HOURS", "168"))
+# Отправка уведомлений из очереди: сколько за один запуск и не больше скольких сообщений в секунду
+NOTIFICATION_BATCH_SIZE = int(os.getenv("NOTIFICATION_BATCH_SIZE", "100"))
+NOTIFICATION_RATE_LIMIT = float(os.getenv("NOTIFICATION_RATE_LIMIT", "20"))
+# Перенос завершенных заданий и отправленных уведомлений старше RETENTION_DAYS дней в архив
+# (расписание в формате cron, по умолчанию ночью) пачками по ARCHIVE_BATCH_SIZE строк
+RETENTION_DAYS = int(os.getenv("RETENTION_DAYS", "90"))
+ARCHIVE_CRON = os.getenv("ARCHIVE_CRON", "30 4 * * *")
+ARCHIVE_BATCH_SIZE = int(os.getenv("ARCHIVE_BATCH_SIZE", "500"))
+# Выбор ведущего процесса: как часто остальные экземпляры пытаются захватить блокировку (секунды)
+# и файл блокировки для SQLite (по умолчанию <DATABASE_PATH>.leader.lock)
+LEADER_RETRY_INTERVAL = int(os.getenv("LEADER_RETRY_INTERVAL", "10"))
+LEADER_LOCK_FILE = os.getenv("LEADER_LOCK_FILE", "")
+# Метрики обращений к БД: порт HTTP-эндпоинта /metrics (0 - не запускать; в режиме webhook
+# процесс-обработчик N слушает METRICS_PORT + N) и период сохранения метрик в БД (секунды)
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))
+METRICS_SNAPSHOT_INTERVAL = int(os.getenv("METRICS_SNAPSHOT_INTERVAL", "60"))
+
+# Настройки режима webhook (по умолчанию используется long polling)
+USE_WEBHOOK = os.getenv("USE_WEBHOOK", "false").lower() == "true"
+WEBHOOK_BASE_URL = os.getenv("WEBHOOK_BASE_URL", "")  # внешний адрес, например https://bot.example.com
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/webhook")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "")
+WEBAPP_HOST = os.getenv("WEBAPP_HOST", "0.0.0.0")
+WEBAPP_PORT = int(os.getenv("WEBAPP_PORT", "8080"))
+# Количество процессов-обработчиков обновлений (обновления распределяются по хешу user_id)
+WEBHOOK_WORKERS = max(1, int(os.getenv("WEBHOOK_WORKERS", str(os.cpu_count() or 1))))
+
+# Адрес Bot API сервера (локальный telegram-bot-api или тестовый fake-сервер)
+TELEGRAM_API_URL = os.getenv("TELEGRAM_API_URL", "")
+# Сервер запущен в режиме --local на той же машине: файлы скачиваются с диска по file_path
+TELEGRAM_API_LOCAL = os.getenv("TELEGRAM_API_LOCAL", "false").lower() == "true"
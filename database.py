@@ -1,16 +1,281 @@
 import aiosqlite
 import asyncpg
+import asyncio
 import datetime
+import json
 import logging
 import os
+import time
 from datetime import date
-from typing import Optional
-from models import User, Payment, PaymentStatus, Subscription, SubscriptionStatus, PlayerStats, Rank, DailyTask, UserStats, TaskStatus, Prize, PrizeType
+from typing import Any, AsyncIterator, Optional
+from models import User, Payment, Subscription, PlayerStats, DailyTask, UserStats, Prize, PrizeType
 from rank_config import get_rank_by_experience
-from postgres_config import get_postgres_connection_params, validate_postgres_config
+from row_decoders import decode_row, decode_rows, decode_stream
+from query_layer import Query, QueryExecutor, init_postgres_connection, sqlite_connect
+from db_metrics import instrument_methods, note_connection_wait
+from sqlite_config import SQLITE_PERFORMANCE_PROFILE
+from streaks import StreakState, effective_streak, is_valid_timezone, local_day
+from prize_engine import PrizeThresholdIndex, is_prize_available_for_user, rank_to_value, render_prize_award_message
+from postgres_config import (
+    get_postgres_connection_params, validate_postgres_config, POSTGRES_PARTITIONING, POSTGRES_PARTITION_PREMAKE_MONTHS
+)
+from pg_partitions import PARTITIONED_TABLES, drop_expired_partitions, ensure_partitions, migrate_to_partitioned
 
 logger = logging.getLogger(__name__)
 
+# Начальное значение ключа для keyset-пагинации (меньше любого целочисленного ID)
+_KEYSET_START = -(2 ** 63)
+
+# Насколько старым может быть действующее задание (выдается на сутки).
+# Условие по created_at позволяет PostgreSQL читать только последние секции таблицы
+_ACTIVE_TASK_MAX_AGE = 2 * 24 * 60 * 60
+
+# Часто выполняемые запросы, общие для SQLite и PostgreSQL (см. query_layer)
+_Q_USER = Query("SELECT * FROM users WHERE telegram_id = ?")
+_Q_USER_STATS = Query('''
+    SELECT us.*, u.timezone
+    FROM user_stats us LEFT JOIN users u ON u.telegram_id = us.user_id
+    WHERE us.user_id = ?
+''')
+_Q_PLAYER_STATS = Query("SELECT * FROM player_stats WHERE user_id = ?")
+_Q_ACTIVE_SUBSCRIPTION = Query('''
+    SELECT * FROM subscriptions
+    WHERE user_id = ? AND status = 'active' AND end_date > ?
+    ORDER BY end_date DESC
+    LIMIT 1
+''')
+_Q_SUBMIT_TASK_MEDIA = Query('''
+    UPDATE daily_tasks
+    SET status = 'submitted', submitted_media_path = ?
+    WHERE id = ? AND status = 'pending'
+''')
+_Q_TOP_BY_CITY = Query('''
+    SELECT u.name, us.level, us.experience, us.rank
+    FROM users u
+    JOIN user_stats us ON u.telegram_id = us.user_id
+    WHERE u.city = ? AND u.subscription_active = TRUE
+    ORDER BY us.level DESC, us.experience DESC
+    LIMIT ?
+''')
+_Q_TOP_BY_RANK = Query('''
+    SELECT u.name, us.level, us.experience, u.city
+    FROM users u
+    JOIN user_stats us ON u.telegram_id = us.user_id
+    WHERE us.rank = ? AND u.subscription_active = TRUE
+    ORDER BY us.level DESC, us.experience DESC
+    LIMIT ?
+''')
+_Q_TOP_BY_REFERRAL_CODE = Query('''
+    SELECT u.name, us.level, us.experience, us.referral_rank, u.city
+    FROM users u
+    JOIN user_stats us ON u.telegram_id = us.user_id
+    WHERE u.referral_code = ? AND u.subscription_active = TRUE
+    ORDER BY us.level DESC, us.experience DESC
+    LIMIT ?
+''')
+# Позиция считается одним запросом; если статистики пользователя нет, строки не будет
+_Q_RATING_POSITION = Query('''
+    SELECT (
+        SELECT COUNT(*)
+        FROM user_stats us
+        JOIN users u ON us.user_id = u.telegram_id
+        WHERE u.subscription_active = TRUE
+        AND (us.level > me.level OR (us.level = me.level AND us.experience > me.experience))
+    ) + 1
+    FROM user_stats me
+    WHERE me.user_id = ?
+''')
+_Q_RESET_USER_STATS_EXPERIENCE = Query('''
+    UPDATE user_stats
+    SET experience = 0, level = 1, rank = 'F'
+    WHERE user_id = ?
+''')
+_Q_RESET_PLAYER_EXPERIENCE = Query('''
+    UPDATE player_stats
+    SET experience = 0, updated_at = ?
+    WHERE user_id = ?
+''')
+_Q_RANK_DISTRIBUTION = Query('''
+    SELECT us.rank, COUNT(*) as count
+    FROM user_stats us
+    JOIN users u ON us.user_id = u.telegram_id
+    WHERE u.subscription_active = TRUE
+    GROUP BY us.rank
+    ORDER BY count DESC
+''')
+_Q_RANK_ACHIEVEMENT_STATS = Query('''
+    SELECT us.rank, COUNT(*) as count,
+           AVG(us.experience) as avg_experience,
+           MAX(us.experience) as max_experience
+    FROM user_stats us
+    JOIN users u ON us.user_id = u.telegram_id
+    WHERE u.subscription_active = TRUE
+    GROUP BY us.rank
+    ORDER BY us.rank
+''')
+# Подписки, истекающие в окне предупреждения: отбираются и отмечаются одним запросом.
+# Предупреждается только самая поздняя действующая подписка пользователя
+_Q_CLAIM_SUBSCRIPTION_WARNINGS = Query('''
+    UPDATE subscriptions
+    SET warned_at = ?
+    WHERE status = 'active'
+    AND warned_at IS NULL
+    AND end_date > ?
+    AND end_date <= ?
+    AND NOT EXISTS (
+        SELECT 1 FROM subscriptions later
+        WHERE later.user_id = subscriptions.user_id
+        AND later.status = 'active'
+        AND later.end_date > subscriptions.end_date
+    )
+    RETURNING user_id, end_date
+''')
+# Снятие подписки у пользователей, у которых не осталось действующих подписок
+_Q_DEACTIVATE_EXPIRED_USERS = Query('''
+    UPDATE users
+    SET subscription_active = FALSE, subscription_start = NULL, subscription_end = NULL, updated_at = CURRENT_TIMESTAMP
+    WHERE subscription_active = TRUE
+    AND subscription_end <= ?
+    AND NOT EXISTS (
+        SELECT 1 FROM subscriptions s
+        WHERE s.user_id = users.telegram_id AND s.status = 'active' AND s.end_date > ?
+    )
+    RETURNING telegram_id, referral_code
+''')
+_Q_INSERT_NOTIFICATION = Query('''
+    INSERT INTO notifications (user_id, type, title, message, data, created_at)
+    VALUES (?, ?, ?, ?, ?, ?)
+''')
+# Истекшие задания пачкой по индексу expires_at: невыполненные - сразу по истечении срока,
+# отправленные на проверку - если их не проверили за отведенное время и сейчас никто не проверяет
+_Q_EXPIRE_DAILY_TASKS = Query('''
+    UPDATE daily_tasks
+    SET status = 'expired'
+    WHERE id IN (
+        SELECT id FROM daily_tasks
+        WHERE expires_at <= ?
+        AND (
+            status = 'pending'
+            OR (status = 'submitted' AND expires_at <= ? AND (claimed_until IS NULL OR claimed_until < ?))
+        )
+        LIMIT ?
+    )
+''')
+_Q_EXPIRED_TASK_MEDIA = Query('''
+    SELECT id, submitted_media_path FROM daily_tasks
+    WHERE status = 'expired' AND submitted_media_path IS NOT NULL
+    LIMIT ?
+''')
+_Q_CLEAR_TASK_MEDIA = Query('UPDATE daily_tasks SET submitted_media_path = NULL WHERE id = ?')
+_Q_RENEW_TASK_LEASE = Query('''
+    UPDATE daily_tasks
+    SET claimed_by = ?, claimed_until = ?
+    WHERE id = ? AND status = 'submitted'
+      AND (claimed_by = ? OR claimed_until IS NULL OR claimed_until < ?)
+''')
+_Q_RELEASE_TASK_LEASE = Query('''
+    UPDATE daily_tasks SET claimed_by = NULL, claimed_until = NULL
+    WHERE id = ? AND claimed_by = ?
+''')
+_Q_MARK_NOTIFICATION_SENT = Query('UPDATE notifications SET is_sent = TRUE, sent_at = ? WHERE id = ?')
+
+# Перенос в архив пачкой: копирование и удаление выполняются в одной транзакции по одинаковому
+# условию; удаляются только строки, уже попавшие в архив. Истекшие задания ждут удаления медиафайла
+_Q_ARCHIVE_DAILY_TASKS = Query('''
+    INSERT INTO daily_tasks_archive
+        (id, user_id, task_description, created_at, expires_at, status, completed_at, moderator_comment, archived_at)
+    SELECT id, user_id, task_description, created_at, expires_at, status, completed_at, moderator_comment, ?
+    FROM daily_tasks
+    WHERE id IN (
+        SELECT id FROM daily_tasks
+        WHERE status IN ('approved', 'rejected', 'expired') AND created_at < ?
+        AND NOT (status = 'expired' AND submitted_media_path IS NOT NULL)
+        ORDER BY id
+        LIMIT ?
+    )
+    ON CONFLICT (id) DO NOTHING
+''')
+_Q_DELETE_ARCHIVED_DAILY_TASKS = Query('''
+    DELETE FROM daily_tasks
+    WHERE id IN (
+        SELECT id FROM daily_tasks
+        WHERE status IN ('approved', 'rejected', 'expired') AND created_at < ?
+        AND NOT (status = 'expired' AND submitted_media_path IS NOT NULL)
+        ORDER BY id
+        LIMIT ?
+    )
+    AND EXISTS (SELECT 1 FROM daily_tasks_archive a WHERE a.id = daily_tasks.id)
+''')
+_Q_ARCHIVE_NOTIFICATIONS = Query('''
+    INSERT INTO notifications_archive (id, user_id, type, title, message, data, created_at, sent_at, archived_at)
+    SELECT id, user_id, type, title, message, data, created_at, sent_at, ?
+    FROM notifications
+    WHERE id IN (
+        SELECT id FROM notifications
+        WHERE is_sent = TRUE AND created_at < ?
+        ORDER BY id
+        LIMIT ?
+    )
+    ON CONFLICT (id) DO NOTHING
+''')
+# Неотправленные уведомления старше срока хранения помечаются просроченными: is_sent = TRUE
+# без sent_at. Так они не теряются молча, а уходят в архив вместе с отправленными
+_Q_EXPIRE_STALE_NOTIFICATIONS = Query('''
+    UPDATE notifications SET is_sent = TRUE
+    WHERE is_sent = FALSE AND created_at < ?
+''')
+_Q_DELETE_ARCHIVED_NOTIFICATIONS = Query('''
+    DELETE FROM notifications
+    WHERE id IN (
+        SELECT id FROM notifications
+        WHERE is_sent = TRUE AND created_at < ?
+        ORDER BY id
+        LIMIT ?
+    )
+    AND EXISTS (SELECT 1 FROM notifications_archive a WHERE a.id = notifications.id)
+''')
+_Q_USER_TASK_HISTORY = Query('''
+    SELECT * FROM daily_tasks_history
+    WHERE user_id = ?
+    ORDER BY created_at DESC
+    LIMIT ?
+''')
+_Q_SCHEDULER_LAST_RUNS = Query('SELECT name, last_run_at FROM scheduler_jobs')
+_Q_SCHEDULER_JOBS = Query('''
+    SELECT name, last_run_at, last_duration_ms, last_error, run_count, failure_count
+    FROM scheduler_jobs
+    ORDER BY name
+''')
+_Q_SCHEDULER_JOB_START = Query('''
+    INSERT INTO scheduler_jobs (name, last_run_at, run_count)
+    VALUES (?, ?, 1)
+    ON CONFLICT (name) DO UPDATE
+    SET last_run_at = excluded.last_run_at, run_count = scheduler_jobs.run_count + 1
+''')
+_Q_SCHEDULER_JOB_RESULT = Query('''
+    UPDATE scheduler_jobs
+    SET last_duration_ms = ?, last_error = ?, failure_count = failure_count + ?
+    WHERE name = ?
+''')
+_Q_SAVE_METRICS_SNAPSHOT = Query('''
+    INSERT INTO db_metrics (process, updated_at, data)
+    VALUES (?, ?, ?)
+    ON CONFLICT (process) DO UPDATE
+    SET updated_at = excluded.updated_at, data = excluded.data
+''')
+_Q_METRICS_SNAPSHOTS = Query('''
+    SELECT process, data FROM db_metrics
+    WHERE updated_at >= ?
+    ORDER BY process
+''')
+
+def _decode_user_stats(row) -> UserStats:
+    """Статистика пользователя из строки _Q_USER_STATS (с колонкой timezone)"""
+    stats = decode_row(UserStats, row)
+    # Серия, прерванная пропуском дня, в базе не обнуляется - учитываем это при чтении
+    stats.current_streak = effective_streak(stats.current_streak, row['last_task_date'], row['timezone'])
+    return stats
+
 async def _get_postgres_connection():
     """Вспомогательная функция для получения подключения к PostgreSQL"""
     """Использует параметры подключения напрямую (рекомендуемый способ для asyncpg)"""
@@ -23,7 +288,11 @@ async def _get_postgres_connection():
         
         logger.info(f"Попытка подключения к PostgreSQL: {POSTGRES_USER}@{POSTGRES_HOST}:{POSTGRES_PORT}/{POSTGRES_DATABASE}")
         
-        return await asyncpg.connect(**conn_params)
+        started = time.perf_counter()
+        conn = await asyncpg.connect(**conn_params)
+        note_connection_wait(time.perf_counter() - started)
+        await init_postgres_connection(conn)
+        return conn
     except ValueError as e:
         # Ошибка валидации (например, пустой пароль)
         logger.error(f"❌ Ошибка конфигурации PostgreSQL: {e}")
@@ -60,10 +329,40 @@ async def _get_postgres_connection():
         logger.error(f"  - POSTGRES_SSL_MODE: {os.getenv('POSTGRES_SSL_MODE', 'не указан')}")
         raise Exception(f"Не удалось подключиться к PostgreSQL: {e}")
 
+@instrument_methods(exclude=('close', 'save_metrics_snapshot'))
 class Database:
-    def __init__(self, db_path: str = "bot_database.db", use_postgres: bool = False):
+    def __init__(self, db_path: str = "bot_database.db", use_postgres: bool = False, replica_dsn: Optional[str] = None):
         self.db_path = db_path
         self.use_postgres = use_postgres
+        # Кэш ролей персонала (telegram_id -> роль) для модераторского бота
+        self._staff_roles: Optional[dict[int, str]] = None
+        self._staff_roles_loaded_at = 0.0
+        self._staff_roles_version = 0
+        self.role_cache_ttl = 60  # секунд, чтобы подхватывать изменения из других процессов
+        # Кэш каталога призов: (prize_type, referral_code, is_active, subscription_level) -> список призов
+        self._prize_cache: dict[tuple, list[Prize]] = {}
+        self._prize_catalog_version: Optional[int] = None
+        self._prize_version_checked_at = 0.0
+        self.prize_version_check_interval = 5  # секунд между проверками версии каталога в БД
+        # Индекс порогов призов для выдачи за достижения (перестраивается при смене версии каталога)
+        self._prize_index: Optional[PrizeThresholdIndex] = None
+        self._prize_index_version: Optional[int] = None
+        # Кэш аналитики блогеров: (экран, telegram_id блогера, limit) -> (время, реферальный код, результат)
+        self._blogger_stats_cache: dict[tuple, tuple[float, Optional[str], Any]] = {}
+        self.blogger_stats_cache_ttl = 30  # секунд
+        # Размер пачки для потокового чтения больших выборок (iter_* методы)
+        self.iter_batch_size = 500
+        # Общие для обеих БД запросы на долгоживущих соединениях с кэшем подготовленных выражений
+        self.queries = QueryExecutor(db_path, use_postgres, replica_dsn=replica_dsn)
+        # Чтение с реплики (рейтинги, аналитика): после собственной записи пользователя его
+        # запросы read_your_writes_window секунд идут на основной сервер, чтобы он видел свои изменения
+        self.read_your_writes_window = 10
+        self._recent_user_writes: dict[int, float] = {}
+        # update_user_field: поле -> запрос
+        self._user_field_queries: dict[str, Query] = {}
+        # Срок хранения заданий и уведомлений (дней) для archive_old_records; неотправленные
+        # уведомления старше срока помечаются просроченными
+        self.retention_days = 90
 
         if self.use_postgres:
             # Проверяем конфигурацию PostgreSQL только если используется PostgreSQL
@@ -76,6 +375,22 @@ class Database:
         else:
             logger.info("Используется SQLite база данных")
 
+    def _note_user_write(self, user_id: int):
+        """Отметка записи от имени пользователя (для чтения своих изменений)"""
+        now = time.monotonic()
+        if len(self._recent_user_writes) > 10000:
+            self._recent_user_writes = {
+                uid: at for uid, at in self._recent_user_writes.items() if now - at < self.read_your_writes_window
+            }
+        self._recent_user_writes[user_id] = now
+
+    def _replica_allowed(self, viewer_id: Optional[int] = None) -> bool:
+        """Можно ли читать с реплики: не сразу после записи пользователя, для которого идет чтение"""
+        if viewer_id is None:
+            return True
+        written_at = self._recent_user_writes.get(viewer_id)
+        return written_at is None or time.monotonic() - written_at >= self.read_your_writes_window
+
     async def init_db(self):
         """Инициализация базы данных и создание таблиц"""
         if self.use_postgres:
@@ -85,7 +400,11 @@ class Database:
 
     async def _init_sqlite_db(self):
         """Инициализация SQLite базы данных"""
-        async with aiosqlite.connect(self.db_path) as db:
+        async with sqlite_connect(self.db_path) as db:
+            if SQLITE_PERFORMANCE_PROFILE:
+                # WAL сохраняется в файле базы: читатели не блокируют запись и друг друга
+                await db.execute("PRAGMA journal_mode = WAL")
+
             # Создаем таблицу пользователей
             await db.execute('''
                 CREATE TABLE IF NOT EXISTS users (
@@ -239,6 +558,116 @@ class Database:
                 )
             ''')
 
+            # Создаем таблицу выданных призов
+            await db.execute('''
+                CREATE TABLE IF NOT EXISTS prize_awards (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    user_id INTEGER NOT NULL,
+                    prize_id INTEGER NOT NULL,
+                    achievement_type TEXT NOT NULL,
+                    achievement_value INTEGER NOT NULL,
+                    task_id INTEGER,
+                    awarded_at INTEGER NOT NULL,
+                    UNIQUE (user_id, prize_id),
+                    FOREIGN KEY (user_id) REFERENCES users (telegram_id),
+                    FOREIGN KEY (prize_id) REFERENCES prizes (id)
+                )
+            ''')
+
+            # Журнал действий модераторов (для статистики модерации)
+            await db.execute('''
+                CREATE TABLE IF NOT EXISTS moderation_events (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    task_id INTEGER NOT NULL,
+                    moderator_id INTEGER NOT NULL,
+                    action TEXT NOT NULL, -- 'approved' или 'rejected'
+                    experience_reward INTEGER DEFAULT 0,
+                    stat_rewards TEXT, -- JSON с начисленными характеристиками
+                    reason TEXT,
+                    created_at INTEGER NOT NULL
+                )
+            ''')
+            await db.execute('''
+                CREATE INDEX IF NOT EXISTS idx_moderation_events_moderator
+                ON moderation_events(moderator_id, created_at)
+            ''')
+
+            # Агрегированные счетчики для админ-статистики (поддерживаются триггерами)
+            await db.execute('''
+                CREATE TABLE IF NOT EXISTS stats_counters (
+                    scope TEXT NOT NULL, -- 'global', 'city', 'rank', 'referral'
+                    key TEXT NOT NULL DEFAULT '',
+                    name TEXT NOT NULL, -- 'users', 'active_users', 'completed_tasks'
+                    value INTEGER NOT NULL DEFAULT 0,
+                    PRIMARY KEY (scope, key, name)
+                )
+            ''')
+
+            # Версии редко меняющихся справочников (для инвалидации кэшей в разных процессах)
+            await db.execute('''
+                CREATE TABLE IF NOT EXISTS cache_versions (
+                    name TEXT PRIMARY KEY,
+                    version INTEGER NOT NULL DEFAULT 0
+                )
+            ''')
+
+            # Время последнего запуска и результат фоновых задач планировщика
+            await db.execute('''
+                CREATE TABLE IF NOT EXISTS scheduler_jobs (
+                    name TEXT PRIMARY KEY,
+                    last_run_at INTEGER,
+                    last_duration_ms INTEGER,
+                    last_error TEXT,
+                    run_count INTEGER NOT NULL DEFAULT 0,
+                    failure_count INTEGER NOT NULL DEFAULT 0
+                )
+            ''')
+
+            # Последние метрики обращений к БД каждого процесса (JSON, см. db_metrics)
+            await db.execute('''
+                CREATE TABLE IF NOT EXISTS db_metrics (
+                    process TEXT PRIMARY KEY,
+                    updated_at INTEGER NOT NULL,
+                    data TEXT NOT NULL
+                )
+            ''')
+
+            # Архив завершенных заданий и отправленных уведомлений старше срока хранения
+            await db.execute('''
+                CREATE TABLE IF NOT EXISTS daily_tasks_archive (
+                    id INTEGER PRIMARY KEY,
+                    user_id INTEGER,
+                    task_description TEXT,
+                    created_at INTEGER,
+                    expires_at INTEGER,
+                    status TEXT,
+                    completed_at INTEGER,
+                    moderator_comment TEXT,
+                    archived_at INTEGER NOT NULL
+                )
+            ''')
+            await db.execute('''
+                CREATE INDEX IF NOT EXISTS idx_daily_tasks_archive_user
+                ON daily_tasks_archive(user_id, created_at)
+            ''')
+            await db.execute('''
+                CREATE TABLE IF NOT EXISTS notifications_archive (
+                    id INTEGER PRIMARY KEY,
+                    user_id INTEGER NOT NULL,
+                    type TEXT NOT NULL,
+                    title TEXT NOT NULL,
+                    message TEXT NOT NULL,
+                    data TEXT,
+                    created_at INTEGER NOT NULL,
+                    sent_at INTEGER,
+                    archived_at INTEGER NOT NULL
+                )
+            ''')
+            await db.execute('''
+                CREATE INDEX IF NOT EXISTS idx_notifications_archive_user
+                ON notifications_archive(user_id, created_at)
+            ''')
+
             # Создаем таблицу уведомлений
             await db.execute('''
                 CREATE TABLE IF NOT EXISTS notifications (
@@ -302,10 +731,54 @@ class Database:
             await db.execute('CREATE INDEX IF NOT EXISTS idx_moderators_telegram_id ON moderators(telegram_id)')
             await db.execute('CREATE INDEX IF NOT EXISTS idx_bloggers_telegram_id ON bloggers(telegram_id)')
             await db.execute('CREATE INDEX IF NOT EXISTS idx_bloggers_referral_code ON bloggers(referral_code)')
+            await db.execute('CREATE INDEX IF NOT EXISTS idx_users_referral_active ON users(referral_code, subscription_active)')
 
             # Добавляем недостающие колонки для существующих баз данных
             await self._add_missing_columns(db)
 
+            # Индексы для предупреждений об окончании и завершения истекших подписок
+            await db.execute('''
+                CREATE INDEX IF NOT EXISTS idx_subscriptions_status_end_date
+                ON subscriptions(status, end_date)
+            ''')
+            await db.execute('''
+                CREATE INDEX IF NOT EXISTS idx_users_active_subscription_end
+                ON users(subscription_end) WHERE subscription_active = TRUE
+            ''')
+            # Частичные индексы: горячие выборки заданий затрагивают только действующие строки
+            await db.execute('''
+                CREATE INDEX IF NOT EXISTS idx_daily_tasks_active_user
+                ON daily_tasks(user_id, created_at) WHERE status IN ('pending', 'submitted')
+            ''')
+            await db.execute('''
+                CREATE INDEX IF NOT EXISTS idx_daily_tasks_submitted
+                ON daily_tasks(created_at) WHERE status = 'submitted'
+            ''')
+            await db.execute('''
+                CREATE INDEX IF NOT EXISTS idx_daily_tasks_expired_media
+                ON daily_tasks(id) WHERE status = 'expired' AND submitted_media_path IS NOT NULL
+            ''')
+
+            # История заданий пользователя: действующие строки и архив
+            await db.execute('''
+                CREATE VIEW IF NOT EXISTS daily_tasks_history AS
+                SELECT id, user_id, task_description, created_at, expires_at, status, completed_at, moderator_comment
+                FROM daily_tasks
+                UNION ALL
+                SELECT id, user_id, task_description, created_at, expires_at, status, completed_at, moderator_comment
+                FROM daily_tasks_archive
+            ''')
+
+
+            # Переносим историю модерации из moderator_comment в журнал (однократно)
+            await self._backfill_moderation_events(db)
+
+            # Триггеры счетчиков статистики; при первом запуске заполняем счетчики
+            await self._create_stats_counter_triggers(db)
+            cursor = await db.execute('SELECT 1 FROM stats_counters LIMIT 1')
+            if not await cursor.fetchone():
+                await self._rebuild_stats_counters(db)
+
             # Инициализируем стандартные призы
             await self._init_default_prizes(db)
 
@@ -477,6 +950,20 @@ class Database:
                 )
             ''')
 
+            # Создаем таблицу выданных призов
+            await conn.execute('''
+                CREATE TABLE IF NOT EXISTS prize_awards (
+                    id SERIAL PRIMARY KEY,
+                    user_id BIGINT NOT NULL REFERENCES users(telegram_id) ON DELETE CASCADE,
+                    prize_id INTEGER NOT NULL REFERENCES prizes(id) ON DELETE CASCADE,
+                    achievement_type TEXT NOT NULL,
+                    achievement_value INTEGER NOT NULL,
+                    task_id INTEGER,
+                    awarded_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    UNIQUE (user_id, prize_id)
+                )
+            ''')
+
             # Создаем таблицу модераторов
             await conn.execute('''
                 CREATE TABLE IF NOT EXISTS moderators (
@@ -505,15 +992,161 @@ class Database:
                 )
             ''')
 
+            # Журнал действий модераторов (для статистики модерации)
+            await conn.execute('''
+                CREATE TABLE IF NOT EXISTS moderation_events (
+                    id SERIAL PRIMARY KEY,
+                    task_id INTEGER NOT NULL,
+                    moderator_id BIGINT NOT NULL,
+                    action TEXT NOT NULL,
+                    experience_reward INTEGER DEFAULT 0,
+                    stat_rewards TEXT,
+                    reason TEXT,
+                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                )
+            ''')
+            await conn.execute('''
+                CREATE INDEX IF NOT EXISTS idx_moderation_events_moderator
+                ON moderation_events(moderator_id, created_at)
+            ''')
+
+            # Очередь уведомлений пользователям (отправляет фоновая задача основного бота)
+            await conn.execute('''
+                CREATE TABLE IF NOT EXISTS notifications (
+                    id SERIAL PRIMARY KEY,
+                    user_id BIGINT NOT NULL,
+                    type TEXT NOT NULL,
+                    title TEXT NOT NULL,
+                    message TEXT NOT NULL,
+                    data TEXT,
+                    is_sent BOOLEAN DEFAULT FALSE,
+                    created_at BIGINT NOT NULL,
+                    sent_at TIMESTAMP
+                )
+            ''')
+            await conn.execute('''
+                CREATE INDEX IF NOT EXISTS idx_notifications_unsent
+                ON notifications(user_id, is_sent)
+            ''')
+
+            # Время последнего запуска и результат фоновых задач планировщика (unix timestamp)
+            await conn.execute('''
+                CREATE TABLE IF NOT EXISTS scheduler_jobs (
+                    name TEXT PRIMARY KEY,
+                    last_run_at BIGINT,
+                    last_duration_ms INTEGER,
+                    last_error TEXT,
+                    run_count INTEGER NOT NULL DEFAULT 0,
+                    failure_count INTEGER NOT NULL DEFAULT 0
+                )
+            ''')
+
+            # Последние метрики обращений к БД каждого процесса (JSON, см. db_metrics)
+            await conn.execute('''
+                CREATE TABLE IF NOT EXISTS db_metrics (
+                    process TEXT PRIMARY KEY,
+                    updated_at BIGINT NOT NULL,
+                    data TEXT NOT NULL
+                )
+            ''')
+
+            # Архив завершенных заданий и отправленных уведомлений старше срока хранения
+            await conn.execute('''
+                CREATE TABLE IF NOT EXISTS daily_tasks_archive (
+                    id INTEGER PRIMARY KEY,
+                    user_id BIGINT,
+                    task_description TEXT,
+                    created_at TIMESTAMP,
+                    expires_at TIMESTAMP,
+                    status TEXT,
+                    completed_at TIMESTAMP,
+                    moderator_comment TEXT,
+                    archived_at BIGINT NOT NULL
+                )
+            ''')
+            await conn.execute('''
+                CREATE INDEX IF NOT EXISTS idx_daily_tasks_archive_user
+                ON daily_tasks_archive(user_id, created_at)
+            ''')
+            await conn.execute('''
+                CREATE TABLE IF NOT EXISTS notifications_archive (
+                    id INTEGER PRIMARY KEY,
+                    user_id BIGINT NOT NULL,
+                    type TEXT NOT NULL,
+                    title TEXT NOT NULL,
+                    message TEXT NOT NULL,
+                    data TEXT,
+                    created_at BIGINT NOT NULL,
+                    sent_at TIMESTAMP,
+                    archived_at BIGINT NOT NULL
+                )
+            ''')
+            await conn.execute('''
+                CREATE INDEX IF NOT EXISTS idx_notifications_archive_user
+                ON notifications_archive(user_id, created_at)
+            ''')
+
+            # Индекс для аналитики блогеров (подписчики по реферальному коду)
+            await conn.execute('''
+                CREATE INDEX IF NOT EXISTS idx_users_referral_active
+                ON users(referral_code, subscription_active)
+            ''')
+
             # Добавляем недостающие колонки в таблицу prizes (миграция для существующих баз)
             await self._add_missing_prizes_columns_postgres(conn)
             
             # Добавляем недостающие колонки в таблицу daily_tasks (миграция для существующих баз)
             await self._add_missing_daily_tasks_columns_postgres(conn)
+
+            # Секционирование daily_tasks и notifications по месяцам (однократный перевод и секции вперед)
+            if POSTGRES_PARTITIONING:
+                for table in PARTITIONED_TABLES:
+                    await migrate_to_partitioned(conn, table, POSTGRES_PARTITION_PREMAKE_MONTHS)
+                    await ensure_partitions(conn, table, POSTGRES_PARTITION_PREMAKE_MONTHS)
             
             # Добавляем недостающие колонки в таблицу users (миграция для существующих баз)
             await self._add_missing_users_columns_postgres(conn)
 
+            # Когда поставлено предупреждение об окончании подписки
+            await conn.execute('ALTER TABLE subscriptions ADD COLUMN IF NOT EXISTS warned_at BIGINT')
+
+            # Индексы для предупреждений об окончании и завершения истекших подписок
+            await conn.execute('''
+                CREATE INDEX IF NOT EXISTS idx_subscriptions_status_end_date
+                ON subscriptions(status, end_date)
+            ''')
+            await conn.execute('''
+                CREATE INDEX IF NOT EXISTS idx_users_active_subscription_end
+                ON users(subscription_end) WHERE subscription_active = TRUE
+            ''')
+            # Частичные индексы: горячие выборки заданий затрагивают только действующие строки
+            await conn.execute('''
+                CREATE INDEX IF NOT EXISTS idx_daily_tasks_active_user
+                ON daily_tasks(user_id, created_at) WHERE status IN ('pending', 'submitted')
+            ''')
+            await conn.execute('''
+                CREATE INDEX IF NOT EXISTS idx_daily_tasks_submitted
+                ON daily_tasks(created_at) WHERE status = 'submitted'
+            ''')
+            await conn.execute('''
+                CREATE INDEX IF NOT EXISTS idx_daily_tasks_expired_media
+                ON daily_tasks(id) WHERE status = 'expired' AND submitted_media_path IS NOT NULL
+            ''')
+
+            # История заданий пользователя: действующие строки и архив
+            await conn.execute('''
+                CREATE OR REPLACE VIEW daily_tasks_history AS
+                SELECT id, user_id, task_description, created_at, expires_at, status, completed_at, moderator_comment
+                FROM daily_tasks
+                UNION ALL
+                SELECT id, user_id, task_description, created_at, expires_at, status, completed_at, moderator_comment
+                FROM daily_tasks_archive
+            ''')
+
+
+            # Переносим историю модерации из moderator_comment в журнал (однократно)
+            await self._backfill_moderation_events_postgres(conn)
+
             # Инициализируем стандартные призы
             await self._init_default_prizes_postgres(conn)
 
@@ -524,12 +1157,16 @@ class Database:
         finally:
             await conn.close()
 
+    async def close(self):
+        """Закрытие долгоживущих соединений слоя запросов"""
+        await self.queries.close()
+
     async def _execute_sqlite(self, query: str, *args):
         """Выполнение запроса к SQLite"""
         if self.use_postgres:
             raise Exception("Этот метод доступен только для SQLite")
 
-        async with aiosqlite.connect(self.db_path) as conn:
+        async with sqlite_connect(self.db_path) as conn:
             if query.strip().upper().startswith('SELECT'):
                 cursor = await conn.execute(query, args)
                 result = await cursor.fetchall()
@@ -556,6 +1193,44 @@ class Database:
         finally:
             await conn.close()
 
+    async def _iter_postgres_keyset(self, query: str, args: tuple, key: str, batch_size: Optional[int] = None) -> AsyncIterator:
+        """
+        Потоковое чтение из PostgreSQL с keyset-пагинацией (как _iter_sqlite_keyset).
+        query должен заканчиваться условием "{key} > $N ORDER BY {key} LIMIT $N+1". Соединение
+        из пула берется только на время чтения пачки: между пачками не держатся ни соединение,
+        ни транзакция, поэтому обработка строк (в том числе внешние запросы) не мешает VACUUM.
+        """
+        batch_size = batch_size or self.iter_batch_size
+        last_key = _KEYSET_START
+        while True:
+            async with self.queries.acquire() as conn:
+                rows = await conn.fetch(query, *args, last_key, batch_size)
+            for row in rows:
+                yield row
+            if len(rows) < batch_size:
+                return
+            last_key = rows[-1][key]
+
+    async def _iter_sqlite_keyset(self, query: str, args: tuple, key: str, batch_size: Optional[int] = None) -> AsyncIterator:
+        """
+        Потоковое чтение из SQLite с keyset-пагинацией.
+        query должен заканчиваться условием "{key} > ? ORDER BY {key} LIMIT ?" - последние два
+        параметра подставляются автоматически. Соединение открывается только на время чтения пачки,
+        поэтому обработка строк не блокирует базу.
+        """
+        batch_size = batch_size or self.iter_batch_size
+        last_key = _KEYSET_START
+        while True:
+            async with sqlite_connect(self.db_path) as db:
+                db.row_factory = aiosqlite.Row
+                cursor = await db.execute(query, (*args, last_key, batch_size))
+                rows = await cursor.fetchall()
+            for row in rows:
+                yield row
+            if len(rows) < batch_size:
+                return
+            last_key = rows[-1][key]
+
     async def _init_default_prizes_postgres(self, conn):
         """Инициализация стандартных призов для PostgreSQL"""
         from datetime import datetime
@@ -727,6 +1402,8 @@ class Database:
             ('expires_at', 'TIMESTAMP', '', False),
             ('submitted_media_path', 'TEXT', '', False),
             ('moderator_comment', 'TEXT', '', False),
+            ('claimed_by', 'BIGINT', '', False),  # модератор, взявший задание на проверку
+            ('claimed_until', 'TIMESTAMP', '', False),  # время окончания аренды задания
         ]
 
         for column_name, column_type, default_value, is_not_null in daily_tasks_columns:
@@ -755,6 +1432,7 @@ class Database:
         # Список колонок которые должны быть в таблице users
         users_columns = [
             ('subscription_level', 'INTEGER', 'DEFAULT 1', False),
+            ('timezone', 'TEXT', '', False),
         ]
 
         for column_name, column_type, default_value, is_not_null in users_columns:
@@ -778,6 +1456,121 @@ class Database:
                 # Колонка уже существует или другая ошибка
                 logger.debug(f"Колонка {column_name} уже существует или ошибка: {e}")
 
+    async def _backfill_moderation_events(self, db):
+        """Заполнение журнала модерации по старым комментариям модераторов (если журнал пуст)"""
+        cursor = await db.execute('SELECT 1 FROM moderation_events LIMIT 1')
+        if await cursor.fetchone():
+            return
+
+        # ID модератора стоит сразу после префикса; CAST берет числовое начало строки
+        cursor = await db.execute('''
+            INSERT INTO moderation_events (task_id, moderator_id, action, reason, created_at)
+            SELECT id,
+                   CAST(substr(moderator_comment, length('Одобрено модератором ') + 1) AS INTEGER),
+                   'approved', NULL, COALESCE(completed_at, created_at, 0)
+            FROM daily_tasks
+            WHERE status = 'approved' AND moderator_comment LIKE 'Одобрено модератором %'
+            UNION ALL
+            SELECT id,
+                   CAST(substr(moderator_comment, length('Отклонено модератором ') + 1) AS INTEGER),
+                   'rejected', NULL, COALESCE(completed_at, created_at, 0)
+            FROM daily_tasks
+            WHERE status = 'rejected' AND moderator_comment LIKE 'Отклонено модератором %'
+        ''')
+        if cursor.rowcount > 0:
+            logger.info(f"Журнал модерации заполнен по истории заданий: {cursor.rowcount} записей")
+
+    async def _backfill_moderation_events_postgres(self, conn):
+        """Заполнение журнала модерации по старым комментариям модераторов для PostgreSQL"""
+        has_events = await conn.fetchval('SELECT EXISTS (SELECT 1 FROM moderation_events)')
+        if has_events:
+            return
+
+        result = await conn.execute('''
+            INSERT INTO moderation_events (task_id, moderator_id, action, created_at)
+            SELECT id,
+                   substring(moderator_comment from 'модератором ([0-9]+)')::BIGINT,
+                   status,
+                   COALESCE(completed_at, created_at, CURRENT_TIMESTAMP)
+            FROM daily_tasks
+            WHERE status IN ('approved', 'rejected')
+              AND moderator_comment ~ '^(Одобрено|Отклонено) модератором [0-9]+'
+        ''')
+        logger.info(f"Журнал модерации заполнен по истории заданий (PostgreSQL): {result}")
+
+    async def _create_stats_counter_triggers(self, db):
+        """
+        Создание триггеров, поддерживающих stats_counters при любых изменениях users и user_stats
+        (save_user, активация/деактивация подписки, одобрение заданий, пересчет уровня и т.д.)
+        """
+        def counter(scope: str, key: str, name: str, delta: str, condition: str = "1") -> str:
+            return f'''
+                INSERT INTO stats_counters (scope, key, name, value)
+                SELECT '{scope}', {key}, '{name}', {delta} WHERE {condition}
+                ON CONFLICT(scope, key, name) DO UPDATE SET value = value + excluded.value;'''
+
+        def user_counters(row: str, sign: str) -> str:
+            return "".join([
+                counter('global', "''", 'users', f"{sign}1"),
+                counter('global', "''", 'active_users', f"{sign}1", f"{row}.subscription_active"),
+                counter('city', f"{row}.city", 'users', f"{sign}1", f"COALESCE({row}.city, '') != ''"),
+                counter('referral', f"{row}.referral_code", 'users', f"{sign}1", f"COALESCE({row}.referral_code, '') != ''"),
+                counter('referral', f"{row}.referral_code", 'active_users', f"{sign}1",
+                        f"COALESCE({row}.referral_code, '') != '' AND {row}.subscription_active"),
+            ])
+
+        def stats_counters_sql(row: str, sign: str) -> str:
+            return "".join([
+                counter('rank', f"COALESCE({row}.rank, 'F')", 'users', f"{sign}1"),
+                counter('global', "''", 'completed_tasks', f"{sign}COALESCE({row}.total_tasks_completed, 0)"),
+            ])
+
+        triggers = {
+            'trg_users_stats_insert': f"AFTER INSERT ON users BEGIN {user_counters('NEW', '+')} END",
+            'trg_users_stats_delete': f"AFTER DELETE ON users BEGIN {user_counters('OLD', '-')} END",
+            'trg_users_stats_update': (
+                "AFTER UPDATE OF city, referral_code, subscription_active ON users "
+                f"BEGIN {user_counters('OLD', '-')} {user_counters('NEW', '+')} END"
+            ),
+            'trg_user_stats_counters_insert': f"AFTER INSERT ON user_stats BEGIN {stats_counters_sql('NEW', '+')} END",
+            'trg_user_stats_counters_delete': f"AFTER DELETE ON user_stats BEGIN {stats_counters_sql('OLD', '-')} END",
+            'trg_user_stats_counters_update': (
+                "AFTER UPDATE OF rank, total_tasks_completed ON user_stats "
+                f"BEGIN {stats_counters_sql('OLD', '-')} {stats_counters_sql('NEW', '+')} END"
+            ),
+        }
+        for name, body in triggers.items():
+            await db.execute(f'CREATE TRIGGER IF NOT EXISTS {name} {body}')
+
+    async def _rebuild_stats_counters(self, db):
+        """Полный пересчет stats_counters по базовым таблицам (в транзакции вызывающего метода)"""
+        await db.execute('DELETE FROM stats_counters')
+        await db.execute('''
+            INSERT INTO stats_counters (scope, key, name, value)
+            SELECT 'global', '', 'users', COUNT(*) FROM users
+            UNION ALL
+            SELECT 'global', '', 'active_users', COUNT(*) FROM users WHERE subscription_active
+            UNION ALL
+            SELECT 'global', '', 'completed_tasks', COALESCE(SUM(total_tasks_completed), 0) FROM user_stats
+            UNION ALL
+            SELECT 'city', city, 'users', COUNT(*) FROM users WHERE COALESCE(city, '') != '' GROUP BY city
+            UNION ALL
+            SELECT 'referral', referral_code, 'users', COUNT(*) FROM users
+            WHERE COALESCE(referral_code, '') != '' GROUP BY referral_code
+            UNION ALL
+            SELECT 'referral', referral_code, 'active_users', COUNT(*) FROM users
+            WHERE COALESCE(referral_code, '') != '' AND subscription_active GROUP BY referral_code
+            UNION ALL
+            SELECT 'rank', COALESCE(rank, 'F'), 'users', COUNT(*) FROM user_stats GROUP BY COALESCE(rank, 'F')
+        ''')
+        logger.info("Счетчики статистики пересчитаны")
+
+    async def rebuild_stats_counters(self):
+        """Пересчет счетчиков статистики (исправление расхождений)"""
+        async with sqlite_connect(self.db_path) as db:
+            await self._rebuild_stats_counters(db)
+            await db.commit()
+
     async def _add_missing_columns(self, db):
         """Добавляет недостающие колонки для совместимости с существующими базами данных"""
         # Поля для таблицы users
@@ -788,7 +1581,8 @@ class Database:
             ('subscription_active', 'BOOLEAN DEFAULT FALSE'),
             ('subscription_start', 'INTEGER'),
             ('subscription_end', 'INTEGER'),
-            ('referral_count', 'INTEGER DEFAULT 0')
+            ('referral_count', 'INTEGER DEFAULT 0'),
+            ('timezone', 'TEXT')  # часовой пояс IANA для подсчета стриков (NULL - STREAK_TIMEZONE)
         ]
 
         for column_name, column_type in user_columns:
@@ -799,6 +1593,19 @@ class Database:
                 # Колонка уже существует
                 pass
 
+        # Поля для таблицы subscriptions
+        subscription_columns = [
+            ('warned_at', 'INTEGER')  # когда поставлено предупреждение об окончании подписки
+        ]
+
+        for column_name, column_type in subscription_columns:
+            try:
+                await db.execute(f'ALTER TABLE subscriptions ADD COLUMN {column_name} {column_type}')
+                logger.info(f"Колонка {column_name} добавлена в таблицу subscriptions")
+            except aiosqlite.OperationalError:
+                # Колонка уже существует
+                pass
+
         # Поля для таблицы payments
         payment_columns = [
             ('currency', "TEXT DEFAULT 'RUB'"),
@@ -838,7 +1645,9 @@ class Database:
         daily_tasks_columns = [
             ('status', "TEXT DEFAULT 'pending'"),
             ('submitted_media_path', 'TEXT'),
-            ('moderator_comment', 'TEXT')
+            ('moderator_comment', 'TEXT'),
+            ('claimed_by', 'INTEGER'),  # модератор, взявший задание на проверку
+            ('claimed_until', 'INTEGER')  # время окончания аренды задания (timestamp)
         ]
 
         for column_name, column_type in daily_tasks_columns:
@@ -1001,107 +1810,12 @@ class Database:
 
     async def get_user(self, telegram_id: int) -> Optional[User]:
         """Получение пользователя по telegram_id"""
-        if self.use_postgres:
-            conn = await _get_postgres_connection()
-            try:
-                row = await conn.fetchrow(
-                    "SELECT * FROM users WHERE telegram_id = $1",
-                    telegram_id
-                )
-                
-                if row:
-                    # Преобразование даты из PostgreSQL формата
-                    birth_date = None
-                    if row.get('birth_date'):
-                        if isinstance(row['birth_date'], date):
-                            birth_date = row['birth_date']
-                        elif isinstance(row['birth_date'], str):
-                            try:
-                                birth_date = date.fromisoformat(row['birth_date'])
-                            except ValueError:
-                                logger.warning(f"Неверный формат даты для пользователя {telegram_id}")
-                    
-                    # Конвертируем timestamp в int если нужно
-                    created_at = row.get('created_at')
-                    updated_at = row.get('updated_at')
-                    subscription_start = row.get('subscription_start')
-                    subscription_end = row.get('subscription_end')
-                    
-                    if isinstance(created_at, datetime.datetime):
-                        created_at = int(created_at.timestamp())
-                    elif created_at is None:
-                        created_at = 0
-                    
-                    if isinstance(updated_at, datetime.datetime):
-                        updated_at = int(updated_at.timestamp())
-                    elif updated_at is None:
-                        updated_at = 0
-                    
-                    if isinstance(subscription_start, datetime.datetime):
-                        subscription_start = int(subscription_start.timestamp())
-                    elif subscription_start is None:
-                        subscription_start = None
-                    
-                    if isinstance(subscription_end, datetime.datetime):
-                        subscription_end = int(subscription_end.timestamp())
-                    elif subscription_end is None:
-                        subscription_end = None
-                    
-                    return User(
-                        telegram_id=row['telegram_id'],
-                        language=row.get('language', 'ru'),
-                        name=row.get('name', ''),
-                        birth_date=birth_date,
-                        height=row.get('height'),
-                        weight=row.get('weight'),
-                        city=row.get('city'),
-                        referral_code=row.get('referral_code'),
-                        goal=row.get('goal'),
-                        subscription_active=bool(row.get('subscription_active', False)),
-                        subscription_start=subscription_start,
-                        subscription_end=subscription_end,
-                        referral_count=row.get('referral_count', 0)
-                    )
-                return None
-            finally:
-                await conn.close()
-        else:
-            async with aiosqlite.connect(self.db_path) as db:
-                db.row_factory = aiosqlite.Row
-                cursor = await db.execute(
-                    "SELECT * FROM users WHERE telegram_id = ?",
-                    (telegram_id,)
-                )
-                row = await cursor.fetchone()
-
-                if row:
-                    # Преобразование строки даты в объект date
-                    birth_date = None
-                    if row['birth_date']:
-                        try:
-                            birth_date = date.fromisoformat(row['birth_date'])
-                        except ValueError:
-                            logger.warning(f"Неверный формат даты для пользователя {telegram_id}")
-
-                    return User(
-                        telegram_id=row['telegram_id'],
-                        language=row['language'],
-                        name=row['name'],
-                        birth_date=birth_date,
-                        height=row['height'],
-                        weight=row['weight'],
-                        city=row['city'],
-                        referral_code=row['referral_code'],
-                        goal=row['goal'],
-                        subscription_active=bool(row['subscription_active']),
-                        subscription_start=row['subscription_start'],
-                        subscription_end=row['subscription_end'],
-                        referral_count=row['referral_count']
-                    )
-                return None
+        row = await self.queries.fetchrow(_Q_USER, telegram_id)
+        return decode_row(User, row) if row else None
 
     async def save_user(self, user: User):
         """Сохранение или обновление пользователя"""
+        self._note_user_write(user.telegram_id)
         if self.use_postgres:
             conn = await _get_postgres_connection()
             try:
@@ -1166,10 +1880,11 @@ class Database:
                     current_time
                 )
                 logger.info(f"Пользователь {user.telegram_id} сохранен в PostgreSQL")
+                self.invalidate_blogger_stats(user.referral_code or None)
             finally:
                 await conn.close()
         else:
-            async with aiosqlite.connect(self.db_path) as db:
+            async with sqlite_connect(self.db_path) as db:
                 # Преобразование даты в строку для хранения
                 birth_date_str = user.birth_date.isoformat() if user.birth_date else None
 
@@ -1208,58 +1923,68 @@ class Database:
                 ))
                 await db.commit()
                 logger.info(f"Пользователь {user.telegram_id} сохранен")
+                self.invalidate_blogger_stats(user.referral_code or None)
 
     async def update_user_field(self, telegram_id: int, field: str, value):
         """Обновление конкретного поля пользователя"""
-        async with aiosqlite.connect(self.db_path) as db:
-            # Преобразование значения в зависимости от типа
-            if field == 'birth_date' and isinstance(value, date):
-                value = value.isoformat()
-
-            await db.execute(f'''
+        self._note_user_write(telegram_id)
+        # Преобразование значения в зависимости от типа
+        if field == 'birth_date' and isinstance(value, date):
+            value = value.isoformat()
+
+        query = self._user_field_queries.get(field)
+        if query is None:
+            query = Query(f'''
                 UPDATE users
                 SET {field} = ?, updated_at = CURRENT_TIMESTAMP
                 WHERE telegram_id = ?
-            ''', (value, telegram_id))
-            await db.commit()
-            logger.info(f"Поле {field} пользователя {telegram_id} обновлено")
+            ''')
+            self._user_field_queries[field] = query
+
+        await self.queries.execute(query, value, telegram_id)
+        logger.info(f"Поле {field} пользователя {telegram_id} обновлено")
+        if field in ('referral_code', 'subscription_active'):
+            self.invalidate_blogger_stats()
+
+    async def set_user_timezone(self, telegram_id: int, timezone: Optional[str]) -> bool:
+        """
+        Часовой пояс пользователя (имя IANA) для подсчета стриков; None - STREAK_TIMEZONE.
+        Возвращает False для неизвестного часового пояса.
+        """
+        if timezone is not None and not is_valid_timezone(timezone):
+            return False
+        await self.update_user_field(telegram_id, 'timezone', timezone)
+        return True
 
     async def get_all_users(self) -> list[User]:
         """Получение всех пользователей"""
-        async with aiosqlite.connect(self.db_path) as db:
+        async with sqlite_connect(self.db_path) as db:
             db.row_factory = aiosqlite.Row
             cursor = await db.execute("SELECT * FROM users ORDER BY created_at DESC")
             rows = await cursor.fetchall()
+            return decode_rows(User, rows)
 
-            users = []
-            for row in rows:
-                birth_date = None
-                if row['birth_date']:
-                    try:
-                        birth_date = date.fromisoformat(row['birth_date'])
-                    except ValueError:
-                        logger.warning(f"Неверный формат даты для пользователя {row['telegram_id']}")
-
-                users.append(User(
-                    telegram_id=row['telegram_id'],
-                    language=row['language'],
-                    name=row['name'],
-                    birth_date=birth_date,
-                    height=row['height'],
-                    weight=row['weight'],
-                    city=row['city'],
-                    referral_code=row['referral_code'],
-                    goal=row['goal'],
-                    subscription_active=bool(row['subscription_active']),
-                    subscription_start=row['subscription_start'],
-                    subscription_end=row['subscription_end'],
-                    referral_count=row['referral_count']
-                ))
-            return users
+    async def iter_users(self, batch_size: Optional[int] = None) -> AsyncIterator[User]:
+        """
+        Потоковый обход всех пользователей (в порядке telegram_id) с постоянным расходом памяти.
+        Keyset-пагинация по telegram_id на обеих базах.
+        """
+        if self.use_postgres:
+            rows = self._iter_postgres_keyset(
+                "SELECT * FROM users WHERE telegram_id > $1 ORDER BY telegram_id LIMIT $2",
+                (), 'telegram_id', batch_size
+            )
+        else:
+            rows = self._iter_sqlite_keyset(
+                "SELECT * FROM users WHERE telegram_id > ? ORDER BY telegram_id LIMIT ?",
+                (), 'telegram_id', batch_size
+            )
+        async for user in decode_stream(User, rows):
+            yield user
 
     async def save_payment(self, payment: Payment) -> int:
         """Сохранение платежа в базу данных"""
-        async with aiosqlite.connect(self.db_path) as db:
+        async with sqlite_connect(self.db_path) as db:
             # Проверяем наличие колонки subscription_level
             cursor = await db.execute("PRAGMA table_info(payments)")
             columns = [row[1] for row in await cursor.fetchall()]
@@ -1320,38 +2045,10 @@ class Database:
                     "SELECT * FROM payments WHERE id = $1",
                     payment_id
                 )
-                if row:
-                    # Конвертируем datetime в timestamp если нужно
-                    created_at = row['created_at']
-                    paid_at = row.get('paid_at')
-                    if isinstance(created_at, datetime.datetime):
-                        created_at = int(created_at.timestamp())
-                    if paid_at and isinstance(paid_at, datetime.datetime):
-                        paid_at = int(paid_at.timestamp())
-                    
-                    subscription_level = row.get('subscription_level', 1) or 1
-                    return Payment(
-                        id=row['id'],
-                        user_id=row['user_id'],
-                        payment_id=row['payment_id'],
-                        order_id=row['order_id'],
-                        amount=float(row['amount']),
-                        months=row['months'],
-                        status=PaymentStatus(row['status']),
-                        created_at=created_at,
-                        paid_at=paid_at,
-                        currency=row.get('currency', 'RUB'),
-                        payment_method=row.get('payment_method', 'WATA'),
-                        subscription_level=subscription_level,
-                        discount_code=row.get('discount_code'),
-                        referral_used=row.get('referral_used'),
-                        subscription_type=row.get('subscription_type', 'standard')
-                    )
-                return None
             finally:
                 await conn.close()
         else:
-            async with aiosqlite.connect(self.db_path) as db:
+            async with sqlite_connect(self.db_path) as db:
                 db.row_factory = aiosqlite.Row
                 cursor = await db.execute(
                     "SELECT * FROM payments WHERE id = ?",
@@ -1359,31 +2056,7 @@ class Database:
                 )
                 row = await cursor.fetchone()
 
-            if row:
-                subscription_level = 1
-                try:
-                    subscription_level = row['subscription_level'] if row['subscription_level'] else 1
-                except (KeyError, IndexError):
-                    subscription_level = 1
-                
-                return Payment(
-                    id=row['id'],
-                    user_id=row['user_id'],
-                    payment_id=row['payment_id'],
-                    order_id=row['order_id'],
-                    amount=row['amount'],
-                    months=row['months'],
-                    status=PaymentStatus(row['status']),
-                    created_at=row['created_at'],
-                    paid_at=row['paid_at'],
-                    currency=row['currency'],
-                    payment_method=row['payment_method'],
-                    subscription_level=subscription_level,
-                    discount_code=row['discount_code'],
-                    referral_used=row['referral_used'],
-                    subscription_type=row['subscription_type']
-                )
-            return None
+        return decode_row(Payment, row) if row else None
 
     async def get_payment_by_order_id(self, order_id: str) -> Optional[Payment]:
         """Получение платежа по order_id"""
@@ -1394,38 +2067,10 @@ class Database:
                     "SELECT * FROM payments WHERE order_id = $1",
                     order_id
                 )
-                if row:
-                    # Конвертируем datetime в timestamp если нужно
-                    created_at = row['created_at']
-                    paid_at = row.get('paid_at')
-                    if isinstance(created_at, datetime.datetime):
-                        created_at = int(created_at.timestamp())
-                    if paid_at and isinstance(paid_at, datetime.datetime):
-                        paid_at = int(paid_at.timestamp())
-                    
-                    subscription_level = row.get('subscription_level', 1) or 1
-                    return Payment(
-                        id=row['id'],
-                        user_id=row['user_id'],
-                        payment_id=row['payment_id'],
-                        order_id=row['order_id'],
-                        amount=float(row['amount']),
-                        months=row['months'],
-                        status=PaymentStatus(row['status']),
-                        created_at=created_at,
-                        paid_at=paid_at,
-                        currency=row.get('currency', 'RUB'),
-                        payment_method=row.get('payment_method', 'WATA'),
-                        subscription_level=subscription_level,
-                        discount_code=row.get('discount_code'),
-                        referral_used=row.get('referral_used'),
-                        subscription_type=row.get('subscription_type', 'standard')
-                    )
-                return None
             finally:
                 await conn.close()
         else:
-            async with aiosqlite.connect(self.db_path) as db:
+            async with sqlite_connect(self.db_path) as db:
                 db.row_factory = aiosqlite.Row
                 cursor = await db.execute(
                     "SELECT * FROM payments WHERE order_id = ?",
@@ -1433,32 +2078,7 @@ class Database:
                 )
                 row = await cursor.fetchone()
 
-        if row:
-            # Проверяем наличие subscription_level в результате
-            subscription_level = 1  # По умолчанию
-            try:
-                subscription_level = row['subscription_level'] if row['subscription_level'] else 1
-            except (KeyError, IndexError):
-                subscription_level = 1
-            
-            return Payment(
-                    id=row['id'],
-                    user_id=row['user_id'],
-                    payment_id=row['payment_id'],
-                    order_id=row['order_id'],
-                    amount=row['amount'],
-                    months=row['months'],
-                    status=PaymentStatus(row['status']),
-                    created_at=row['created_at'],
-                    paid_at=row['paid_at'],
-                    currency=row['currency'],
-                    payment_method=row['payment_method'],
-                    subscription_level=subscription_level,
-                    discount_code=row['discount_code'],
-                    referral_used=row['referral_used'],
-                    subscription_type=row['subscription_type']
-                )
-            return None
+        return decode_row(Payment, row) if row else None
 
     async def get_pending_payments(self) -> list[Payment]:
         """Получение всех неоплаченных платежей"""
@@ -1468,82 +2088,39 @@ class Database:
                 rows = await conn.fetch(
                     "SELECT * FROM payments WHERE status = 'pending' ORDER BY created_at DESC"
                 )
-                
-                payments = []
-                for row in rows:
-                    # Конвертируем datetime в timestamp если нужно
-                    created_at = row.get('created_at')
-                    paid_at = row.get('paid_at')
-                    
-                    if isinstance(created_at, datetime.datetime):
-                        created_at = int(created_at.timestamp())
-                    elif created_at is None:
-                        created_at = 0
-                    
-                    if paid_at and isinstance(paid_at, datetime.datetime):
-                        paid_at = int(paid_at.timestamp())
-                    elif paid_at is None:
-                        paid_at = None
-                    
-                    payments.append(Payment(
-                        id=row['id'],
-                        user_id=row['user_id'],
-                        payment_id=row['payment_id'],
-                        order_id=row['order_id'],
-                        amount=row['amount'],
-                        months=row['months'],
-                        status=PaymentStatus(row['status']),
-                        created_at=created_at,
-                        paid_at=paid_at,
-                        currency=row.get('currency', 'RUB'),
-                        payment_method=row.get('payment_method', 'WATA'),
-                        discount_code=row.get('discount_code'),
-                        referral_used=row.get('referral_used'),
-                        subscription_type=row.get('subscription_type', 'standard'),
-                        subscription_level=row.get('subscription_level', 1)
-                    ))
-                return payments
+                return decode_rows(Payment, rows)
             finally:
                 await conn.close()
         else:
-            async with aiosqlite.connect(self.db_path) as db:
+            async with sqlite_connect(self.db_path) as db:
                 db.row_factory = aiosqlite.Row
                 cursor = await db.execute(
                     "SELECT * FROM payments WHERE status = 'pending' ORDER BY created_at DESC"
                 )
                 rows = await cursor.fetchall()
+                return decode_rows(Payment, rows)
 
-                payments = []
-                for row in rows:
-                    # Проверяем наличие subscription_level в результате
-                    subscription_level = 1  # По умолчанию
-                    try:
-                        subscription_level = row['subscription_level'] if row['subscription_level'] else 1
-                    except (KeyError, IndexError):
-                        subscription_level = 1
-                    
-                    payments.append(Payment(
-                        id=row['id'],
-                        user_id=row['user_id'],
-                        payment_id=row['payment_id'],
-                        order_id=row['order_id'],
-                        amount=row['amount'],
-                        months=row['months'],
-                        status=PaymentStatus(row['status']),
-                        created_at=row['created_at'],
-                        paid_at=row['paid_at'],
-                        currency=row['currency'],
-                        payment_method=row['payment_method'],
-                        discount_code=row['discount_code'],
-                        referral_used=row['referral_used'],
-                        subscription_type=row['subscription_type'],
-                        subscription_level=subscription_level
-                    ))
-                return payments
-
-    async def update_payment_status(self, payment_id: int, status: str, paid_at: Optional[int] = None):
-        """Обновление статуса платежа"""
-        if self.use_postgres:
+    async def iter_pending_payments(self, batch_size: Optional[int] = None) -> AsyncIterator[Payment]:
+        """
+        Потоковый обход неоплаченных платежей (в порядке id) с постоянным расходом памяти.
+        Платежи, статус которых меняется во время обхода, не мешают пагинации: ключом служит id.
+        """
+        if self.use_postgres:
+            rows = self._iter_postgres_keyset(
+                "SELECT * FROM payments WHERE status = 'pending' AND id > $1 ORDER BY id LIMIT $2",
+                (), 'id', batch_size
+            )
+        else:
+            rows = self._iter_sqlite_keyset(
+                "SELECT * FROM payments WHERE status = 'pending' AND id > ? ORDER BY id LIMIT ?",
+                (), 'id', batch_size
+            )
+        async for payment in decode_stream(Payment, rows):
+            yield payment
+
+    async def update_payment_status(self, payment_id: int, status: str, paid_at: Optional[int] = None):
+        """Обновление статуса платежа"""
+        if self.use_postgres:
             conn = await _get_postgres_connection()
             try:
                 # Конвертируем timestamp в datetime для PostgreSQL если нужно
@@ -1563,7 +2140,7 @@ class Database:
             finally:
                 await conn.close()
         else:
-            async with aiosqlite.connect(self.db_path) as db:
+            async with sqlite_connect(self.db_path) as db:
                 await db.execute('''
                     UPDATE payments
                     SET status = ?, paid_at = ?
@@ -1576,6 +2153,7 @@ class Database:
 
     async def save_subscription(self, subscription: Subscription) -> int:
         """Сохранение подписки в базу данных"""
+        self._note_user_write(subscription.user_id)
         if self.use_postgres:
             conn = await _get_postgres_connection()
             try:
@@ -1631,7 +2209,7 @@ class Database:
             finally:
                 await conn.close()
         else:
-            async with aiosqlite.connect(self.db_path) as db:
+            async with sqlite_connect(self.db_path) as db:
                 # Проверяем наличие колонки subscription_level
                 cursor = await db.execute("PRAGMA table_info(subscriptions)")
                 columns = [row[1] for row in await cursor.fetchall()]
@@ -1678,125 +2256,9 @@ class Database:
 
     async def get_active_subscription(self, user_id: int) -> Optional[Subscription]:
         """Получение активной подписки пользователя"""
-        if self.use_postgres:
-            conn = await _get_postgres_connection()
-            try:
-                # В таблице subscriptions колонка end_date имеет тип BIGINT (timestamp)
-                # Поэтому используем timestamp (int) для сравнения
-                current_timestamp = int(datetime.datetime.now().timestamp())
-                
-                row = await conn.fetchrow('''
-                    SELECT * FROM subscriptions
-                    WHERE user_id = $1 AND status = 'active' AND end_date > $2
-                    ORDER BY end_date DESC
-                    LIMIT 1
-                ''', user_id, current_timestamp)
-                
-                if row:
-                    # В таблице subscriptions колонки start_date и end_date имеют тип BIGINT (timestamp)
-                    # created_at может быть TIMESTAMP, поэтому конвертируем если нужно
-                    start_date = row.get('start_date')
-                    end_date = row.get('end_date')
-                    created_at = row.get('created_at')
-                    updated_at = row.get('updated_at')
-                    
-                    # start_date и end_date уже должны быть int (BIGINT), но проверяем на всякий случай
-                    if isinstance(start_date, datetime.datetime):
-                        start_date = int(start_date.timestamp())
-                    elif isinstance(start_date, (int, float)):
-                        start_date = int(start_date)
-                    elif start_date is None:
-                        start_date = 0
-                    
-                    if isinstance(end_date, datetime.datetime):
-                        end_date = int(end_date.timestamp())
-                    elif isinstance(end_date, (int, float)):
-                        end_date = int(end_date)
-                    elif end_date is None:
-                        end_date = 0
-                    
-                    if isinstance(created_at, datetime.datetime):
-                        created_at = int(created_at.timestamp())
-                    elif isinstance(created_at, (int, float)):
-                        created_at = int(created_at)
-                    elif created_at is None:
-                        created_at = 0
-                    
-                    if isinstance(updated_at, datetime.datetime):
-                        updated_at = int(updated_at.timestamp())
-                    elif isinstance(updated_at, (int, float)):
-                        updated_at = int(updated_at)
-                    elif updated_at is None:
-                        updated_at = 0
-                    
-                    # Проверяем наличие колонки subscription_level
-                    subscription_level = row.get('subscription_level', 1) or 1
-                    if subscription_level is None:
-                        # Определяем по месяцам если subscription_level отсутствует
-                        months = row.get('months', 0)
-                        if months >= 12:
-                            subscription_level = 3
-                        elif months >= 3:
-                            subscription_level = 2
-                        else:
-                            subscription_level = 1
-                    
-                    return Subscription(
-                        id=row['id'],
-                        user_id=row['user_id'],
-                        payment_id=row.get('payment_id', ''),
-                        start_date=start_date,
-                        end_date=end_date,
-                        months=row.get('months', 0),
-                        subscription_level=subscription_level,
-                        status=SubscriptionStatus(row['status']),
-                        auto_renew=bool(row.get('auto_renew', False)),
-                        created_at=created_at,
-                        updated_at=updated_at
-                    )
-                return None
-            finally:
-                await conn.close()
-        else:
-            async with aiosqlite.connect(self.db_path) as db:
-                db.row_factory = aiosqlite.Row
-                cursor = await db.execute('''
-                    SELECT * FROM subscriptions
-                    WHERE user_id = ? AND status = 'active' AND end_date > ?
-                    ORDER BY end_date DESC
-                    LIMIT 1
-                ''', (user_id, int(datetime.datetime.now().timestamp())))
-
-                row = await cursor.fetchone()
-                if row:
-                    # Проверяем наличие колонки subscription_level
-                    subscription_level = 1  # По умолчанию
-                    try:
-                        subscription_level = row['subscription_level'] if row['subscription_level'] else 1
-                    except (KeyError, IndexError):
-                        # Колонка отсутствует в старых версиях БД, определяем по месяцам
-                        months = row['months']
-                        if months >= 12:
-                            subscription_level = 3
-                        elif months >= 3:
-                            subscription_level = 2
-                        else:
-                            subscription_level = 1
-                    
-                    return Subscription(
-                        id=row['id'],
-                        user_id=row['user_id'],
-                        payment_id=row['payment_id'],
-                        start_date=row['start_date'],
-                        end_date=row['end_date'],
-                        months=row['months'],
-                        subscription_level=subscription_level,
-                        status=SubscriptionStatus(row['status']),
-                        auto_renew=bool(row['auto_renew']),
-                        created_at=row['created_at'],
-                        updated_at=row['updated_at']
-                    )
-                return None
+        # В таблице subscriptions колонка end_date имеет тип BIGINT/INTEGER (timestamp) в обеих БД
+        row = await self.queries.fetchrow(_Q_ACTIVE_SUBSCRIPTION, user_id, int(datetime.datetime.now().timestamp()))
+        return decode_row(Subscription, row) if row else None
 
     async def get_user_subscriptions(self, user_id: int) -> list[Subscription]:
         """Получение всех подписок пользователя"""
@@ -1808,115 +2270,19 @@ class Database:
                     WHERE user_id = $1
                     ORDER BY created_at DESC
                 ''', user_id)
-                
-                subscriptions = []
-                for row in rows:
-                    # Конвертируем datetime в timestamp если нужно
-                    start_date = row.get('start_date')
-                    end_date = row.get('end_date')
-                    created_at = row.get('created_at')
-                    updated_at = row.get('updated_at')
-                    
-                    # start_date и end_date имеют тип BIGINT (timestamp)
-                    if isinstance(start_date, datetime.datetime):
-                        start_date = int(start_date.timestamp())
-                    elif isinstance(start_date, (int, float)):
-                        start_date = int(start_date)
-                    elif start_date is None:
-                        start_date = 0
-                    
-                    if isinstance(end_date, datetime.datetime):
-                        end_date = int(end_date.timestamp())
-                    elif isinstance(end_date, (int, float)):
-                        end_date = int(end_date)
-                    elif end_date is None:
-                        end_date = 0
-                    
-                    # created_at может быть TIMESTAMP
-                    if isinstance(created_at, datetime.datetime):
-                        created_at = int(created_at.timestamp())
-                    elif isinstance(created_at, (int, float)):
-                        created_at = int(created_at)
-                    elif created_at is None:
-                        created_at = 0
-                    
-                    if isinstance(updated_at, datetime.datetime):
-                        updated_at = int(updated_at.timestamp())
-                    elif isinstance(updated_at, (int, float)):
-                        updated_at = int(updated_at)
-                    elif updated_at is None:
-                        updated_at = 0
-                    
-                    # Проверяем наличие колонки subscription_level
-                    subscription_level = row.get('subscription_level', 1) or 1
-                    if subscription_level is None:
-                        # Определяем по месяцам если subscription_level отсутствует
-                        months = row.get('months', 0)
-                        if months >= 12:
-                            subscription_level = 3
-                        elif months >= 3:
-                            subscription_level = 2
-                        else:
-                            subscription_level = 1
-                    
-                    subscriptions.append(Subscription(
-                        id=row['id'],
-                        user_id=row['user_id'],
-                        payment_id=row.get('payment_id', ''),
-                        start_date=start_date,
-                        end_date=end_date,
-                        months=row.get('months', 0),
-                        subscription_level=subscription_level,
-                        status=SubscriptionStatus(row['status']),
-                        auto_renew=bool(row.get('auto_renew', False)),
-                        created_at=created_at,
-                        updated_at=updated_at
-                    ))
-                return subscriptions
             finally:
                 await conn.close()
         else:
-            async with aiosqlite.connect(self.db_path) as db:
+            async with sqlite_connect(self.db_path) as db:
                 db.row_factory = aiosqlite.Row
                 cursor = await db.execute('''
                     SELECT * FROM subscriptions
                     WHERE user_id = ?
                     ORDER BY created_at DESC
                 ''', (user_id,))
-
                 rows = await cursor.fetchall()
-                subscriptions = []
-
-                for row in rows:
-                    # Проверяем наличие колонки subscription_level
-                    subscription_level = 1  # По умолчанию
-                    try:
-                        subscription_level = row['subscription_level'] if row['subscription_level'] else 1
-                    except (KeyError, IndexError):
-                        # Колонка отсутствует в старых версиях БД, определяем по месяцам
-                        months = row['months']
-                        if months >= 12:
-                            subscription_level = 3
-                        elif months >= 3:
-                            subscription_level = 2
-                        else:
-                            subscription_level = 1
-                    
-                    subscriptions.append(Subscription(
-                        id=row['id'],
-                        user_id=row['user_id'],
-                        payment_id=row['payment_id'],
-                        start_date=row['start_date'],
-                        end_date=row['end_date'],
-                        months=row['months'],
-                        subscription_level=subscription_level,
-                        status=SubscriptionStatus(row['status']),
-                        auto_renew=bool(row['auto_renew']),
-                        created_at=row['created_at'],
-                        updated_at=row['updated_at']
-                    ))
 
-            return subscriptions
+        return decode_rows(Subscription, rows)
 
     async def update_subscription_status(self, subscription_id: int, status: str):
         """Обновление статуса подписки"""
@@ -1936,7 +2302,7 @@ class Database:
             finally:
                 await conn.close()
         else:
-            async with aiosqlite.connect(self.db_path) as db:
+            async with sqlite_connect(self.db_path) as db:
                 current_time = int(datetime.datetime.now().timestamp())
                 await db.execute('''
                     UPDATE subscriptions
@@ -1948,6 +2314,7 @@ class Database:
 
     async def activate_user_subscription(self, user_id: int, subscription_start: int, subscription_end: int):
         """Активация подписки пользователя"""
+        self._note_user_write(user_id)
         if self.use_postgres:
             conn = await _get_postgres_connection()
             try:
@@ -1956,53 +2323,67 @@ class Database:
                 end_datetime = datetime.datetime.fromtimestamp(subscription_end) if isinstance(subscription_end, int) else subscription_end
                 current_time = datetime.datetime.now()
                 
-                await conn.execute('''
+                referral_code = await conn.fetchval('''
                     UPDATE users
                     SET subscription_active = TRUE, subscription_start = $1, subscription_end = $2, updated_at = $3
                     WHERE telegram_id = $4
+                    RETURNING referral_code
                 ''', start_datetime, end_datetime, current_time, user_id)
                 logger.info(f"Подписка пользователя {user_id} активирована (PostgreSQL)")
             finally:
                 await conn.close()
         else:
-            async with aiosqlite.connect(self.db_path) as db:
-                await db.execute('''
+            async with sqlite_connect(self.db_path) as db:
+                cursor = await db.execute('''
                     UPDATE users
                     SET subscription_active = TRUE, subscription_start = ?, subscription_end = ?, updated_at = CURRENT_TIMESTAMP
                     WHERE telegram_id = ?
+                    RETURNING referral_code
                 ''', (subscription_start, subscription_end, user_id))
+                row = await cursor.fetchone()
+                referral_code = row[0] if row else None
                 await db.commit()
                 logger.info(f"Подписка пользователя {user_id} активирована")
+        if referral_code:
+            self.invalidate_blogger_stats(referral_code)
 
     async def deactivate_user_subscription(self, user_id: int):
         """Деактивация подписки пользователя"""
+        self._note_user_write(user_id)
         if self.use_postgres:
             conn = await _get_postgres_connection()
             try:
                 current_time = datetime.datetime.now()
                 
-                await conn.execute('''
+                referral_code = await conn.fetchval('''
                     UPDATE users
                     SET subscription_active = FALSE, subscription_start = NULL, subscription_end = NULL, updated_at = $1
                     WHERE telegram_id = $2
+                    RETURNING referral_code
                 ''', current_time, user_id)
                 logger.info(f"Подписка пользователя {user_id} деактивирована (PostgreSQL)")
             finally:
                 await conn.close()
         else:
-            async with aiosqlite.connect(self.db_path) as db:
-                await db.execute('''
+            async with sqlite_connect(self.db_path) as db:
+                cursor = await db.execute('''
                     UPDATE users
                     SET subscription_active = FALSE, subscription_start = NULL, subscription_end = NULL, updated_at = CURRENT_TIMESTAMP
                     WHERE telegram_id = ?
+                    RETURNING referral_code
                 ''', (user_id,))
+                row = await cursor.fetchone()
+                referral_code = row[0] if row else None
                 await db.commit()
                 logger.info(f"Подписка пользователя {user_id} деактивирована")
+        if referral_code:
+            self.invalidate_blogger_stats(referral_code)
 
     # Методы для работы со статами игрока
 
     async def save_player_stats(self, stats: PlayerStats) -> int:
         """Сохранение или обновление статов игрока"""
+        self._note_user_write(stats.user_id)
         logger.info(f"Сохранение PlayerStats для user_id={stats.user_id}: strength={stats.strength}, agility={stats.agility}, endurance={stats.endurance}, intelligence={stats.intelligence}, charisma={stats.charisma}")
         
         if self.use_postgres:
@@ -2055,7 +2436,7 @@ class Database:
             finally:
                 await conn.close()
         else:
-            async with aiosqlite.connect(self.db_path) as db:
+            async with sqlite_connect(self.db_path) as db:
                 cursor = await db.execute('''
                     INSERT INTO player_stats (user_id, nickname, experience, strength, agility, endurance, intelligence, charisma, photo_path, card_image_path, created_at, updated_at)
                     VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
@@ -2091,73 +2472,12 @@ class Database:
 
     async def get_player_stats(self, user_id: int) -> Optional[PlayerStats]:
         """Получение статов игрока"""
-        if self.use_postgres:
-            conn = await _get_postgres_connection()
-            try:
-                row = await conn.fetchrow('''
-                    SELECT * FROM player_stats WHERE user_id = $1
-                ''', user_id)
-                
-                if row:
-                    # Преобразуем timestamp в int, если это datetime
-                    created_at = row['created_at']
-                    updated_at = row['updated_at']
-                    if isinstance(created_at, datetime.datetime):
-                        created_at = int(created_at.timestamp())
-                    elif created_at is None:
-                        created_at = 0
-                    if isinstance(updated_at, datetime.datetime):
-                        updated_at = int(updated_at.timestamp())
-                    elif updated_at is None:
-                        updated_at = 0
-                    
-                    stats = PlayerStats(
-                        id=row['id'],
-                        user_id=row['user_id'],
-                        nickname=row['nickname'],
-                        experience=row.get('experience', 0) or 0,
-                        strength=row['strength'],
-                        agility=row['agility'],
-                        endurance=row['endurance'],
-                        intelligence=row['intelligence'],
-                        charisma=row['charisma'],
-                        photo_path=row.get('photo_path'),
-                        card_image_path=row.get('card_image_path'),
-                        created_at=created_at,
-                        updated_at=updated_at
-                    )
-                    logger.info(f"Получены PlayerStats из PostgreSQL для user_id={user_id}: strength={stats.strength}, agility={stats.agility}, endurance={stats.endurance}")
-                    return stats
-                return None
-            finally:
-                await conn.close()
-        else:
-            async with aiosqlite.connect(self.db_path) as db:
-                db.row_factory = aiosqlite.Row
-                cursor = await db.execute('''
-                    SELECT * FROM player_stats WHERE user_id = ?
-                ''', (user_id,))
-
-                row = await cursor.fetchone()
-                if row:
-                    stats = PlayerStats(
-                        id=row['id'],
-                        user_id=row['user_id'],
-                        nickname=row['nickname'],
-                        experience=row['experience'],
-                        strength=row['strength'],
-                        agility=row['agility'],
-                        endurance=row['endurance'],
-                        intelligence=row['intelligence'],
-                        charisma=row['charisma'],
-                        photo_path=row['photo_path'],
-                        card_image_path=row['card_image_path'],
-                        created_at=row['created_at'],
-                        updated_at=row['updated_at']
-                    )
-                    logger.info(f"Получены PlayerStats из SQLite для user_id={user_id}: strength={stats.strength}, agility={stats.agility}, endurance={stats.endurance}")
-                    return stats
-                return None
+        row = await self.queries.fetchrow(_Q_PLAYER_STATS, user_id)
+        if not row:
+            return None
+        stats = decode_row(PlayerStats, row)
+        logger.info(f"Получены PlayerStats для user_id={user_id}: strength={stats.strength}, agility={stats.agility}, endurance={stats.endurance}")
+        return stats
 
     # Методы для работы с ежедневными заданиями
 
@@ -2206,7 +2526,7 @@ class Database:
             finally:
                 await conn.close()
         else:
-            async with aiosqlite.connect(self.db_path) as db:
+            async with sqlite_connect(self.db_path) as db:
                 cursor = await db.execute('''
                     INSERT INTO daily_tasks (user_id, task_description, created_at, expires_at, status, completed_at, submitted_media_path, moderator_comment)
                     VALUES (?, ?, ?, ?, ?, ?, ?, ?)
@@ -2233,95 +2553,210 @@ class Database:
                 # Конвертируем текущее время в datetime для PostgreSQL
                 current_time = datetime.datetime.now()
                 
+                # task_description дублируется в конце выборки: если он пуст, берется старая колонка task
                 row = await conn.fetchrow('''
-                    SELECT * FROM daily_tasks
+                    SELECT *, COALESCE(task_description, task, '') AS task_description FROM daily_tasks
                     WHERE user_id = $1 AND status IN ('pending', 'submitted') 
                     AND (expires_at IS NULL OR expires_at > $2)
+                    AND created_at >= $3
                     ORDER BY created_at DESC
                     LIMIT 1
-                ''', user_id, current_time)
-                
-                if row:
-                    # Конвертируем datetime в timestamp если нужно
-                    created_at = row['created_at']
-                    expires_at = row.get('expires_at')
-                    completed_at = row.get('completed_at')
-                    
-                    if isinstance(created_at, datetime.datetime):
-                        created_at = int(created_at.timestamp())
-                    elif created_at is None:
-                        created_at = 0
-                    
-                    if expires_at and isinstance(expires_at, datetime.datetime):
-                        expires_at = int(expires_at.timestamp())
-                    elif expires_at is None:
-                        expires_at = None
-                    
-                    if completed_at and isinstance(completed_at, datetime.datetime):
-                        completed_at = int(completed_at.timestamp())
-                    elif completed_at is None:
-                        completed_at = None
-                    
-                    # Используем task_description если есть, иначе task (для обратной совместимости)
-                    task_description = row.get('task_description') or row.get('task', '')
-                    
-                    return DailyTask(
-                        id=row['id'],
-                        user_id=row['user_id'],
-                        task_description=task_description,
-                        created_at=created_at,
-                        expires_at=expires_at,
-                        status=TaskStatus(row['status']),
-                        completed_at=completed_at,
-                        submitted_media_path=row.get('submitted_media_path'),
-                        moderator_comment=row.get('moderator_comment')
-                    )
-                return None
+                ''', user_id, current_time, current_time - datetime.timedelta(seconds=_ACTIVE_TASK_MAX_AGE))
             finally:
                 await conn.close()
         else:
-            async with aiosqlite.connect(self.db_path) as db:
+            async with sqlite_connect(self.db_path) as db:
                 db.row_factory = aiosqlite.Row
+                current_time = int(datetime.datetime.now().timestamp())
                 cursor = await db.execute('''
                     SELECT * FROM daily_tasks
                     WHERE user_id = ? AND status IN ('pending', 'submitted') AND expires_at > ?
+                    AND created_at >= ?
                     ORDER BY created_at DESC
                     LIMIT 1
-                ''', (user_id, int(datetime.datetime.now().timestamp())))
-
+                ''', (user_id, current_time, current_time - _ACTIVE_TASK_MAX_AGE))
                 row = await cursor.fetchone()
-                if row:
-                    return DailyTask(
-                        id=row['id'],
-                        user_id=row['user_id'],
-                        task_description=row['task_description'],
-                        created_at=row['created_at'],
-                        expires_at=row['expires_at'],
-                        status=TaskStatus(row['status']),
-                        completed_at=row['completed_at'],
-                        submitted_media_path=row['submitted_media_path'],
-                        moderator_comment=row['moderator_comment']
-                    )
-                return None
 
-    async def submit_daily_task_media(self, task_id: int, media_path: str) -> bool:
-        """Отправить медиафайл для задания на модерацию"""
-        async with aiosqlite.connect(self.db_path) as db:
-            cursor = await db.execute('''
-                UPDATE daily_tasks
-                SET status = 'submitted', submitted_media_path = ?
-                WHERE id = ? AND status = 'pending'
-            ''', (media_path, task_id))
+        return decode_row(DailyTask, row) if row else None
+
+    async def get_user_daily_tasks(self, user_id: int, limit: int = 30) -> list[DailyTask]:
+        """Последние задания пользователя, включая перенесенные в архив"""
+        rows = await self.queries.fetch(_Q_USER_TASK_HISTORY, user_id, limit)
+        return decode_rows(DailyTask, rows)
+
+    async def expire_daily_tasks(self, submission_ttl: int = 7 * 24 * 60 * 60, batch_size: int = 1000) -> int:
+        """
+        Перевод истекших заданий в статус expired пачками по batch_size.
+        Невыполненные задания истекают сразу по expires_at, отправленные на проверку -
+        через submission_ttl секунд после него, если их так и не проверили.
+        Возвращает количество истекших заданий.
+        """
+        now = int(datetime.datetime.now().timestamp())
+        stale_before = now - submission_ttl
+        if self.use_postgres:
+            # В PostgreSQL expires_at и claimed_until имеют тип TIMESTAMP
+            args = (datetime.datetime.fromtimestamp(now), datetime.datetime.fromtimestamp(stale_before),
+                    datetime.datetime.fromtimestamp(now))
+        else:
+            args = (now, stale_before, now)
+
+        total = 0
+        while True:
+            # Короткие транзакции, чтобы не держать блокировку записи на весь проход
+            expired = await self.queries.execute(_Q_EXPIRE_DAILY_TASKS, *args, batch_size)
+            total += expired
+            if expired < batch_size:
+                break
+        if total:
+            logger.info(f"Истекших заданий переведено в статус expired: {total}")
+        return total
+
+    async def get_expired_task_media(self, limit: int = 500) -> list[tuple[int, str]]:
+        """Медиафайлы истекших заданий, которые еще не удалены: [(task_id, путь), ...]"""
+        rows = await self.queries.fetch(_Q_EXPIRED_TASK_MEDIA, limit)
+        return [(row['id'], row['submitted_media_path']) for row in rows]
+
+    async def clear_task_media(self, task_ids: list[int]):
+        """Очистка ссылок на удаленные медиафайлы заданий"""
+        if task_ids:
+            await self.queries.execute_many([(_Q_CLEAR_TASK_MEDIA, (task_id,)) for task_id in task_ids])
+
+    async def delete_expired_task_media(self, batch_size: int = 500) -> int:
+        """
+        Удаление медиафайлов истекших заданий пачками по batch_size.
+        Ссылка на файл очищается только после удаления (или если файла уже нет), поэтому после
+        сбоя удаление повторится при следующем запуске. Возвращает количество очищенных ссылок.
+        """
+        total = 0
+        while True:
+            media = await self.get_expired_task_media(limit=batch_size)
+            removed = []
+            for task_id, media_path in media:
+                try:
+                    os.remove(media_path)
+                except FileNotFoundError:
+                    pass
+                except OSError as e:
+                    logger.error(f"Не удалось удалить медиафайл {media_path} задания {task_id}: {e}")
+                    continue
+                removed.append(task_id)
+            await self.clear_task_media(removed)
+            total += len(removed)
+            if len(media) < batch_size or not removed:
+                break
+        if total:
+            logger.info(f"Удалено медиафайлов истекших заданий: {total}")
+        return total
+
+    async def archive_old_records(self, retention_days: Optional[int] = None, batch_size: int = 500,
+                                  pause: float = 0.05) -> dict:
+        """
+        Перенос завершенных заданий и отправленных уведомлений старше retention_days дней
+        (по умолчанию self.retention_days) в таблицы *_archive. Неотправленные уведомления
+        старше срока сначала помечаются просроченными. Каждая пачка из batch_size строк
+        переносится отдельной короткой транзакцией, между пачками - пауза pause секунд, чтобы
+        не задерживать запись ботов. При секционировании PostgreSQL вместо этого удаляются
+        месячные секции старше срока. Возвращает количество перенесенных строк:
+        {'daily_tasks', 'notifications'}.
+        """
+        now = int(datetime.datetime.now().timestamp())
+        cutoff = now - (retention_days or self.retention_days) * 24 * 60 * 60
+        await self.expire_stale_notifications(cutoff)
+        # В PostgreSQL daily_tasks.created_at имеет тип TIMESTAMP, notifications.created_at - BIGINT
+        task_cutoff = datetime.datetime.fromtimestamp(cutoff) if self.use_postgres else cutoff
+
+        moved = {}
+        if self.use_postgres and POSTGRES_PARTITIONING:
+            conn = await _get_postgres_connection()
+            try:
+                for table in PARTITIONED_TABLES:
+                    moved[table.name] = await drop_expired_partitions(conn, table, task_cutoff, now)
+            finally:
+                await conn.close()
+            if any(moved.values()):
+                await self.optimize_after_archive()
+            return moved
+
+        for table, archive_query, delete_query, table_cutoff in (
+            ('daily_tasks', _Q_ARCHIVE_DAILY_TASKS, _Q_DELETE_ARCHIVED_DAILY_TASKS, task_cutoff),
+            ('notifications', _Q_ARCHIVE_NOTIFICATIONS, _Q_DELETE_ARCHIVED_NOTIFICATIONS, cutoff),
+        ):
+            total = 0
+            while True:
+                batch = await self.queries.execute_many([
+                    (archive_query, (now, table_cutoff, batch_size)),
+                    (delete_query, (table_cutoff, batch_size)),
+                ])
+                total += batch
+                if batch < batch_size:
+                    break
+                await asyncio.sleep(pause)
+            moved[table] = total
+
+        if any(moved.values()):
+            logger.info(f"Перенесено в архив: заданий {moved['daily_tasks']}, уведомлений {moved['notifications']}")
+            await self.optimize_after_archive()
+        return moved
+
+    async def expire_stale_notifications(self, cutoff: int) -> int:
+        """Пометка неотправленных уведомлений, созданных раньше cutoff, просроченными"""
+        expired = await self.queries.execute(_Q_EXPIRE_STALE_NOTIFICATIONS, cutoff)
+        if expired:
+            logger.warning(f"Помечено просроченными неотправленных уведомлений: {expired}")
+        return expired
+
+    async def maintain_partitions(self) -> list[str]:
+        """Создание секций PostgreSQL на POSTGRES_PARTITION_PREMAKE_MONTHS месяцев вперед"""
+        if not (self.use_postgres and POSTGRES_PARTITIONING):
+            return []
+        conn = await _get_postgres_connection()
+        try:
+            created = []
+            for table in PARTITIONED_TABLES:
+                created += await ensure_partitions(conn, table, POSTGRES_PARTITION_PREMAKE_MONTHS)
+            return created
+        finally:
+            await conn.close()
+
+    async def optimize_after_archive(self, vacuum_free_ratio: float = 0.2):
+        """
+        Обслуживание после переноса в архив: обновление статистики планировщика и
+        освобождение места. SQLite переписывает файл (VACUUM) только если свободные страницы
+        составляют не меньше vacuum_free_ratio от файла - VACUUM блокирует запись на все время работы.
+        """
+        tables = ('daily_tasks', 'notifications', 'daily_tasks_archive', 'notifications_archive')
+        if self.use_postgres:
+            # VACUUM нельзя выполнять внутри транзакции, поэтому отдельное соединение
+            conn = await _get_postgres_connection()
+            try:
+                await conn.execute('VACUUM (ANALYZE) daily_tasks, notifications')
+                await conn.execute('ANALYZE daily_tasks_archive, notifications_archive')
+            finally:
+                await conn.close()
+            return
+
+        async with sqlite_connect(self.db_path) as db:
+            for table in tables:
+                await db.execute(f'ANALYZE {table}')
             await db.commit()
+            cursor = await db.execute('PRAGMA freelist_count')
+            free_pages = (await cursor.fetchone())[0]
+            cursor = await db.execute('PRAGMA page_count')
+            total_pages = (await cursor.fetchone())[0]
+            if total_pages and free_pages / total_pages >= vacuum_free_ratio:
+                await db.execute('VACUUM')
+                logger.info(f"VACUUM выполнен: освобождено страниц {free_pages} из {total_pages}")
 
-            if cursor.rowcount > 0:
-                logger.info(f"Медиафайл для задания {task_id} отправлен на модерацию")
-                return True
-            return False
+    async def submit_daily_task_media(self, task_id: int, media_path: str) -> bool:
+        """Отправить медиафайл для задания на модерацию"""
+        if await self.queries.execute(_Q_SUBMIT_TASK_MEDIA, media_path, task_id) > 0:
+            logger.info(f"Медиафайл для задания {task_id} отправлен на модерацию")
+            return True
+        return False
 
     async def approve_daily_task(self, task_id: int, moderator_comment: str = None) -> bool:
         """Одобрить задание модератором"""
-        async with aiosqlite.connect(self.db_path) as db:
+        async with sqlite_connect(self.db_path) as db:
             current_time = int(datetime.datetime.now().timestamp())
             cursor = await db.execute('''
                 UPDATE daily_tasks
@@ -2337,7 +2772,7 @@ class Database:
 
     async def reject_daily_task(self, task_id: int, moderator_comment: str) -> bool:
         """Отклонить задание модератором"""
-        async with aiosqlite.connect(self.db_path) as db:
+        async with sqlite_connect(self.db_path) as db:
             cursor = await db.execute('''
                 UPDATE daily_tasks
                 SET status = 'rejected', moderator_comment = ?
@@ -2352,7 +2787,7 @@ class Database:
 
     async def get_pending_moderation_tasks(self) -> list[DailyTask]:
         """Получить задания, ожидающие модерации"""
-        async with aiosqlite.connect(self.db_path) as db:
+        async with sqlite_connect(self.db_path) as db:
             db.row_factory = aiosqlite.Row
             cursor = await db.execute('''
                 SELECT * FROM daily_tasks
@@ -2361,27 +2796,13 @@ class Database:
             ''')
 
             rows = await cursor.fetchall()
-            tasks = []
-
-            for row in rows:
-                tasks.append(DailyTask(
-                    id=row['id'],
-                    user_id=row['user_id'],
-                    task_description=row['task_description'],
-                    created_at=row['created_at'],
-                    expires_at=row['expires_at'],
-                    status=TaskStatus(row['status']),
-                    completed_at=row['completed_at'],
-                    submitted_media_path=row['submitted_media_path'],
-                    moderator_comment=row['moderator_comment']
-                ))
-
-            return tasks
+            return decode_rows(DailyTask, rows)
 
     # Методы для работы со статистикой пользователей
 
     async def save_user_stats(self, stats: UserStats):
         """Сохранение или обновление статистики пользователя"""
+        self._note_user_write(stats.user_id)
         if self.use_postgres:
             conn = await _get_postgres_connection()
             try:
@@ -2413,7 +2834,7 @@ class Database:
             finally:
                 await conn.close()
         else:
-            async with aiosqlite.connect(self.db_path) as db:
+            async with sqlite_connect(self.db_path) as db:
                 await db.execute('''
                     INSERT INTO user_stats (user_id, level, experience, rank, referral_rank, current_streak, best_streak, total_tasks_completed, last_task_date)
                     VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
@@ -2442,100 +2863,93 @@ class Database:
 
     async def get_user_stats(self, user_id: int) -> Optional[UserStats]:
         """Получение статистики пользователя"""
+        row = await self.queries.fetchrow(_Q_USER_STATS, user_id)
+        return _decode_user_stats(row) if row else None
+
+    async def backfill_streaks(self, batch_size: int = 1000) -> int:
+        """
+        Разовый пересчет стриков по истории одобренных заданий (после включения инкрементального
+        подсчета или исправления данных). Один проход по заданиям в порядке (пользователь, время),
+        результаты записываются пачками по batch_size. Возвращает число обновленных пользователей.
+        """
+        query = '''
+            SELECT dt.user_id, dt.created_at, u.timezone
+            FROM daily_tasks_history dt
+            JOIN user_stats us ON us.user_id = dt.user_id
+            LEFT JOIN users u ON u.telegram_id = dt.user_id
+            WHERE dt.status = 'approved'
+            ORDER BY dt.user_id, dt.created_at
+        '''
+        reset_query = 'UPDATE user_stats SET current_streak = 0, best_streak = 0'
+        update_query = 'UPDATE user_stats SET current_streak = ?, best_streak = ?, last_task_date = ? WHERE user_id = ?'
+
+        # (user_id, состояние, часовой пояс) по пользователям, встреченным в истории
+        results: list[tuple[int, StreakState, Optional[str]]] = []
         if self.use_postgres:
             conn = await _get_postgres_connection()
             try:
-                row = await conn.fetchrow('''
-                    SELECT * FROM user_stats WHERE user_id = $1
-                ''', user_id)
-                
-                if row:
-                    return UserStats(
-                        user_id=row['user_id'],
-                        level=row['level'],
-                        experience=row['experience'],
-                        rank=Rank(row['rank']),
-                        referral_rank=Rank(row['referral_rank']) if row['referral_rank'] else None,
-                        current_streak=row['current_streak'],
-                        best_streak=row['best_streak'],
-                        total_tasks_completed=row['total_tasks_completed'],
-                        last_task_date=row['last_task_date']
-                    )
-                return None
+                async with conn.transaction():
+                    async for row in conn.cursor(query, prefetch=batch_size):
+                        if not results or results[-1][0] != row['user_id']:
+                            results.append((row['user_id'], StreakState(), row['timezone']))
+                        created_at = row['created_at']
+                        if created_at is not None:
+                            results[-1][1].advance(int(created_at.timestamp()), row['timezone'])
+
+                async with conn.transaction():
+                    await conn.execute(reset_query)
+                    # В PostgreSQL last_task_date хранится как DATE - записываем локальный день пользователя
+                    for start in range(0, len(results), batch_size):
+                        await conn.executemany(Query(update_query).sql(True), [
+                            (state.current, state.best,
+                             local_day(state.last_task_date, timezone) if state.last_task_date else None, user_id)
+                            for user_id, state, timezone in results[start:start + batch_size]
+                        ])
             finally:
                 await conn.close()
         else:
-            async with aiosqlite.connect(self.db_path) as db:
-                db.row_factory = aiosqlite.Row
-                cursor = await db.execute('''
-                    SELECT * FROM user_stats WHERE user_id = ?
-                ''', (user_id,))
+            async with sqlite_connect(self.db_path) as db:
+                async with db.execute(query) as cursor:
+                    async for user_id, created_at, timezone in cursor:
+                        if not results or results[-1][0] != user_id:
+                            results.append((user_id, StreakState(), timezone))
+                        if created_at:
+                            results[-1][1].advance(created_at, timezone)
+
+                await db.execute(reset_query)
+                for start in range(0, len(results), batch_size):
+                    await db.executemany(update_query, [
+                        (state.current, state.best, state.last_task_date, user_id)
+                        for user_id, state, timezone in results[start:start + batch_size]
+                    ])
+                await db.commit()
 
-                row = await cursor.fetchone()
-                if row:
-                    return UserStats(
-                        user_id=row['user_id'],
-                        level=row['level'],
-                        experience=row['experience'],
-                        rank=Rank(row['rank']),
-                        referral_rank=Rank(row['referral_rank']) if row['referral_rank'] else None,
-                        current_streak=row['current_streak'],
-                        best_streak=row['best_streak'],
-                        total_tasks_completed=row['total_tasks_completed'],
-                        last_task_date=row['last_task_date']
-                    )
-                return None
+        logger.info(f"Стрики пересчитаны по истории заданий, пользователей с выполненными заданиями: {len(results)}")
+        return len(results)
 
-    async def get_top_users_by_city(self, city: str, limit: int = 10) -> list[tuple]:
+    async def get_top_users_by_city(self, city: str, limit: int = 10,
+                                    viewer_id: Optional[int] = None) -> list[tuple]:
         """Получение топ пользователей по городу (по уровню)"""
-        async with aiosqlite.connect(self.db_path) as db:
-            cursor = await db.execute('''
-                SELECT u.name, us.level, us.experience, us.rank
-                FROM users u
-                JOIN user_stats us ON u.telegram_id = us.user_id
-                WHERE u.city = ? AND u.subscription_active = TRUE
-                ORDER BY us.level DESC, us.experience DESC
-                LIMIT ?
-            ''', (city, limit))
-
-            rows = await cursor.fetchall()
-            return [(row[0], row[1], row[2], row[3]) for row in rows]
+        rows = await self.queries.fetch(_Q_TOP_BY_CITY, city, limit, replica=self._replica_allowed(viewer_id))
+        return [(row[0], row[1], row[2], row[3]) for row in rows]
 
-    async def get_top_users_by_rank(self, rank: str, limit: int = 10) -> list[tuple]:
+    async def get_top_users_by_rank(self, rank: str, limit: int = 10,
+                                    viewer_id: Optional[int] = None) -> list[tuple]:
         """Получение топ пользователей по рангу"""
-        async with aiosqlite.connect(self.db_path) as db:
-            cursor = await db.execute('''
-                SELECT u.name, us.level, us.experience, u.city
-                FROM users u
-                JOIN user_stats us ON u.telegram_id = us.user_id
-                WHERE us.rank = ? AND u.subscription_active = TRUE
-                ORDER BY us.level DESC, us.experience DESC
-                LIMIT ?
-            ''', (rank, limit))
-
-            rows = await cursor.fetchall()
-            return [(row[0], row[1], row[2], row[3]) for row in rows]
+        rows = await self.queries.fetch(_Q_TOP_BY_RANK, rank, limit, replica=self._replica_allowed(viewer_id))
+        return [(row[0], row[1], row[2], row[3]) for row in rows]
 
-    async def get_top_users_by_referral_code(self, referral_code: str, limit: int = 10) -> list[tuple]:
+    async def get_top_users_by_referral_code(self, referral_code: str, limit: int = 10,
+                                             viewer_id: Optional[int] = None) -> list[tuple]:
         """Получение топ пользователей среди подписчиков блогера (по реферальному коду)"""
-        async with aiosqlite.connect(self.db_path) as db:
-            cursor = await db.execute('''
-                SELECT u.name, us.level, us.experience, us.referral_rank, u.city
-                FROM users u
-                JOIN user_stats us ON u.telegram_id = us.user_id
-                WHERE u.referral_code = ? AND u.subscription_active = TRUE
-                ORDER BY us.level DESC, us.experience DESC
-                LIMIT ?
-            ''', (referral_code, limit))
-
-            rows = await cursor.fetchall()
-            return [(row[0], row[1], row[2], row[3], row[4]) for row in rows]
+        rows = await self.queries.fetch(_Q_TOP_BY_REFERRAL_CODE, referral_code, limit, replica=self._replica_allowed(viewer_id))
+        return [(row[0], row[1], row[2], row[3], row[4]) for row in rows]
 
-    async def get_top_users_by_subscription_level(self, subscription_level: int, limit: int = 10) -> list[tuple]:
+    async def get_top_users_by_subscription_level(self, subscription_level: int, limit: int = 10,
+                                                  viewer_id: Optional[int] = None) -> list[tuple]:
         """Получение топ пользователей по уровню подписки"""
         if self.use_postgres:
-            conn = await _get_postgres_connection()
-            try:
+            async with self.queries.acquire(replica=self._replica_allowed(viewer_id)) as conn:
                 rows = await conn.fetch('''
                     SELECT u.name, us.level, us.experience, us.rank, u.city
                     FROM users u
@@ -2549,10 +2963,8 @@ class Database:
                 ''', subscription_level, int(datetime.datetime.now().timestamp()), limit)
                 
                 return [(row['name'], row['level'], row['experience'], row['rank'], row['city']) for row in rows]
-            finally:
-                await conn.close()
         else:
-            async with aiosqlite.connect(self.db_path) as db:
+            async with sqlite_connect(self.db_path) as db:
                 cursor = await db.execute('''
                     SELECT u.name, us.level, us.experience, us.rank, u.city
                     FROM users u
@@ -2571,26 +2983,7 @@ class Database:
 
     async def get_user_rating_position(self, user_id: int) -> int:
         """Получение позиции пользователя в общем рейтинге (по уровню и опыту)"""
-        async with aiosqlite.connect(self.db_path) as db:
-            # Получаем статистику пользователя
-            user_stats = await self.get_user_stats(user_id)
-            if not user_stats:
-                return 0
-            
-            # Подсчитываем количество пользователей с лучшими показателями
-            cursor = await db.execute('''
-                SELECT COUNT(*) + 1 as position
-                FROM user_stats us
-                JOIN users u ON us.user_id = u.telegram_id
-                WHERE u.subscription_active = 1
-                AND (
-                    us.level > ? OR 
-                    (us.level = ? AND us.experience > ?)
-                )
-            ''', (user_stats.level, user_stats.level, user_stats.experience))
-            
-            row = await cursor.fetchone()
-            return row[0] if row else 0
+        return await self.queries.fetchval(_Q_RATING_POSITION, user_id) or 0
 
     async def update_user_referral_rank(self, user_id: int):
         """Обновление рейтинга среди подписчиков блогера для пользователя"""
@@ -2613,23 +3006,109 @@ class Database:
 
     async def reset_user_experience(self, user_id: int):
         """Сброс опыта пользователя до 0"""
-        async with aiosqlite.connect(self.db_path) as db:
-            # Сбрасываем опыт в user_stats
-            await db.execute('''
-                UPDATE user_stats
-                SET experience = 0, level = 1, rank = 'F', updated_at = ?
-                WHERE user_id = ?
-            ''', (int(datetime.datetime.now().timestamp()), user_id))
-            
-            # Сбрасываем опыт в player_stats
-            await db.execute('''
-                UPDATE player_stats
-                SET experience = 0, updated_at = ?
-                WHERE user_id = ?
-            ''', (int(datetime.datetime.now().timestamp()), user_id))
-            
-            await db.commit()
-            logger.info(f"Опыт пользователя {user_id} сброшен до 0")
+        self._note_user_write(user_id)
+        # Сбрасываем опыт в user_stats и player_stats одной транзакцией
+        await self.queries.execute_many([
+            (_Q_RESET_USER_STATS_EXPERIENCE, (user_id,)),
+            (_Q_RESET_PLAYER_EXPERIENCE, (int(datetime.datetime.now().timestamp()), user_id)),
+        ])
+        logger.info(f"Опыт пользователя {user_id} сброшен до 0")
+
+    async def queue_subscription_warnings(self, days_before: int = 3) -> int:
+        """
+        Предупреждения об окончании подписки: подписки, истекающие в ближайшие days_before дней
+        и еще не предупрежденные, отмечаются warned_at, а уведомления ставятся в очередь
+        отправки - в одной транзакции, поэтому предупреждение не дублируется и не теряется.
+        Возвращает количество поставленных предупреждений.
+        """
+        now = int(datetime.datetime.now().timestamp())
+        args = (now, now, now + days_before * 24 * 60 * 60)
+
+        if self.use_postgres:
+            conn = await _get_postgres_connection()
+            try:
+                async with conn.transaction():
+                    rows = await conn.fetch(_Q_CLAIM_SUBSCRIPTION_WARNINGS.sql(True), *args)
+                    if rows:
+                        await conn.executemany(_Q_INSERT_NOTIFICATION.sql(True), [
+                            self._subscription_warning_notification(row['user_id'], row['end_date'], now)
+                            for row in rows
+                        ])
+            finally:
+                await conn.close()
+        else:
+            async with sqlite_connect(self.db_path) as db:
+                try:
+                    cursor = await db.execute(_Q_CLAIM_SUBSCRIPTION_WARNINGS.sql(False), args)
+                    rows = await cursor.fetchall()
+                    if rows:
+                        await db.executemany(_Q_INSERT_NOTIFICATION.sql(False), [
+                            self._subscription_warning_notification(user_id, end_date, now)
+                            for user_id, end_date in rows
+                        ])
+                    await db.commit()
+                except Exception:
+                    await db.rollback()
+                    raise
+
+        if rows:
+            logger.info(f"Поставлено в очередь предупреждений об окончании подписки: {len(rows)}")
+        return len(rows)
+
+    async def expire_subscriptions(self) -> dict:
+        """
+        Завершение истекших подписок одной транзакцией: статус subscriptions -> 'expired',
+        снятие users.subscription_active у пользователей без действующих подписок
+        и уведомления им в очередь отправки.
+        Возвращает {'subscriptions': число подписок, 'users': число пользователей}.
+        """
+        now = int(datetime.datetime.now().timestamp())
+
+        if self.use_postgres:
+            conn = await _get_postgres_connection()
+            try:
+                async with conn.transaction():
+                    result = await conn.execute('''
+                        UPDATE subscriptions
+                        SET status = 'expired'
+                        WHERE status = 'active' AND end_date <= $1
+                    ''', now)
+                    expired_count = int(result.split()[-1])
+                    rows = await conn.fetch(
+                        _Q_DEACTIVATE_EXPIRED_USERS.sql(True), datetime.datetime.fromtimestamp(now), now
+                    )
+                    if rows:
+                        await conn.executemany(_Q_INSERT_NOTIFICATION.sql(True), [
+                            self._subscription_expired_notification(row['telegram_id'], now) for row in rows
+                        ])
+            finally:
+                await conn.close()
+        else:
+            async with sqlite_connect(self.db_path) as db:
+                try:
+                    cursor = await db.execute('''
+                        UPDATE subscriptions
+                        SET status = 'expired', updated_at = ?
+                        WHERE status = 'active' AND end_date <= ?
+                    ''', (now, now))
+                    expired_count = cursor.rowcount
+                    cursor = await db.execute(_Q_DEACTIVATE_EXPIRED_USERS.sql(False), (now, now))
+                    rows = await cursor.fetchall()
+                    if rows:
+                        await db.executemany(_Q_INSERT_NOTIFICATION.sql(False), [
+                            self._subscription_expired_notification(row[0], now) for row in rows
+                        ])
+                    await db.commit()
+                except Exception:
+                    await db.rollback()
+                    raise
+
+        for row in rows:
+            if row[1]:
+                self.invalidate_blogger_stats(row[1])
+        if expired_count or rows:
+            logger.info(f"Завершено истекших подписок: {expired_count}, снята подписка у пользователей: {len(rows)}")
+        return {'subscriptions': expired_count, 'users': len(rows)}
 
     async def get_subscriptions_expiring_soon(self, days_before: int = 3) -> list[dict]:
         """Получение подписок, которые истекают через указанное количество дней"""
@@ -2666,7 +3145,7 @@ class Database:
             finally:
                 await conn.close()
         else:
-            async with aiosqlite.connect(self.db_path) as db:
+            async with sqlite_connect(self.db_path) as db:
                 db.row_factory = aiosqlite.Row
                 current_time = int(datetime.datetime.now().timestamp())
                 target_time = current_time + (days_before * 24 * 60 * 60)
@@ -2709,9 +3188,21 @@ class Database:
                     })
                 return result
 
+    def _active_subscriber_from_row(self, row) -> dict:
+        """Преобразование строки выборки активных подписчиков в словарь"""
+        last_task_date = row['last_task_date']
+        # В PostgreSQL last_task_date хранится как DATE
+        if isinstance(last_task_date, date):
+            last_task_date = int(datetime.datetime(last_task_date.year, last_task_date.month, last_task_date.day).timestamp())
+        return {
+            'user_id': row['telegram_id'],
+            'subscription_level': row['subscription_level'] or 1,
+            'last_task_date': last_task_date
+        }
+
     async def get_all_active_subscribed_users(self) -> list[dict]:
         """Получение всех пользователей с активной подпиской"""
-        async with aiosqlite.connect(self.db_path) as db:
+        async with sqlite_connect(self.db_path) as db:
             db.row_factory = aiosqlite.Row
             current_time = int(datetime.datetime.now().timestamp())
             # Получаем пользователей с активной подпиской, используя самую актуальную подписку
@@ -2737,43 +3228,65 @@ class Database:
             ''', (current_time, current_time))
             
             rows = await cursor.fetchall()
-            result = []
-            for row in rows:
-                # Проверяем наличие колонки subscription_level
-                subscription_level = 1  # По умолчанию
-                try:
-                    subscription_level = row['subscription_level'] if row['subscription_level'] else 1
-                except (KeyError, IndexError):
-                    # Колонка отсутствует в старых версиях БД, определяем по месяцам
-                    try:
-                        months = row['months']
-                        if months >= 12:
-                            subscription_level = 3
-                        elif months >= 3:
-                            subscription_level = 2
-                        else:
-                            subscription_level = 1
-                    except (KeyError, IndexError):
-                        subscription_level = 1
-                
-                result.append({
-                    'user_id': row['telegram_id'],
-                    'subscription_level': subscription_level,
-                    'last_task_date': row['last_task_date']
-                })
-            return result
-
-    # Методы для работы с рангами
-
-    async def get_user_rank_info(self, user_id: int) -> dict | None:
-        """Получение детальной информации о ранге пользователя"""
-        from rank_config import get_rank_progress, get_next_rank_experience, RANK_NAMES, RANK_DESCRIPTIONS, RANK_EMOJIS
-
-        user_stats = await self.get_user_stats(user_id)
-        if not user_stats:
-            return None
+            return [self._active_subscriber_from_row(row) for row in rows]
 
-        current_rank, exp_in_rank, exp_to_next, progress_percent = get_rank_progress(user_stats.experience)
+    async def iter_active_subscribers(self, batch_size: Optional[int] = None) -> AsyncIterator[dict]:
+        """
+        Потоковый обход пользователей с активной подпиской (в порядке telegram_id).
+        Возвращает те же словари, что и get_all_active_subscribed_users.
+        """
+        current_time = int(datetime.datetime.now().timestamp())
+        if self.use_postgres:
+            # В PostgreSQL уровень подписки хранится в users
+            rows = self._iter_postgres_keyset('''
+                SELECT u.telegram_id, u.subscription_level, us.last_task_date
+                FROM users u
+                LEFT JOIN user_stats us ON u.telegram_id = us.user_id
+                WHERE u.subscription_active = TRUE
+                AND EXISTS (
+                    SELECT 1 FROM subscriptions s
+                    WHERE s.user_id = u.telegram_id AND s.status = 'active' AND s.end_date > $1
+                )
+                AND u.telegram_id > $2
+                ORDER BY u.telegram_id
+                LIMIT $3
+            ''', (current_time,), 'telegram_id', batch_size)
+        else:
+            rows = self._iter_sqlite_keyset('''
+                SELECT
+                    u.telegram_id,
+                    s.subscription_level,
+                    us.last_task_date
+                FROM users u
+                JOIN subscriptions s ON u.telegram_id = s.user_id
+                LEFT JOIN user_stats us ON u.telegram_id = us.user_id
+                WHERE u.subscription_active = 1
+                AND s.id = (
+                    SELECT id FROM subscriptions s2
+                    WHERE s2.user_id = u.telegram_id
+                    AND s2.status = 'active'
+                    AND s2.end_date > ?
+                    ORDER BY s2.end_date DESC
+                    LIMIT 1
+                )
+                AND u.telegram_id > ?
+                ORDER BY u.telegram_id
+                LIMIT ?
+            ''', (current_time,), 'telegram_id', batch_size)
+        async for row in rows:
+            yield self._active_subscriber_from_row(row)
+
+    # Методы для работы с рангами
+
+    async def get_user_rank_info(self, user_id: int) -> dict | None:
+        """Получение детальной информации о ранге пользователя"""
+        from rank_config import get_rank_progress, get_next_rank_experience, RANK_NAMES, RANK_DESCRIPTIONS, RANK_EMOJIS
+
+        user_stats = await self.get_user_stats(user_id)
+        if not user_stats:
+            return None
+
+        current_rank, exp_in_rank, exp_to_next, progress_percent = get_rank_progress(user_stats.experience)
 
         next_rank_info = get_next_rank_experience(user_stats.experience)
 
@@ -2792,41 +3305,19 @@ class Database:
 
     async def get_users_by_rank_distribution(self) -> dict:
         """Получение распределения пользователей по рангам"""
-        async with aiosqlite.connect(self.db_path) as db:
-            cursor = await db.execute('''
-                SELECT us.rank, COUNT(*) as count
-                FROM user_stats us
-                JOIN users u ON us.user_id = u.telegram_id
-                WHERE u.subscription_active = 1
-                GROUP BY us.rank
-                ORDER BY count DESC
-            ''')
-
-            rows = await cursor.fetchall()
-            return {row[0]: row[1] for row in rows}
+        rows = await self.queries.fetch(_Q_RANK_DISTRIBUTION, replica=True)
+        return {row[0]: row[1] for row in rows}
 
     async def get_rank_achievement_stats(self) -> list[tuple]:
         """Статистика достижений рангов (сколько пользователей достигло каждого ранга)"""
-        async with aiosqlite.connect(self.db_path) as db:
-            cursor = await db.execute('''
-                SELECT us.rank, COUNT(*) as count,
-                       AVG(us.experience) as avg_experience,
-                       MAX(us.experience) as max_experience
-                FROM user_stats us
-                JOIN users u ON us.user_id = u.telegram_id
-                WHERE u.subscription_active = 1
-                GROUP BY us.rank
-                ORDER BY us.rank
-            ''')
-
-            rows = await cursor.fetchall()
-            return [(row[0], row[1], row[2], row[3]) for row in rows]
+        rows = await self.queries.fetch(_Q_RANK_ACHIEVEMENT_STATS, replica=True)
+        return [(row[0], row[1], row[2], row[3]) for row in rows]
 
     # Методы для работы с призами
 
     async def save_prize(self, prize: Prize) -> int:
         """Сохранение или обновление приза"""
-        async with aiosqlite.connect(self.db_path) as db:
+        async with sqlite_connect(self.db_path) as db:
             if prize.id is None:
                 # Создание нового приза
                 # Проверяем наличие колонок
@@ -2918,12 +3409,69 @@ class Database:
                     prize.updated_at,
                     prize.id
                 ))
+            version = await self._bump_prize_catalog_version(db)
             await db.commit()
+            self._set_prize_catalog_version(version)
             logger.info(f"Приз '{prize.title}' сохранен (ID: {prize.id})")
             return prize.id
 
+    async def get_prize_catalog_version(self) -> int:
+        """
+        Текущая версия каталога призов.
+        Версия хранится в таблице cache_versions и увеличивается при каждом изменении призов.
+        Чтение из БД выполняется не чаще prize_version_check_interval секунд, при смене
+        версии (изменения из другого процесса) кэш призов сбрасывается.
+        """
+        now = time.monotonic()
+        if self._prize_catalog_version is not None and now - self._prize_version_checked_at < self.prize_version_check_interval:
+            return self._prize_catalog_version
+
+        async with sqlite_connect(self.db_path) as db:
+            cursor = await db.execute("SELECT version FROM cache_versions WHERE name = 'prizes'")
+            row = await cursor.fetchone()
+        version = row[0] if row else 0
+
+        if version != self._prize_catalog_version:
+            self._prize_cache.clear()
+            self._prize_catalog_version = version
+        self._prize_version_checked_at = now
+        return version
+
+    async def _bump_prize_catalog_version(self, db) -> int:
+        """Увеличение версии каталога призов в рамках текущей транзакции"""
+        await db.execute('''
+            INSERT INTO cache_versions (name, version) VALUES ('prizes', 1)
+            ON CONFLICT(name) DO UPDATE SET version = version + 1
+        ''')
+        cursor = await db.execute("SELECT version FROM cache_versions WHERE name = 'prizes'")
+        row = await cursor.fetchone()
+        return row[0]
+
+    def _set_prize_catalog_version(self, version: int):
+        """Применение новой версии каталога в текущем процессе (после commit)"""
+        self._prize_cache.clear()
+        self._prize_catalog_version = version
+        self._prize_version_checked_at = time.monotonic()
+
     async def get_prizes(self, prize_type: Optional[PrizeType] = None, referral_code: Optional[str] = None, is_active: bool = True, subscription_level: Optional[int] = None) -> list[Prize]:
-        """Получение списка призов
+        """Получение списка призов (с кэшированием по версии каталога)
+
+        Аргументы те же, что у _fetch_prizes. Возвращенные объекты Prize общие для
+        всех вызовов, изменять их нельзя - для редактирования используйте get_prize_by_id.
+        """
+        await self.get_prize_catalog_version()
+        key = (prize_type, referral_code, is_active, subscription_level)
+        prizes = self._prize_cache.get(key)
+        if prizes is None:
+            version = self._prize_catalog_version
+            prizes = await self._fetch_prizes(prize_type, referral_code, is_active, subscription_level)
+            # Не кэшируем результат, если каталог изменился во время запроса
+            if version == self._prize_catalog_version:
+                self._prize_cache[key] = prizes
+        return list(prizes)
+
+    async def _fetch_prizes(self, prize_type: Optional[PrizeType] = None, referral_code: Optional[str] = None, is_active: bool = True, subscription_level: Optional[int] = None) -> list[Prize]:
+        """Получение списка призов из БД
         
         Args:
             prize_type: Тип приза (ADMIN или BLOGGER)
@@ -2931,7 +3479,7 @@ class Database:
             is_active: Активен ли приз
             subscription_level: Уровень подписки (None - для всех, 2 - для уровня 2, 3 - для уровня 3)
         """
-        async with aiosqlite.connect(self.db_path) as db:
+        async with sqlite_connect(self.db_path) as db:
             db.row_factory = aiosqlite.Row
 
             conditions = []
@@ -2963,127 +3511,65 @@ class Database:
             ''', params)
 
             rows = await cursor.fetchall()
-            prizes = []
-
-            for row in rows:
-                # Проверяем наличие колонки custom_condition (для совместимости со старыми БД)
-                custom_condition = None
-                try:
-                    # Пытаемся получить значение, если колонка существует
-                    custom_condition = row['custom_condition'] if row['custom_condition'] else None
-                except (KeyError, IndexError):
-                    # Колонка отсутствует в старых версиях БД
-                    custom_condition = None
-                
-                # Проверяем наличие колонки subscription_level
-                subscription_level = None
-                try:
-                    subscription_level = row['subscription_level'] if row['subscription_level'] else None
-                except (KeyError, IndexError):
-                    subscription_level = None
-                
-                prizes.append(Prize(
-                    id=row['id'],
-                    prize_type=PrizeType(row['prize_type']),
-                    referral_code=row['referral_code'],
-                    title=row['title'],
-                    description=row['description'],
-                    achievement_type=row['achievement_type'],
-                    achievement_value=row['achievement_value'],
-                    custom_condition=custom_condition,
-                    subscription_level=subscription_level,
-                    emoji=row['emoji'],
-                    is_active=row['is_active'],
-                    created_at=row['created_at'],
-                    updated_at=row['updated_at']
-                ))
-
-            return prizes
+            # Колонок custom_condition и subscription_level может не быть в старых БД - декодер это учитывает
+            return decode_rows(Prize, rows)
 
     async def get_prize_by_id(self, prize_id: int) -> Optional[Prize]:
         """Получение приза по ID"""
-        async with aiosqlite.connect(self.db_path) as db:
+        async with sqlite_connect(self.db_path) as db:
             db.row_factory = aiosqlite.Row
             cursor = await db.execute('SELECT * FROM prizes WHERE id = ?', (prize_id,))
 
             row = await cursor.fetchone()
-            if row:
-                # Проверяем наличие колонки custom_condition (для совместимости со старыми БД)
-                custom_condition = None
-                try:
-                    # Пытаемся получить значение, если колонка существует
-                    custom_condition = row['custom_condition'] if row['custom_condition'] else None
-                except (KeyError, IndexError):
-                    # Колонка отсутствует в старых версиях БД
-                    custom_condition = None
-                
-                # Проверяем наличие колонки subscription_level
-                subscription_level = None
-                try:
-                    subscription_level = row['subscription_level'] if row['subscription_level'] else None
-                except (KeyError, IndexError):
-                    subscription_level = None
-                
-                return Prize(
-                    id=row['id'],
-                    prize_type=PrizeType(row['prize_type']),
-                    referral_code=row['referral_code'],
-                    title=row['title'],
-                    description=row['description'],
-                    achievement_type=row['achievement_type'],
-                    achievement_value=row['achievement_value'],
-                    custom_condition=custom_condition,
-                    subscription_level=subscription_level,
-                    emoji=row['emoji'],
-                    is_active=row['is_active'],
-                    created_at=row['created_at'],
-                    updated_at=row['updated_at']
-                )
-            return None
+            return decode_row(Prize, row) if row else None
 
     async def delete_prize(self, prize_id: int) -> bool:
         """Удаление приза"""
-        async with aiosqlite.connect(self.db_path) as db:
+        async with sqlite_connect(self.db_path) as db:
             cursor = await db.execute('DELETE FROM prizes WHERE id = ?', (prize_id,))
-            await db.commit()
             deleted = cursor.rowcount > 0
             if deleted:
+                version = await self._bump_prize_catalog_version(db)
+            await db.commit()
+            if deleted:
+                self._set_prize_catalog_version(version)
                 logger.info(f"Приз с ID {prize_id} удален")
             return deleted
 
     # Методы для модераторского бота
 
-    async def get_total_users_count(self) -> int:
-        """Получение общего количества пользователей"""
-        async with aiosqlite.connect(self.db_path) as db:
-            cursor = await db.execute('SELECT COUNT(*) FROM users')
+    async def _get_stats_counter(self, scope: str, name: str, key: str = '') -> int:
+        """Значение одного счетчика из stats_counters"""
+        async with sqlite_connect(self.db_path) as db:
+            cursor = await db.execute(
+                'SELECT value FROM stats_counters WHERE scope = ? AND key = ? AND name = ?', (scope, key, name)
+            )
             result = await cursor.fetchone()
             return result[0] if result else 0
 
+    async def get_total_users_count(self) -> int:
+        """Получение общего количества пользователей"""
+        return await self._get_stats_counter('global', 'users')
+
     async def get_active_users_count(self) -> int:
         """Получение количества пользователей с активной подпиской"""
-        async with aiosqlite.connect(self.db_path) as db:
-            cursor = await db.execute('SELECT COUNT(*) FROM users WHERE subscription_active = 1')
-            result = await cursor.fetchone()
-            return result[0] if result else 0
+        return await self._get_stats_counter('global', 'active_users')
 
     async def get_total_completed_tasks(self) -> int:
         """Получение общего количества выполненных заданий"""
-        async with aiosqlite.connect(self.db_path) as db:
-            cursor = await db.execute('SELECT SUM(total_tasks_completed) FROM user_stats')
-            result = await cursor.fetchone()
-            return result[0] if result and result[0] else 0
+        return await self._get_stats_counter('global', 'completed_tasks')
+
+    async def get_referral_users_count(self, referral_code: str, active_only: bool = False) -> int:
+        """Количество пользователей (или активных подписчиков) с реферальным кодом"""
+        return await self._get_stats_counter('referral', 'active_users' if active_only else 'users', referral_code)
 
     async def get_users_by_city_stats(self) -> list[tuple]:
         """Статистика пользователей по городам"""
-        async with aiosqlite.connect(self.db_path) as db:
+        async with sqlite_connect(self.db_path) as db:
             cursor = await db.execute('''
-                SELECT u.city, COUNT(*) as count
-                FROM users u
-                JOIN user_stats us ON u.telegram_id = us.user_id
-                WHERE u.city IS NOT NULL AND u.city != ''
-                GROUP BY u.city
-                ORDER BY count DESC
+                SELECT key, value FROM stats_counters
+                WHERE scope = 'city' AND name = 'users' AND value > 0
+                ORDER BY value DESC
                 LIMIT 20
             ''')
             rows = await cursor.fetchall()
@@ -3091,19 +3577,18 @@ class Database:
 
     async def get_users_by_rank_stats(self) -> list[tuple]:
         """Статистика пользователей по рангам"""
-        async with aiosqlite.connect(self.db_path) as db:
+        async with sqlite_connect(self.db_path) as db:
             cursor = await db.execute('''
-                SELECT us.rank, COUNT(*) as count
-                FROM user_stats us
-                GROUP BY us.rank
-                ORDER BY count DESC
+                SELECT key, value FROM stats_counters
+                WHERE scope = 'rank' AND name = 'users' AND value > 0
+                ORDER BY value DESC
             ''')
             rows = await cursor.fetchall()
             return [(row[0], row[1]) for row in rows]
 
     async def get_users_by_referral_code_stats(self, referral_code: str) -> list[tuple]:
         """Получение статистики подписчиков блогера"""
-        async with aiosqlite.connect(self.db_path) as db:
+        async with sqlite_connect(self.db_path) as db:
             cursor = await db.execute('''
                 SELECT u.name, us.level, us.experience, us.rank
                 FROM users u
@@ -3119,7 +3604,7 @@ class Database:
 
     async def get_pending_tasks_for_moderation(self, limit: int = 50) -> list[tuple]:
         """Получение заданий, ожидающих модерации"""
-        async with aiosqlite.connect(self.db_path) as db:
+        async with sqlite_connect(self.db_path) as db:
             cursor = await db.execute('''
                 SELECT dt.id, dt.user_id, dt.task_description, dt.submitted_media_path,
                        u.name, ps.nickname
@@ -3133,9 +3618,90 @@ class Database:
             rows = await cursor.fetchall()
             return [(row[0], row[1], row[2], row[3], row[4], row[5]) for row in rows]
 
+    async def claim_tasks_for_moderation(self, moderator_id: int, limit: int = 10, lease_seconds: int = 300) -> list[tuple]:
+        """
+        Атомарное получение заданий на проверку с арендой.
+        Задания, уже арендованные этим модератором, возвращаются повторно (аренда продлевается),
+        задания с действующей арендой другого модератора пропускаются.
+        Формат результата такой же, как у get_pending_tasks_for_moderation.
+        """
+        if self.use_postgres:
+            conn = await _get_postgres_connection()
+            try:
+                rows = await conn.fetch('''
+                    WITH claimable AS (
+                        SELECT id FROM daily_tasks
+                        WHERE status = 'submitted'
+                          AND (claimed_until IS NULL OR claimed_until < NOW() OR claimed_by = $1)
+                        ORDER BY created_at ASC
+                        LIMIT $2
+                        FOR UPDATE SKIP LOCKED
+                    ), claimed AS (
+                        UPDATE daily_tasks dt
+                        SET claimed_by = $1, claimed_until = NOW() + make_interval(secs => $3)
+                        FROM claimable
+                        WHERE dt.id = claimable.id
+                        RETURNING dt.id, dt.user_id, dt.task_description, dt.submitted_media_path, dt.created_at
+                    )
+                    SELECT c.id, c.user_id, c.task_description, c.submitted_media_path, u.name, ps.nickname
+                    FROM claimed c
+                    JOIN users u ON c.user_id = u.telegram_id
+                    LEFT JOIN player_stats ps ON c.user_id = ps.user_id
+                    ORDER BY c.created_at ASC
+                ''', moderator_id, limit, lease_seconds)
+                return [(row['id'], row['user_id'], row['task_description'], row['submitted_media_path'], row['name'], row['nickname']) for row in rows]
+            finally:
+                await conn.close()
+        else:
+            async with sqlite_connect(self.db_path) as db:
+                current_time = int(datetime.datetime.now().timestamp())
+                # Один UPDATE выполняется под блокировкой записи SQLite, поэтому два модератора
+                # не могут арендовать одно и то же задание
+                await db.execute('''
+                    UPDATE daily_tasks
+                    SET claimed_by = ?, claimed_until = ?
+                    WHERE id IN (
+                        SELECT id FROM daily_tasks
+                        WHERE status = 'submitted'
+                          AND (claimed_until IS NULL OR claimed_until < ? OR claimed_by = ?)
+                        ORDER BY created_at ASC
+                        LIMIT ?
+                    )
+                ''', (moderator_id, current_time + lease_seconds, current_time, moderator_id, limit))
+                await db.commit()
+
+                cursor = await db.execute('''
+                    SELECT dt.id, dt.user_id, dt.task_description, dt.submitted_media_path,
+                           u.name, ps.nickname
+                    FROM daily_tasks dt
+                    JOIN users u ON dt.user_id = u.telegram_id
+                    LEFT JOIN player_stats ps ON dt.user_id = ps.user_id
+                    WHERE dt.status = 'submitted' AND dt.claimed_by = ? AND dt.claimed_until >= ?
+                    ORDER BY dt.created_at ASC
+                    LIMIT ?
+                ''', (moderator_id, current_time, limit))
+                rows = await cursor.fetchall()
+                return [(row[0], row[1], row[2], row[3], row[4], row[5]) for row in rows]
+
+    async def renew_task_lease(self, task_id: int, moderator_id: int, lease_seconds: int = 300) -> bool:
+        """
+        Продление аренды задания модератором (или аренда свободного задания).
+        Возвращает False, если задание уже проверено или арендовано другим модератором.
+        """
+        now = int(datetime.datetime.now().timestamp())
+        until = now + lease_seconds
+        if self.use_postgres:
+            # В PostgreSQL claimed_until имеет тип TIMESTAMP
+            now, until = datetime.datetime.fromtimestamp(now), datetime.datetime.fromtimestamp(until)
+        return await self.queries.execute(_Q_RENEW_TASK_LEASE, moderator_id, until, task_id, moderator_id, now) > 0
+
+    async def release_task_lease(self, task_id: int, moderator_id: int) -> bool:
+        """Досрочное освобождение аренды задания"""
+        return await self.queries.execute(_Q_RELEASE_TASK_LEASE, task_id, moderator_id) > 0
+
     async def get_task_details(self, task_id: int) -> Optional[dict]:
         """Получение детальной информации о задании"""
-        async with aiosqlite.connect(self.db_path) as db:
+        async with sqlite_connect(self.db_path) as db:
             db.row_factory = aiosqlite.Row
             cursor = await db.execute('''
                 SELECT dt.*, u.name, ps.nickname, ps.photo_path
@@ -3150,28 +3716,53 @@ class Database:
             return None
 
     async def approve_task(self, task_id: int, moderator_id: int, experience_reward: int = 10,
-                          stat_rewards: dict = None) -> bool:
-        """Одобрение задания с начислением наград"""
+                          stat_rewards: dict = None) -> Optional[dict]:
+        """
+        Одобрение задания с начислением наград.
+        Уведомление пользователю записывается в той же транзакции, что и награды.
+        Возвращает созданное уведомление (None при ошибке, если задание уже проверено
+        или арендовано другим модератором).
+        """
         if stat_rewards is None:
             stat_rewards = {'strength': 0, 'agility': 0, 'endurance': 0, 'intelligence': 0, 'charisma': 0}
 
-        async with aiosqlite.connect(self.db_path) as db:
+        # Индекс порогов призов берем до начала транзакции (обычно из кэша)
+        prize_index = await self.get_prize_index()
+
+        async with sqlite_connect(self.db_path) as db:
             try:
-                # Получаем информацию о задании
-                cursor = await db.execute('SELECT user_id, submitted_media_path FROM daily_tasks WHERE id = ?', (task_id,))
+                # Получаем информацию о задании (и реферальный код автора для сброса аналитики блогера)
+                cursor = await db.execute('''
+                    SELECT dt.user_id, dt.submitted_media_path, dt.task_description, u.referral_code,
+                           dt.created_at, u.timezone
+                    FROM daily_tasks dt LEFT JOIN users u ON u.telegram_id = dt.user_id
+                    WHERE dt.id = ?
+                ''', (task_id,))
                 task_row = await cursor.fetchone()
                 if not task_row:
-                    return False
+                    return None
 
                 user_id = task_row[0]
                 media_path = task_row[1]
+                task_desc = task_row[2]
+                referral_code = task_row[3]
 
-                # Обновляем статус задания
-                await db.execute('''
+                # Запоминаем показатели до начисления наград
+                old_achievements = await self._get_achievement_values(user_id, db)
+
+                # Обновляем статус задания, только если оно еще на проверке и не арендовано другим
+                # модератором (аренда могла истечь, пока модератор вводил бонусы)
+                current_time = int(datetime.datetime.now().timestamp())
+                cursor = await db.execute('''
                     UPDATE daily_tasks
                     SET status = 'approved', completed_at = ?, moderator_comment = ?
-                    WHERE id = ?
-                ''', (int(datetime.datetime.now().timestamp()), f"Одобрено модератором {moderator_id}", task_id))
+                    WHERE id = ? AND status = 'submitted'
+                      AND (claimed_by = ? OR claimed_until IS NULL OR claimed_until < ?)
+                ''', (current_time, f"Одобрено модератором {moderator_id}", task_id, moderator_id, current_time))
+                if cursor.rowcount == 0:
+                    await db.rollback()
+                    logger.warning(f"Задание {task_id} уже проверено или арендовано другим модератором, одобрение {moderator_id} отменено")
+                    return None
 
                 # Начисляем опыт пользователю
                 await db.execute('''
@@ -3180,6 +3771,9 @@ class Database:
                     WHERE user_id = ?
                 ''', (experience_reward, user_id))
 
+                # Продлеваем стрик (до проверки достижений: от него зависят призы за серии)
+                await self._advance_streaks([(user_id, task_row[4], task_row[5])], db)
+
                 # Начисляем характеристики игроку
                 await db.execute('''
                     UPDATE player_stats
@@ -3203,54 +3797,295 @@ class Database:
                 # Обновляем уровень пользователя на основе нового опыта
                 await self._update_user_level(user_id, db)
 
-                await db.commit()
+                # Выдаем призы за пересеченные пороги достижений
+                new_achievements = await self._get_achievement_values(user_id, db)
+                await self._award_crossed_prizes(user_id, task_id, prize_index, old_achievements, new_achievements, db)
+
+                await self._insert_moderation_events(db, [(task_id, moderator_id, 'approved', experience_reward, stat_rewards, None)])
+
+                # Уведомление о результате проверки (в той же транзакции)
+                notification = await self._insert_notification(
+                    db, user_id, *self._render_task_result_notification(task_desc, True, experience_reward, stat_rewards)
+                )
 
-                # Отправляем уведомление пользователю (после commit)
-                await self.send_task_result_notification(task_id, True, experience_reward, stat_rewards)
+                await db.commit()
 
                 # Удаляем медиафайл для экономии места на сервере
                 if media_path:
                     self._delete_task_media_file(media_path)
 
+                if referral_code:
+                    self.invalidate_blogger_stats(referral_code)
+
                 logger.info(f"Задание {task_id} одобрено модератором {moderator_id}, начислено опыта: {experience_reward}")
-                return True
+                return notification
 
             except Exception as e:
                 await db.rollback()
                 logger.error(f"Ошибка при одобрении задания {task_id}: {e}")
-                return False
+                return None
 
-    async def reject_task(self, task_id: int, moderator_id: int, reason: str = "") -> bool:
-        """Отклонение задания"""
-        async with aiosqlite.connect(self.db_path) as db:
+    async def reject_task(self, task_id: int, moderator_id: int, reason: str = "") -> Optional[dict]:
+        """
+        Отклонение задания.
+        Уведомление пользователю записывается в той же транзакции, что и смена статуса.
+        Возвращает созданное уведомление (None при ошибке, если задание уже проверено
+        или арендовано другим модератором).
+        """
+        async with sqlite_connect(self.db_path) as db:
             try:
-                # Получаем информацию о задании для удаления файла
-                cursor = await db.execute('SELECT submitted_media_path FROM daily_tasks WHERE id = ?', (task_id,))
+                # Получаем информацию о задании для уведомления и удаления файла
+                cursor = await db.execute('SELECT user_id, submitted_media_path, task_description FROM daily_tasks WHERE id = ?', (task_id,))
                 task_row = await cursor.fetchone()
-                media_path = task_row[0] if task_row else None
+                if not task_row:
+                    return None
 
-                await db.execute('''
+                user_id = task_row[0]
+                media_path = task_row[1]
+                task_desc = task_row[2]
+
+                current_time = int(datetime.datetime.now().timestamp())
+                cursor = await db.execute('''
                     UPDATE daily_tasks
                     SET status = 'rejected', moderator_comment = ?
-                    WHERE id = ?
-                ''', (f"Отклонено модератором {moderator_id}: {reason}", task_id))
+                    WHERE id = ? AND status = 'submitted'
+                      AND (claimed_by = ? OR claimed_until IS NULL OR claimed_until < ?)
+                ''', (f"Отклонено модератором {moderator_id}: {reason}", task_id, moderator_id, current_time))
+                if cursor.rowcount == 0:
+                    await db.rollback()
+                    logger.warning(f"Задание {task_id} уже проверено или арендовано другим модератором, отклонение {moderator_id} отменено")
+                    return None
 
-                await db.commit()
+                await self._insert_moderation_events(db, [(task_id, moderator_id, 'rejected', 0, None, reason)])
 
-                # Отправляем уведомление пользователю (после commit)
-                await self.send_task_result_notification(task_id, False, reason=reason)
+                # Уведомление о результате проверки (в той же транзакции)
+                notification = await self._insert_notification(
+                    db, user_id, *self._render_task_result_notification(task_desc, False, reason=reason)
+                )
+
+                await db.commit()
 
                 # Удаляем медиафайл для экономии места на сервере
                 if media_path:
                     self._delete_task_media_file(media_path)
 
                 logger.info(f"Задание {task_id} отклонено модератором {moderator_id}")
-                return True
+                return notification
 
             except Exception as e:
                 await db.rollback()
                 logger.error(f"Ошибка при отклонении задания {task_id}: {e}")
-                return False
+                return None
+
+    async def approve_tasks_bulk(self, task_ids: list[int], moderator_id: int, experience_reward: int = 10,
+                                 stat_rewards: dict = None) -> list[dict]:
+        """
+        Одобрение нескольких заданий одной транзакцией.
+        Награды суммируются по пользователям, уровень и ранг пересчитываются одним проходом.
+        Обрабатываются только задания в статусе submitted, не арендованные другим модератором.
+        Возвращает созданные уведомления.
+        """
+        if not task_ids:
+            return []
+        if stat_rewards is None:
+            stat_rewards = {'strength': 0, 'agility': 0, 'endurance': 0, 'intelligence': 0, 'charisma': 0}
+
+        prize_index = await self.get_prize_index()
+        placeholders = ",".join("?" * len(task_ids))
+
+        async with sqlite_connect(self.db_path) as db:
+            try:
+                completed_at = int(datetime.datetime.now().timestamp())
+                cursor = await db.execute(f'''
+                    SELECT dt.id, dt.user_id, dt.submitted_media_path, dt.task_description, dt.created_at, u.timezone
+                    FROM daily_tasks dt LEFT JOIN users u ON u.telegram_id = dt.user_id
+                    WHERE dt.id IN ({placeholders}) AND dt.status = 'submitted'
+                      AND (dt.claimed_by = ? OR dt.claimed_until IS NULL OR dt.claimed_until < ?)
+                ''', [*task_ids, moderator_id, completed_at])
+                # Награды начисляются только за задания, статус которых удалось сменить:
+                # между выборкой и записью их мог проверить другой модератор
+                tasks = await self._claim_task_statuses(
+                    db, await cursor.fetchall(), 'approved', completed_at,
+                    f"Одобрено модератором {moderator_id}", moderator_id
+                )
+                if not tasks:
+                    await db.rollback()
+                    return []
+
+                # Количество одобренных заданий по каждому пользователю
+                tasks_per_user: dict[int, int] = {}
+                for task in tasks:
+                    tasks_per_user[task[1]] = tasks_per_user.get(task[1], 0) + 1
+
+                # Смена статуса заданий не меняет показатели, поэтому это еще значения до наград
+                old_achievements = {user_id: await self._get_achievement_values(user_id, db) for user_id in tasks_per_user}
+
+                await db.executemany('''
+                    UPDATE user_stats
+                    SET experience = experience + ?, total_tasks_completed = total_tasks_completed + ?
+                    WHERE user_id = ?
+                ''', [(experience_reward * count, count, user_id) for user_id, count in tasks_per_user.items()])
+
+                await self._advance_streaks([(task[1], task[4], task[5]) for task in tasks], db)
+
+                await db.executemany('''
+                    UPDATE player_stats
+                    SET strength = strength + ?,
+                        agility = agility + ?,
+                        endurance = endurance + ?,
+                        intelligence = intelligence + ?,
+                        charisma = charisma + ?,
+                        experience = experience + ?
+                    WHERE user_id = ?
+                ''', [(
+                    stat_rewards.get('strength', 0) * count,
+                    stat_rewards.get('agility', 0) * count,
+                    stat_rewards.get('endurance', 0) * count,
+                    stat_rewards.get('intelligence', 0) * count,
+                    stat_rewards.get('charisma', 0) * count,
+                    experience_reward * count,
+                    user_id
+                ) for user_id, count in tasks_per_user.items()])
+
+                # Один проход пересчета уровня и ранга для всех затронутых пользователей
+                await self._update_users_levels(list(tasks_per_user), db)
+
+                for user_id in tasks_per_user:
+                    new_achievements = await self._get_achievement_values(user_id, db)
+                    await self._award_crossed_prizes(user_id, None, prize_index, old_achievements[user_id], new_achievements, db)
+
+                await self._insert_moderation_events(
+                    db, [(task[0], moderator_id, 'approved', experience_reward, stat_rewards, None) for task in tasks]
+                )
+
+                notifications = []
+                for task_id, user_id, media_path, task_desc, _, _ in tasks:
+                    notifications.append(await self._insert_notification(
+                        db, user_id, *self._render_task_result_notification(task_desc, True, experience_reward, stat_rewards)
+                    ))
+
+                await db.commit()
+
+                for task in tasks:
+                    if task[2]:
+                        self._delete_task_media_file(task[2])
+
+                self.invalidate_blogger_stats()
+
+                logger.info(f"Модератор {moderator_id} одобрил {len(tasks)} заданий пакетом, опыт за задание: {experience_reward}")
+                return notifications
+
+            except Exception as e:
+                await db.rollback()
+                logger.error(f"Ошибка при пакетном одобрении заданий {task_ids}: {e}")
+                return []
+
+    async def reject_tasks_bulk(self, task_ids: list[int], moderator_id: int, reason: str = "") -> list[dict]:
+        """
+        Отклонение нескольких заданий одной транзакцией.
+        Обрабатываются только задания в статусе submitted, не арендованные другим модератором.
+        Возвращает созданные уведомления.
+        """
+        if not task_ids:
+            return []
+        placeholders = ",".join("?" * len(task_ids))
+
+        async with sqlite_connect(self.db_path) as db:
+            try:
+                current_time = int(datetime.datetime.now().timestamp())
+                cursor = await db.execute(f'''
+                    SELECT id, user_id, submitted_media_path, task_description
+                    FROM daily_tasks WHERE id IN ({placeholders}) AND status = 'submitted'
+                      AND (claimed_by = ? OR claimed_until IS NULL OR claimed_until < ?)
+                ''', [*task_ids, moderator_id, current_time])
+                tasks = await self._claim_task_statuses(
+                    db, await cursor.fetchall(), 'rejected', None,
+                    f"Отклонено модератором {moderator_id}: {reason}", moderator_id
+                )
+                if not tasks:
+                    await db.rollback()
+                    return []
+
+                await self._insert_moderation_events(
+                    db, [(task[0], moderator_id, 'rejected', 0, None, reason) for task in tasks]
+                )
+
+                notifications = []
+                for task_id, user_id, media_path, task_desc in tasks:
+                    notifications.append(await self._insert_notification(
+                        db, user_id, *self._render_task_result_notification(task_desc, False, reason=reason)
+                    ))
+
+                await db.commit()
+
+                for task in tasks:
+                    if task[2]:
+                        self._delete_task_media_file(task[2])
+
+                logger.info(f"Модератор {moderator_id} отклонил {len(tasks)} заданий пакетом")
+                return notifications
+
+            except Exception as e:
+                await db.rollback()
+                logger.error(f"Ошибка при пакетном отклонении заданий {task_ids}: {e}")
+                return []
+
+    async def _claim_task_statuses(self, db, tasks: list, status: str, completed_at: Optional[int],
+                                   comment: str, moderator_id: int) -> list:
+        """
+        Смена статуса выбранных заданий (первая колонка - id) с повторной проверкой статуса
+        и аренды. Возвращает задания, статус которых сменен. Выполняется в транзакции вызывающего метода.
+        """
+        current_time = int(datetime.datetime.now().timestamp())
+        claimed = []
+        for task in tasks:
+            cursor = await db.execute('''
+                UPDATE daily_tasks
+                SET status = ?, completed_at = COALESCE(?, completed_at), moderator_comment = ?
+                WHERE id = ? AND status = 'submitted'
+                  AND (claimed_by = ? OR claimed_until IS NULL OR claimed_until < ?)
+            ''', (status, completed_at, comment, task[0], moderator_id, current_time))
+            if cursor.rowcount == 1:
+                claimed.append(task)
+        if len(claimed) < len(tasks):
+            logger.warning(f"Пропущено заданий, уже проверенных другим модератором: {len(tasks) - len(claimed)}")
+        return claimed
+
+    async def _update_users_levels(self, user_ids: list[int], db):
+        """Пересчет уровня и ранга для нескольких пользователей одним проходом"""
+        if not user_ids:
+            return
+        placeholders = ",".join("?" * len(user_ids))
+        cursor = await db.execute(f'SELECT user_id, experience FROM user_stats WHERE user_id IN ({placeholders})', user_ids)
+        rows = await cursor.fetchall()
+        await db.executemany(
+            'UPDATE user_stats SET level = ?, rank = ? WHERE user_id = ?',
+            [(experience // 100 + 1, get_rank_by_experience(experience).value, user_id) for user_id, experience in rows]
+        )
+
+    async def _advance_streaks(self, completed: list[tuple], db):
+        """
+        Продление стриков по одобренным заданиям: (user_id, created_at задания, часовой пояс).
+        На каждое задание - одно сравнение дня с last_task_date, без чтения истории заданий.
+        Выполняется в транзакции вызывающего метода.
+        """
+        user_ids = list({user_id for user_id, _, _ in completed})
+        placeholders = ",".join("?" * len(user_ids))
+        cursor = await db.execute(f'''
+            SELECT user_id, current_streak, best_streak, last_task_date
+            FROM user_stats WHERE user_id IN ({placeholders})
+        ''', user_ids)
+        states = {row[0]: StreakState(row[1] or 0, row[2] or 0, row[3]) for row in await cursor.fetchall()}
+
+        now = int(datetime.datetime.now().timestamp())
+        for user_id, created_at, timezone in sorted(completed, key=lambda item: item[1] or now):
+            if user_id in states:
+                states[user_id].advance(created_at or now, timezone)
+
+        await db.executemany(
+            'UPDATE user_stats SET current_streak = ?, best_streak = ?, last_task_date = ? WHERE user_id = ?',
+            [(state.current, state.best, state.last_task_date, user_id) for user_id, state in states.items()]
+        )
 
     async def _update_user_level(self, user_id: int, db):
         """Обновление уровня и ранга пользователя на основе опыта"""
@@ -3263,6 +4098,76 @@ class Database:
 
             await db.execute('UPDATE user_stats SET level = ?, rank = ? WHERE user_id = ?', (new_level, new_rank.value, user_id))
 
+    async def get_prize_index(self) -> PrizeThresholdIndex:
+        """Индекс порогов активных призов (перестраивается только при смене версии каталога)"""
+        version = await self.get_prize_catalog_version()
+        if self._prize_index is None or self._prize_index_version != version:
+            prizes = await self.get_prizes(is_active=True)
+            self._prize_index = PrizeThresholdIndex(prizes)
+            self._prize_index_version = version
+        return self._prize_index
+
+    async def _get_achievement_values(self, user_id: int, db) -> dict:
+        """Текущие значения показателей пользователя для проверки достижений"""
+        cursor = await db.execute('''
+            SELECT us.experience, us.level, us.total_tasks_completed, us.current_streak, us.rank,
+                   us.last_task_date, u.timezone
+            FROM user_stats us LEFT JOIN users u ON u.telegram_id = us.user_id
+            WHERE us.user_id = ?
+        ''', (user_id,))
+        row = await cursor.fetchone()
+        if not row:
+            return {}
+        return {
+            'experience': row[0] or 0,
+            'level': row[1] or 0,
+            'tasks': row[2] or 0,
+            # Как в get_user_stats: прерванная серия считается нулевой
+            'streak': effective_streak(row[3], row[5], row[6]),
+            'rank': rank_to_value(row[4]),
+        }
+
+    async def _award_crossed_prizes(self, user_id: int, task_id: Optional[int], prize_index: PrizeThresholdIndex,
+                                    old_values: dict, new_values: dict, db) -> list[Prize]:
+        """
+        Выдача призов, пороги которых пересечены при изменении показателей.
+        Выполняется в транзакции вызывающего метода; уведомления создаются там же.
+        """
+        candidates = prize_index.crossed_by_changes(old_values, new_values)
+        if not candidates:
+            return []
+
+        # Данные для фильтрации призов блогеров и призов для уровней подписки
+        cursor = await db.execute('SELECT referral_code FROM users WHERE telegram_id = ?', (user_id,))
+        row = await cursor.fetchone()
+        referral_code = row[0] if row else None
+        cursor = await db.execute('''
+            SELECT subscription_level FROM subscriptions
+            WHERE user_id = ? AND status = 'active'
+            ORDER BY end_date DESC LIMIT 1
+        ''', (user_id,))
+        row = await cursor.fetchone()
+        subscription_level = row[0] if row else None
+
+        current_time = int(datetime.datetime.now().timestamp())
+        awarded = []
+        for prize in candidates:
+            if not is_prize_available_for_user(prize, referral_code, subscription_level):
+                continue
+            cursor = await db.execute('''
+                INSERT OR IGNORE INTO prize_awards (user_id, prize_id, achievement_type, achievement_value, task_id, awarded_at)
+                VALUES (?, ?, ?, ?, ?, ?)
+            ''', (user_id, prize.id, prize.achievement_type, prize.achievement_value, task_id, current_time))
+            if cursor.rowcount == 0:
+                continue  # Приз уже был выдан ранее
+
+            title, message = render_prize_award_message(prize)
+            await self._insert_notification(db, user_id, 'prize_awarded', title, message, json.dumps({'prize_id': prize.id}))
+            awarded.append(prize)
+            logger.info(f"Пользователю {user_id} выдан приз {prize.id} ({prize.achievement_type} >= {prize.achievement_value})")
+
+        return awarded
+
     def _delete_task_media_file(self, media_path: str) -> bool:
         """Удаление медиафайла задания для экономии места"""
         if not media_path:
@@ -3281,14 +4186,64 @@ class Database:
             return False
 
     # Методы для работы с уведомлениями
+    async def _insert_moderation_events(self, db, events: list[tuple]):
+        """
+        Запись действий модератора в журнал в рамках транзакции вызывающего метода.
+        events: [(task_id, moderator_id, action, experience_reward, stat_rewards, reason), ...]
+        """
+        created_at = int(datetime.datetime.now().timestamp())
+        await db.executemany('''
+            INSERT INTO moderation_events (task_id, moderator_id, action, experience_reward, stat_rewards, reason, created_at)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+        ''', [
+            (task_id, moderator_id, action, experience_reward,
+             json.dumps(stat_rewards) if stat_rewards else None, reason, created_at)
+            for task_id, moderator_id, action, experience_reward, stat_rewards, reason in events
+        ])
+
+    def _subscription_warning_notification(self, user_id: int, end_date: int, created_at: int) -> tuple:
+        """Параметры _Q_INSERT_NOTIFICATION для предупреждения об окончании подписки"""
+        end_date_str = datetime.datetime.fromtimestamp(end_date).strftime('%d.%m.%Y')
+        return (
+            user_id, 'subscription_expiring', "⚠️ <b>Важная информация о подписке</b>",
+            f"Ваша подписка истекает {end_date_str}.\n\n"
+            f"Чтобы продолжить пользоваться всеми функциями бота, необходимо продлить подписку.\n\n"
+            f"💎 Используйте команду /subscribe для продления подписки.",
+            None, created_at
+        )
+
+    def _subscription_expired_notification(self, user_id: int, created_at: int) -> tuple:
+        """Параметры _Q_INSERT_NOTIFICATION для уведомления об окончании подписки"""
+        return (
+            user_id, 'subscription_expired', "⏰ <b>Подписка закончилась</b>",
+            "Доступ к функциям бота приостановлен.\n\n"
+            "💎 Используйте команду /subscribe, чтобы продлить подписку.",
+            None, created_at
+        )
+
+    async def _insert_notification(self, db, user_id: int, notification_type: str, title: str, message: str, data: str = None) -> dict:
+        """Запись уведомления в рамках транзакции вызывающего метода (без commit)"""
+        created_at = int(datetime.datetime.now().timestamp())
+        cursor = await db.execute('''
+            INSERT INTO notifications (user_id, type, title, message, data, created_at)
+            VALUES (?, ?, ?, ?, ?, ?)
+        ''', (user_id, notification_type, title, message, data, created_at))
+        return {
+            'id': cursor.lastrowid,
+            'user_id': user_id,
+            'type': notification_type,
+            'title': title,
+            'message': message,
+            'data': data,
+            'is_sent': False,
+            'created_at': created_at,
+        }
+
     async def create_notification(self, user_id: int, notification_type: str, title: str, message: str, data: str = None) -> bool:
         """Создание уведомления для пользователя"""
-        async with aiosqlite.connect(self.db_path) as db:
+        async with sqlite_connect(self.db_path) as db:
             try:
-                await db.execute('''
-                    INSERT INTO notifications (user_id, type, title, message, data, created_at)
-                    VALUES (?, ?, ?, ?, ?, ?)
-                ''', (user_id, notification_type, title, message, data, int(datetime.datetime.now().timestamp())))
+                await self._insert_notification(db, user_id, notification_type, title, message, data)
 
                 await db.commit()
                 logger.info(f"Уведомление типа '{notification_type}' создано для пользователя {user_id}")
@@ -3301,439 +4256,365 @@ class Database:
 
     async def get_unsent_notifications(self, user_id: int = None, limit: int = 50) -> list[dict]:
         """Получение неотправленных уведомлений"""
+        # Уведомления старше срока хранения помечаются просроченными при архивации, поэтому на
+        # секционированной таблице условие по created_at лишь отсекает старые секции
+        created_after = 0
+        if self.use_postgres and POSTGRES_PARTITIONING:
+            created_after = int(datetime.datetime.now().timestamp()) - self.retention_days * 24 * 60 * 60
         if self.use_postgres:
             conn = await _get_postgres_connection()
             try:
                 if user_id:
                     rows = await conn.fetch('''
                         SELECT * FROM notifications
-                        WHERE user_id = $1 AND is_sent = FALSE
+                        WHERE user_id = $1 AND is_sent = FALSE AND created_at >= $2
                         ORDER BY created_at ASC
-                        LIMIT $2
-                    ''', user_id, limit)
+                        LIMIT $3
+                    ''', user_id, created_after, limit)
                 else:
                     rows = await conn.fetch('''
                         SELECT * FROM notifications
-                        WHERE is_sent = FALSE
+                        WHERE is_sent = FALSE AND created_at >= $1
                         ORDER BY created_at ASC
-                        LIMIT $1
-                    ''', limit)
+                        LIMIT $2
+                    ''', created_after, limit)
                 
                 return [dict(row) for row in rows]
             finally:
                 await conn.close()
         else:
-            async with aiosqlite.connect(self.db_path) as db:
+            async with sqlite_connect(self.db_path) as db:
                 db.row_factory = aiosqlite.Row
 
                 if user_id:
                     cursor = await db.execute('''
                         SELECT * FROM notifications
-                        WHERE user_id = ? AND is_sent = FALSE
+                        WHERE user_id = ? AND is_sent = FALSE AND created_at >= ?
                         ORDER BY created_at ASC
                         LIMIT ?
-                    ''', (user_id, limit))
+                    ''', (user_id, created_after, limit))
                 else:
                     cursor = await db.execute('''
                         SELECT * FROM notifications
-                        WHERE is_sent = FALSE
+                        WHERE is_sent = FALSE AND created_at >= ?
                         ORDER BY created_at ASC
                         LIMIT ?
-                    ''', (limit,))
+                    ''', (created_after, limit))
 
                 rows = await cursor.fetchall()
                 return [dict(row) for row in rows]
 
     async def mark_notification_sent(self, notification_id: int) -> bool:
         """Отметить уведомление как отправленное"""
-        if self.use_postgres:
-            conn = await _get_postgres_connection()
-            try:
-                await conn.execute('''
-                    UPDATE notifications
-                    SET is_sent = TRUE, sent_at = $1
-                    WHERE id = $2
-                ''', datetime.datetime.now(), notification_id)
-                logger.info(f"Уведомление {notification_id} отмечено как отправленное (PostgreSQL)")
-                return True
-            except Exception as e:
-                logger.error(f"Ошибка при отметке уведомления {notification_id} как отправленного: {e}")
-                return False
-            finally:
-                await conn.close()
+        sent_at = datetime.datetime.now()
+        try:
+            await self.queries.execute(_Q_MARK_NOTIFICATION_SENT,
+                                       sent_at if self.use_postgres else int(sent_at.timestamp()), notification_id)
+            return True
+        except Exception as e:
+            logger.error(f"Ошибка при отметке уведомления {notification_id} как отправленного: {e}")
+            return False
+
+    def _render_task_result_notification(self, task_desc: str, approved: bool, experience_reward: int = 0,
+                                         stat_rewards: dict = None, reason: str = "") -> tuple[str, str, str, str]:
+        """Формирование уведомления о результате проверки: (тип, заголовок, текст, data)"""
+        if stat_rewards is None:
+            stat_rewards = {}
+
+        if approved:
+            # Уведомление об одобрении
+            title = "🎉 Задание одобрено!"
+
+            # Формируем сообщение с наградами
+            message = f"✅ <b>Ваше задание было одобрено модератором!</b>\n\n"
+            message += f"📝 <b>Задание:</b>\n{task_desc}\n\n"
+            message += f"🎉 <b>Награды:</b>\n"
+            message += f"⭐ Опыт: +{experience_reward}\n"
+
+            if any(stat_rewards.values()):
+                message += "💪 Характеристики:\n"
+                stat_display_names = {
+                    'strength': '💪 Сила',
+                    'agility': '🤸 Ловкость',
+                    'endurance': '🏃 Выносливость',
+                    'intelligence': '🧠 Интеллект',
+                    'charisma': '✨ Харизма'
+                }
+                for stat_name, value in stat_rewards.items():
+                    if value > 0:
+                        message += f"{stat_display_names[stat_name]}: +{value}\n"
+
+            notification_type = "task_approved"
+            data = json.dumps({"experience": experience_reward, "stats": stat_rewards}, ensure_ascii=False)
+
         else:
-            async with aiosqlite.connect(self.db_path) as db:
-                try:
-                    await db.execute('''
-                        UPDATE notifications
-                        SET is_sent = TRUE, sent_at = ?
-                        WHERE id = ?
-                    ''', (int(datetime.datetime.now().timestamp()), notification_id))
+            # Уведомление об отклонении
+            title = "❌ Задание отклонено"
 
-                    await db.commit()
-                    return True
+            message = f"❌ <b>Ваше задание было отклонено модератором</b>\n\n"
+            message += f"📝 <b>Задание:</b>\n{task_desc}\n\n"
+            if reason and reason != "Без указания причины":
+                message += f"📋 <b>Причина:</b>\n{reason}\n\n"
+            message += "💡 Попробуйте выполнить задание лучше и отправьте снова!"
 
-                except Exception as e:
-                    await db.rollback()
-                    logger.error(f"Ошибка при отметке уведомления {notification_id} как отправленного: {e}")
-                    return False
+            notification_type = "task_rejected"
+            data = json.dumps({"reason": reason}, ensure_ascii=False)
+
+        return notification_type, title, message, data
 
     async def send_task_result_notification(self, task_id: int, approved: bool, experience_reward: int = 0,
                                           stat_rewards: dict = None, reason: str = "") -> bool:
-        """Отправка уведомления о результате проверки задания"""
-        if stat_rewards is None:
-            stat_rewards = {}
-
-        async with aiosqlite.connect(self.db_path) as db:
+        """Отправка уведомления о результате проверки задания (отдельно от approve_task/reject_task)"""
+        async with sqlite_connect(self.db_path) as db:
             try:
-                # Получаем информацию о задании и пользователе
-                cursor = await db.execute('''
-                    SELECT dt.user_id, dt.task_description, u.name
-                    FROM daily_tasks dt
-                    JOIN users u ON dt.user_id = u.telegram_id
-                    WHERE dt.id = ?
-                ''', (task_id,))
+                # Получаем информацию о задании
+                cursor = await db.execute('SELECT user_id, task_description FROM daily_tasks WHERE id = ?', (task_id,))
                 task_info = await cursor.fetchone()
 
                 if not task_info:
                     logger.error(f"Задание {task_id} не найдено при отправке уведомления")
                     return False
 
-                user_id, task_desc, user_name = task_info
-
-                if approved:
-                    # Уведомление об одобрении
-                    title = "🎉 Задание одобрено!"
-
-                    # Формируем сообщение с наградами
-                    message = f"✅ <b>Ваше задание было одобрено модератором!</b>\n\n"
-                    message += f"📝 <b>Задание:</b>\n{task_desc}\n\n"
-                    message += f"🎉 <b>Награды:</b>\n"
-                    message += f"⭐ Опыт: +{experience_reward}\n"
-
-                    if any(stat_rewards.values()):
-                        message += "💪 Характеристики:\n"
-                        stat_display_names = {
-                            'strength': '💪 Сила',
-                            'agility': '🤸 Ловкость',
-                            'endurance': '🏃 Выносливость',
-                            'intelligence': '🧠 Интеллект',
-                            'charisma': '✨ Харизма'
-                        }
-                        for stat_name, value in stat_rewards.items():
-                            if value > 0:
-                                message += f"{stat_display_names[stat_name]}: +{value}\n"
-
-                    notification_type = "task_approved"
-                    data = f'{{"experience": {experience_reward}, "stats": {stat_rewards}}}'
-
-                else:
-                    # Уведомление об отклонении
-                    title = "❌ Задание отклонено"
-
-                    message = f"❌ <b>Ваше задание было отклонено модератором</b>\n\n"
-                    message += f"📝 <b>Задание:</b>\n{task_desc}\n\n"
-                    if reason and reason != "Без указания причины":
-                        message += f"📋 <b>Причина:</b>\n{reason}\n\n"
-                    message += "💡 Попробуйте выполнить задание лучше и отправьте снова!"
-
-                    notification_type = "task_rejected"
-                    data = f'{{"reason": "{reason}"}}'
-
-                # Создаем уведомление
-                success = await self.create_notification(user_id, notification_type, title, message, data)
-                if success:
-                    logger.info(f"Уведомление о результате задания {task_id} создано для пользователя {user_id}")
-                return success
+                user_id, task_desc = task_info
+                await self._insert_notification(
+                    db, user_id, *self._render_task_result_notification(task_desc, approved, experience_reward, stat_rewards, reason)
+                )
+                await db.commit()
+                logger.info(f"Уведомление о результате задания {task_id} создано для пользователя {user_id}")
+                return True
 
             except Exception as e:
+                await db.rollback()
                 logger.error(f"Ошибка при создании уведомления о задании {task_id}: {e}")
                 return False
 
     # Методы для работы с блогерами
-    async def get_blogger_stats(self, blogger_telegram_id: int) -> dict:
-        """Получение статистики блогера"""
-        if self.use_postgres:
-            conn = await _get_postgres_connection()
-            try:
-                # Получаем реферальный код блогера
-                blogger = await self.get_blogger_by_telegram_id(blogger_telegram_id)
-                if not blogger:
-                    return {'error': 'Блогер не найден'}
-
-                referral_code = blogger['referral_code']
-
-                # Статистика подписчиков
-                total_subscribers = await conn.fetchval('''
-                    SELECT COUNT(*) FROM users WHERE referral_code = $1
-                ''', referral_code) or 0
-
-                # Статистика активных подписчиков (с подпиской)
-                active_subscribers = await conn.fetchval('''
-                    SELECT COUNT(*) FROM users WHERE referral_code = $1 AND subscription_active = TRUE
-                ''', referral_code) or 0
-
-                # Количество выполненных заданий подписчиками
-                total_tasks = await conn.fetchval('''
-                    SELECT COUNT(*) FROM daily_tasks dt
-                    JOIN users u ON dt.user_id = u.telegram_id
-                    WHERE u.referral_code = $1 AND dt.status IN ('approved', 'completed')
-                ''', referral_code) or 0
-
-                return {
-                    'referral_code': referral_code,
-                    'total_subscribers': total_subscribers,
-                    'active_subscribers': active_subscribers,
-                    'inactive_subscribers': total_subscribers - active_subscribers,
-                    'total_tasks_completed': total_tasks
-                }
-            finally:
-                await conn.close()
-        else:
-            async with aiosqlite.connect(self.db_path) as db:
-                # Получаем реферальный код блогера
-                blogger = await self.get_blogger_by_telegram_id(blogger_telegram_id)
-                if not blogger:
-                    return {'error': 'Блогер не найден'}
+    def _get_blogger_cache(self, key: tuple):
+        """Результат аналитики блогера из кэша (None, если нет или устарел)"""
+        entry = self._blogger_stats_cache.get(key)
+        if entry is None or time.monotonic() - entry[0] >= self.blogger_stats_cache_ttl:
+            return None
+        return entry[2]
 
-                referral_code = blogger['referral_code']
+    def _set_blogger_cache(self, key: tuple, referral_code: Optional[str], value):
+        self._blogger_stats_cache[key] = (time.monotonic(), referral_code, value)
 
-                # Статистика подписчиков
-                cursor = await db.execute('''
-                    SELECT COUNT(*) as total_subscribers
-                    FROM users
-                    WHERE referral_code = ?
-                ''', (referral_code,))
+    def invalidate_blogger_stats(self, referral_code: Optional[str] = None):
+        """
+        Сброс кэша аналитики блогеров: для указанного реферального кода или полностью.
+        Изменения из других процессов подхватываются по истечении blogger_stats_cache_ttl.
+        """
+        if referral_code is None:
+            self._blogger_stats_cache.clear()
+            return
+        for key in [k for k, v in self._blogger_stats_cache.items() if v[1] in (referral_code, None)]:
+            del self._blogger_stats_cache[key]
 
-                subscribers_row = await cursor.fetchone()
-                total_subscribers = subscribers_row[0] if subscribers_row else 0
+    async def get_blogger_stats(self, blogger_telegram_id: int) -> dict:
+        """
+        Получение статистики блогера одним запросом.
+        Результат кэшируется на blogger_stats_cache_ttl секунд.
+        """
+        cache_key = ('stats', blogger_telegram_id)
+        cached = self._get_blogger_cache(cache_key)
+        if cached is not None:
+            return cached
 
-                # Статистика активных подписчиков (с подпиской)
+        if self.use_postgres:
+            async with self.queries.acquire(replica=True) as conn:
+                row = await conn.fetchrow('''
+                    WITH blogger AS (
+                        SELECT referral_code FROM bloggers WHERE telegram_id = $1
+                    ),
+                    subscribers AS (
+                        SELECT u.telegram_id, u.subscription_active
+                        FROM users u JOIN blogger b ON u.referral_code = b.referral_code
+                    )
+                    SELECT
+                        b.referral_code,
+                        (SELECT COUNT(*) FROM subscribers) AS total_subscribers,
+                        (SELECT COUNT(*) FROM subscribers WHERE subscription_active = TRUE) AS active_subscribers,
+                        (SELECT COUNT(*) FROM daily_tasks_history dt JOIN subscribers s ON dt.user_id = s.telegram_id
+                         WHERE dt.status IN ('approved', 'completed')) AS total_tasks
+                    FROM blogger b
+                ''', blogger_telegram_id)
+        else:
+            async with sqlite_connect(self.db_path) as db:
                 cursor = await db.execute('''
-                    SELECT COUNT(*) as active_subscribers
-                    FROM users
-                    WHERE referral_code = ? AND subscription_active = 1
-                ''', (referral_code,))
+                    WITH blogger AS (
+                        SELECT referral_code FROM bloggers WHERE telegram_id = ?
+                    ),
+                    subscribers AS (
+                        SELECT u.telegram_id, u.subscription_active
+                        FROM users u JOIN blogger b ON u.referral_code = b.referral_code
+                    )
+                    SELECT
+                        b.referral_code,
+                        (SELECT COUNT(*) FROM subscribers) AS total_subscribers,
+                        (SELECT COUNT(*) FROM subscribers WHERE subscription_active = 1) AS active_subscribers,
+                        (SELECT COUNT(*) FROM daily_tasks_history dt JOIN subscribers s ON dt.user_id = s.telegram_id
+                         WHERE dt.status IN ('approved', 'completed')) AS total_tasks
+                    FROM blogger b
+                ''', (blogger_telegram_id,))
+                row = await cursor.fetchone()
 
-                active_row = await cursor.fetchone()
-                active_subscribers = active_row[0] if active_row else 0
+        if not row:
+            return {'error': 'Блогер не найден'}
 
-                # Количество выполненных заданий подписчиками
-                cursor = await db.execute('''
-                    SELECT COUNT(*) as total_tasks
-                    FROM daily_tasks dt
-                    JOIN users u ON dt.user_id = u.telegram_id
-                    WHERE u.referral_code = ? AND dt.status IN ('approved', 'completed')
-                ''', (referral_code,))
-
-                tasks_row = await cursor.fetchone()
-                total_tasks = tasks_row[0] if tasks_row else 0
-
-                return {
-                    'referral_code': referral_code,
-                    'total_subscribers': total_subscribers,
-                    'active_subscribers': active_subscribers,
-                    'inactive_subscribers': total_subscribers - active_subscribers,
-                    'total_tasks_completed': total_tasks
-                }
+        referral_code, total_subscribers, active_subscribers, total_tasks = row[0], row[1] or 0, row[2] or 0, row[3] or 0
+        stats = {
+            'referral_code': referral_code,
+            'total_subscribers': total_subscribers,
+            'active_subscribers': active_subscribers,
+            'inactive_subscribers': total_subscribers - active_subscribers,
+            'total_tasks_completed': total_tasks
+        }
+        self._set_blogger_cache(cache_key, referral_code, stats)
+        return stats
 
     async def get_blogger_top_subscribers(self, blogger_telegram_id: int, limit: int = 10) -> list[dict]:
-        """Получение топ-10 подписчиков блогера по опыту"""
-        if self.use_postgres:
-            conn = await _get_postgres_connection()
-            try:
-                # Получаем реферальный код блогера
-                blogger = await self.get_blogger_by_telegram_id(blogger_telegram_id)
-                if not blogger:
-                    return []
-
-                referral_code = blogger['referral_code']
+        """
+        Получение топ-10 подписчиков блогера по опыту одним запросом.
+        Результат кэшируется на blogger_stats_cache_ttl секунд.
+        """
+        cache_key = ('top', blogger_telegram_id, limit)
+        cached = self._get_blogger_cache(cache_key)
+        if cached is not None:
+            return cached
 
-                # Получаем топ подписчиков по опыту
+        # Строка блогера присутствует всегда (LEFT JOIN), чтобы знать реферальный код для кэша
+        # даже если подписчиков пока нет
+        if self.use_postgres:
+            async with self.queries.acquire(replica=True) as conn:
                 rows = await conn.fetch('''
-                    SELECT
-                        u.telegram_id,
-                        u.name,
-                        ps.nickname,
-                        us.experience,
-                        us.level,
-                        COUNT(dt.id) as tasks_completed
-                    FROM users u
-                    LEFT JOIN user_stats us ON u.telegram_id = us.user_id
-                    LEFT JOIN player_stats ps ON u.telegram_id = ps.user_id
-                    LEFT JOIN daily_tasks dt ON u.telegram_id = dt.user_id AND dt.status IN ('approved', 'completed')
-                    WHERE u.referral_code = $1 AND u.subscription_active = TRUE
-                    GROUP BY u.telegram_id, u.name, ps.nickname, us.experience, us.level
+                    WITH blogger AS (
+                        SELECT referral_code FROM bloggers WHERE telegram_id = $1
+                    ),
+                    subscribers AS (
+                        SELECT u.telegram_id, u.name
+                        FROM users u JOIN blogger b ON u.referral_code = b.referral_code
+                        WHERE u.subscription_active = TRUE
+                    ),
+                    completed AS (
+                        SELECT dt.user_id, COUNT(*) AS tasks_completed
+                        FROM daily_tasks_history dt JOIN subscribers s ON dt.user_id = s.telegram_id
+                        WHERE dt.status IN ('approved', 'completed')
+                        GROUP BY dt.user_id
+                    )
+                    SELECT b.referral_code, s.telegram_id, s.name, ps.nickname, us.experience, us.level,
+                           COALESCE(c.tasks_completed, 0) AS tasks_completed
+                    FROM blogger b
+                    LEFT JOIN subscribers s ON 1 = 1
+                    LEFT JOIN user_stats us ON s.telegram_id = us.user_id
+                    LEFT JOIN player_stats ps ON s.telegram_id = ps.user_id
+                    LEFT JOIN completed c ON s.telegram_id = c.user_id
                     ORDER BY us.experience DESC, us.level DESC
                     LIMIT $2
-                ''', referral_code, limit)
-
-                result = []
-                for row in rows:
-                    result.append({
-                        'telegram_id': row['telegram_id'],
-                        'name': row['name'],
-                        'nickname': row['nickname'],
-                        'experience': row['experience'] or 0,
-                        'level': row['level'] or 1,
-                        'tasks_completed': row['tasks_completed'] or 0
-                    })
-                return result
-            finally:
-                await conn.close()
+                ''', blogger_telegram_id, limit)
         else:
-            async with aiosqlite.connect(self.db_path) as db:
-                # Получаем реферальный код блогера
-                blogger = await self.get_blogger_by_telegram_id(blogger_telegram_id)
-                if not blogger:
-                    return []
-
-                referral_code = blogger['referral_code']
-
-                # Получаем топ подписчиков по опыту
+            async with sqlite_connect(self.db_path) as db:
                 cursor = await db.execute('''
-                    SELECT
-                        u.telegram_id,
-                        u.name,
-                        ps.nickname,
-                        us.experience,
-                        us.level,
-                        COUNT(dt.id) as tasks_completed
-                    FROM users u
-                    LEFT JOIN user_stats us ON u.telegram_id = us.user_id
-                    LEFT JOIN player_stats ps ON u.telegram_id = ps.user_id
-                    LEFT JOIN daily_tasks dt ON u.telegram_id = dt.user_id AND dt.status IN ('approved', 'completed')
-                    WHERE u.referral_code = ?
-                    GROUP BY u.telegram_id, u.name, ps.nickname, us.experience, us.level
+                    WITH blogger AS (
+                        SELECT referral_code FROM bloggers WHERE telegram_id = ?
+                    ),
+                    subscribers AS (
+                        SELECT u.telegram_id, u.name
+                        FROM users u JOIN blogger b ON u.referral_code = b.referral_code
+                    ),
+                    completed AS (
+                        SELECT dt.user_id, COUNT(*) AS tasks_completed
+                        FROM daily_tasks_history dt JOIN subscribers s ON dt.user_id = s.telegram_id
+                        WHERE dt.status IN ('approved', 'completed')
+                        GROUP BY dt.user_id
+                    )
+                    SELECT b.referral_code, s.telegram_id, s.name, ps.nickname, us.experience, us.level,
+                           COALESCE(c.tasks_completed, 0) AS tasks_completed
+                    FROM blogger b
+                    LEFT JOIN subscribers s ON 1 = 1
+                    LEFT JOIN user_stats us ON s.telegram_id = us.user_id
+                    LEFT JOIN player_stats ps ON s.telegram_id = ps.user_id
+                    LEFT JOIN completed c ON s.telegram_id = c.user_id
                     ORDER BY us.experience DESC, tasks_completed DESC
                     LIMIT ?
-                ''', (referral_code, limit))
-
+                ''', (blogger_telegram_id, limit))
                 rows = await cursor.fetchall()
 
-                result = []
-                for row in rows:
-                    telegram_id, name, nickname, experience, level, tasks_completed = row
-                    display_name = nickname or name or f"User_{telegram_id}"
-
-                    result.append({
-                        'telegram_id': telegram_id,
-                        'display_name': display_name,
-                        'experience': experience or 0,
-                        'level': level or 1,
-                        'tasks_completed': tasks_completed or 0
-                    })
+        if not rows:
+            return []
 
-                return result
+        result = []
+        for row in rows:
+            _, telegram_id, name, nickname, experience, level, tasks_completed = tuple(row)
+            if telegram_id is None:
+                continue
+            result.append({
+                'telegram_id': telegram_id,
+                'display_name': nickname or name or f"User_{telegram_id}",
+                'experience': experience or 0,
+                'level': level or 1,
+                'tasks_completed': tasks_completed or 0
+            })
+
+        self._set_blogger_cache(cache_key, rows[0][0], result)
+        return result
 
     # Методы для статистики модерации
     async def get_moderator_stats(self, moderator_id: int) -> dict:
-        """Получение статистики модерации для конкретного модератора"""
+        """Получение статистики модерации для конкретного модератора (один запрос к журналу модерации)"""
+        today = datetime.datetime.now().replace(hour=0, minute=0, second=0, microsecond=0)
+        counts = {'approved': (0, 0), 'rejected': (0, 0)}
+
         if self.use_postgres:
             conn = await _get_postgres_connection()
             try:
-                # Статистика за все время
-                total_moderated = await conn.fetchval('''
-                    SELECT COUNT(*) FROM daily_tasks
-                    WHERE moderator_comment LIKE $1
-                ''', f'%Одобрено модератором {moderator_id}%') or 0
-
-                # Статистика за сегодня
-                today_start = datetime.datetime.now().replace(hour=0, minute=0, second=0, microsecond=0)
-                today_moderated = await conn.fetchval('''
-                    SELECT COUNT(*) FROM daily_tasks
-                    WHERE moderator_comment LIKE $1
-                    AND updated_at >= $2
-                ''', f'%Одобрено модератором {moderator_id}%', today_start) or 0
-
-                # Статистика одобренных заданий
-                approved = await conn.fetchval('''
-                    SELECT COUNT(*) FROM daily_tasks
-                    WHERE status = 'approved'
-                    AND moderator_comment LIKE $1
-                ''', f'%Одобрено модератором {moderator_id}%') or 0
-
-                # Статистика отклоненных заданий
-                rejected = await conn.fetchval('''
-                    SELECT COUNT(*) FROM daily_tasks
-                    WHERE status = 'rejected'
-                    AND moderator_comment LIKE $1
-                ''', f'%Отклонено модератором {moderator_id}%') or 0
-
-                # Статистика отклоненных заданий за сегодня
-                today_rejected = await conn.fetchval('''
-                    SELECT COUNT(*) FROM daily_tasks
-                    WHERE status = 'rejected'
-                    AND moderator_comment LIKE $1
-                    AND updated_at >= $2
-                ''', f'%Отклонено модератором {moderator_id}%', today_start) or 0
-
-                return {
-                    'moderator_id': moderator_id,
-                    'total_moderated': total_moderated,
-                    'today_moderated': today_moderated,
-                    'approved': approved,
-                    'rejected': rejected,
-                    'total_tasks': total_moderated + rejected,
-                    'today_tasks': today_moderated + today_rejected
-                }
+                rows = await conn.fetch('''
+                    SELECT action, COUNT(*) AS total, COUNT(*) FILTER (WHERE created_at >= $2) AS today
+                    FROM moderation_events
+                    WHERE moderator_id = $1
+                    GROUP BY action
+                ''', moderator_id, today)
+                for row in rows:
+                    counts[row['action']] = (row['total'], row['today'])
             finally:
                 await conn.close()
         else:
-            async with aiosqlite.connect(self.db_path) as db:
-                # Статистика за все время
-                cursor = await db.execute('''
-                SELECT COUNT(*) as total_moderated
-                FROM daily_tasks
-                WHERE moderator_comment LIKE ?
-                ''', (f"Одобрено модератором {moderator_id}%",))
-
-                total_row = await cursor.fetchone()
-                total_moderated = total_row[0] if total_row else 0
-
-                # Статистика за сегодня
-                today_start = int(datetime.datetime.now().replace(hour=0, minute=0, second=0, microsecond=0).timestamp())
-                today_end = today_start + 86400  # 24 часа
-
+            async with sqlite_connect(self.db_path) as db:
                 cursor = await db.execute('''
-                    SELECT COUNT(*) as today_moderated
-                    FROM daily_tasks
-                    WHERE moderator_comment LIKE ?
-                    AND completed_at >= ? AND completed_at < ?
-                ''', (f"Одобрено модератором {moderator_id}%", today_start, today_end))
-
-                today_row = await cursor.fetchone()
-                today_moderated = today_row[0] if today_row else 0
-
-                # Статистика отклоненных заданий за все время
-                cursor = await db.execute('''
-                    SELECT COUNT(*) as total_rejected
-                    FROM daily_tasks
-                    WHERE moderator_comment LIKE ?
-                ''', (f"Отклонено модератором {moderator_id}%",))
-
-                rejected_row = await cursor.fetchone()
-                total_rejected = rejected_row[0] if rejected_row else 0
+                    SELECT action, COUNT(*), SUM(CASE WHEN created_at >= ? THEN 1 ELSE 0 END)
+                    FROM moderation_events
+                    WHERE moderator_id = ?
+                    GROUP BY action
+                ''', (int(today.timestamp()), moderator_id))
+                for action, total, today_count in await cursor.fetchall():
+                    counts[action] = (total, today_count or 0)
+
+        total_moderated, today_moderated = counts['approved']
+        total_rejected, today_rejected = counts['rejected']
+        return {
+            'moderator_id': moderator_id,
+            'total_moderated': total_moderated,
+            'today_moderated': today_moderated,
+            'total_rejected': total_rejected,
+            'today_rejected': today_rejected,
+            'approved': total_moderated,
+            'rejected': total_rejected,
+            'total_tasks': total_moderated + total_rejected,
+            'today_tasks': today_moderated + today_rejected
+        }
 
-                # Статистика отклоненных заданий за сегодня
-                cursor = await db.execute('''
-                    SELECT COUNT(*) as today_rejected
-                    FROM daily_tasks
-                    WHERE moderator_comment LIKE ?
-                    AND completed_at >= ? AND completed_at < ?
-                ''', (f"Отклонено модератором {moderator_id}%", today_start, today_end))
-
-                today_rejected_row = await cursor.fetchone()
-                today_rejected = today_rejected_row[0] if today_rejected_row else 0
-
-                return {
-                    'total_moderated': total_moderated,
-                    'today_moderated': today_moderated,
-                    'total_rejected': total_rejected,
-                    'today_rejected': today_rejected,
-                    'total_tasks': total_moderated + total_rejected,
-                    'today_tasks': today_moderated + today_rejected
-                }
+    async def get_pending_tasks_count(self) -> int:
+        """Количество заданий, ожидающих модерации"""
+        if self.use_postgres:
+            conn = await _get_postgres_connection()
+            try:
+                return await conn.fetchval("SELECT COUNT(*) FROM daily_tasks WHERE status = 'submitted'") or 0
+            finally:
+                await conn.close()
+        else:
+            async with sqlite_connect(self.db_path) as db:
+                cursor = await db.execute("SELECT COUNT(*) FROM daily_tasks WHERE status = 'submitted'")
+                row = await cursor.fetchone()
+                return row[0] if row else 0
 
     # Методы для управления модераторами
 
@@ -3753,6 +4634,7 @@ class Database:
                         updated_at = EXCLUDED.updated_at
                 ''', telegram_id, username, full_name, current_time, current_time)
                 logger.info(f"Модератор {telegram_id} добавлен/обновлен (PostgreSQL)")
+                self.invalidate_staff_roles()
                 return True
             except Exception as e:
                 logger.error(f"Ошибка добавления модератора {telegram_id}: {e}")
@@ -3760,7 +4642,7 @@ class Database:
             finally:
                 await conn.close()
         else:
-            async with aiosqlite.connect(self.db_path) as db:
+            async with sqlite_connect(self.db_path) as db:
                 try:
                     current_time = int(datetime.datetime.now().timestamp())
                     await db.execute('''
@@ -3774,6 +4656,7 @@ class Database:
                     ''', (telegram_id, username, full_name, current_time, current_time))
                     await db.commit()
                     logger.info(f"Модератор {telegram_id} добавлен/обновлен")
+                    self.invalidate_staff_roles()
                     return True
                 except Exception as e:
                     await db.rollback()
@@ -3789,6 +4672,7 @@ class Database:
                 deleted = result == 'DELETE 1'
                 if deleted:
                     logger.info(f"Модератор {telegram_id} удален (PostgreSQL)")
+                self.invalidate_staff_roles()
                 return deleted
             except Exception as e:
                 logger.error(f"Ошибка удаления модератора {telegram_id}: {e}")
@@ -3796,13 +4680,14 @@ class Database:
             finally:
                 await conn.close()
         else:
-            async with aiosqlite.connect(self.db_path) as db:
+            async with sqlite_connect(self.db_path) as db:
                 try:
                     cursor = await db.execute('DELETE FROM moderators WHERE telegram_id = ?', (telegram_id,))
                     deleted = cursor.rowcount > 0
                     await db.commit()
                     if deleted:
                         logger.info(f"Модератор {telegram_id} удален")
+                    self.invalidate_staff_roles()
                     return deleted
                 except Exception as e:
                     await db.rollback()
@@ -3822,7 +4707,7 @@ class Database:
             finally:
                 await conn.close()
         else:
-            async with aiosqlite.connect(self.db_path) as db:
+            async with sqlite_connect(self.db_path) as db:
                 db.row_factory = aiosqlite.Row
 
                 query = 'SELECT * FROM moderators'
@@ -3850,7 +4735,7 @@ class Database:
             finally:
                 await conn.close()
         else:
-            async with aiosqlite.connect(self.db_path) as db:
+            async with sqlite_connect(self.db_path) as db:
                 db.row_factory = aiosqlite.Row
                 cursor = await db.execute('SELECT * FROM moderators WHERE telegram_id = ?', (telegram_id,))
                 row = await cursor.fetchone()
@@ -3875,6 +4760,8 @@ class Database:
                         updated_at = EXCLUDED.updated_at
                 ''', telegram_id, username, full_name, referral_code, current_time, current_time)
                 logger.info(f"Блогер {telegram_id} с реферальным кодом {referral_code} добавлен/обновлен (PostgreSQL)")
+                self.invalidate_staff_roles()
+                self.invalidate_blogger_stats()
                 return True
             except Exception as e:
                 logger.error(f"Ошибка добавления блогера {telegram_id}: {e}")
@@ -3882,7 +4769,7 @@ class Database:
             finally:
                 await conn.close()
         else:
-            async with aiosqlite.connect(self.db_path) as db:
+            async with sqlite_connect(self.db_path) as db:
                 try:
                     current_time = int(datetime.datetime.now().timestamp())
                     await db.execute('''
@@ -3897,6 +4784,8 @@ class Database:
                     ''', (telegram_id, username, full_name, referral_code, current_time, current_time))
                     await db.commit()
                     logger.info(f"Блогер {telegram_id} с реферальным кодом {referral_code} добавлен/обновлен")
+                    self.invalidate_staff_roles()
+                    self.invalidate_blogger_stats()
                     return True
                 except Exception as e:
                     await db.rollback()
@@ -3912,6 +4801,8 @@ class Database:
                 deleted = result == 'DELETE 1'
                 if deleted:
                     logger.info(f"Блогер {telegram_id} удален (PostgreSQL)")
+                self.invalidate_staff_roles()
+                self.invalidate_blogger_stats()
                 return deleted
             except Exception as e:
                 logger.error(f"Ошибка удаления блогера {telegram_id}: {e}")
@@ -3919,13 +4810,15 @@ class Database:
             finally:
                 await conn.close()
         else:
-            async with aiosqlite.connect(self.db_path) as db:
+            async with sqlite_connect(self.db_path) as db:
                 try:
                     cursor = await db.execute('DELETE FROM bloggers WHERE telegram_id = ?', (telegram_id,))
                     deleted = cursor.rowcount > 0
                     await db.commit()
                     if deleted:
                         logger.info(f"Блогер {telegram_id} удален")
+                    self.invalidate_staff_roles()
+                    self.invalidate_blogger_stats()
                     return deleted
                 except Exception as e:
                     await db.rollback()
@@ -3945,7 +4838,7 @@ class Database:
             finally:
                 await conn.close()
         else:
-            async with aiosqlite.connect(self.db_path) as db:
+            async with sqlite_connect(self.db_path) as db:
                 db.row_factory = aiosqlite.Row
 
                 query = 'SELECT * FROM bloggers'
@@ -3973,7 +4866,7 @@ class Database:
             finally:
                 await conn.close()
         else:
-            async with aiosqlite.connect(self.db_path) as db:
+            async with sqlite_connect(self.db_path) as db:
                 db.row_factory = aiosqlite.Row
                 cursor = await db.execute('SELECT * FROM bloggers WHERE telegram_id = ?', (telegram_id,))
                 row = await cursor.fetchone()
@@ -3992,7 +4885,7 @@ class Database:
             finally:
                 await conn.close()
         else:
-            async with aiosqlite.connect(self.db_path) as db:
+            async with sqlite_connect(self.db_path) as db:
                 db.row_factory = aiosqlite.Row
                 cursor = await db.execute('SELECT * FROM bloggers WHERE referral_code = ? AND is_active = 1', (referral_code,))
                 row = await cursor.fetchone()
@@ -4018,3 +4911,63 @@ class Database:
         except ImportError:
             # Fallback на случай если moderator_config не доступен
             return []
+
+    async def get_staff_roles(self) -> dict[int, str]:
+        """
+        Получение словаря ролей персонала: telegram_id -> "admin" / "blogger" / "moderator".
+        Словарь кэшируется в памяти процесса на role_cache_ttl секунд и сбрасывается
+        при добавлении/удалении модераторов и блогеров.
+        """
+        now = time.monotonic()
+        if self._staff_roles is not None and now - self._staff_roles_loaded_at < self.role_cache_ttl:
+            return self._staff_roles
+
+        version = self._staff_roles_version
+        roles: dict[int, str] = {}
+        # Порядок важен: при совпадении ID приоритет у админа, затем у блогера
+        for telegram_id in await self.get_moderator_telegram_ids():
+            roles[telegram_id] = "moderator"
+        for telegram_id in await self.get_blogger_telegram_ids():
+            roles[telegram_id] = "blogger"
+        for telegram_id in await self.get_admin_telegram_ids():
+            roles[telegram_id] = "admin"
+
+        # Если во время загрузки состав персонала изменился, не сохраняем устаревший словарь
+        if version == self._staff_roles_version:
+            self._staff_roles = roles
+            self._staff_roles_loaded_at = now
+        logger.info(f"Загружены роли персонала: {len(roles)} записей")
+        return roles
+
+    def invalidate_staff_roles(self):
+        """Сброс кэша ролей персонала"""
+        self._staff_roles = None
+        self._staff_roles_version += 1
+
+    async def get_scheduler_last_runs(self) -> dict[str, int]:
+        """Время последнего запуска фоновых задач: имя задачи -> unix timestamp"""
+        rows = await self.queries.fetch(_Q_SCHEDULER_LAST_RUNS)
+        return {row['name']: row['last_run_at'] for row in rows if row['last_run_at'] is not None}
+
+    async def get_scheduler_jobs(self) -> list[dict]:
+        """Состояние фоновых задач (последний запуск, длительность, ошибки) для команды статуса"""
+        rows = await self.queries.fetch(_Q_SCHEDULER_JOBS)
+        return [dict(row) for row in rows]
+
+    async def save_scheduler_job_start(self, name: str, started_at: int):
+        """Сохранение времени запуска фоновой задачи"""
+        await self.queries.execute(_Q_SCHEDULER_JOB_START, name, started_at)
+
+    async def save_scheduler_job_result(self, name: str, duration_ms: int, error: Optional[str] = None):
+        """Сохранение длительности и ошибки последнего запуска фоновой задачи"""
+        await self.queries.execute(_Q_SCHEDULER_JOB_RESULT, duration_ms, error, 1 if error else 0, name)
+
+    async def save_metrics_snapshot(self, process: str, snapshot: dict):
+        """Сохранение метрик обращений к БД процесса"""
+        await self.queries.execute(_Q_SAVE_METRICS_SNAPSHOT, process, snapshot['updated_at'], json.dumps(snapshot))
+
+    async def get_metrics_snapshots(self, max_age: int = 3600) -> list[dict]:
+        """Метрики процессов, обновленные не раньше max_age секунд назад"""
+        since = int(datetime.datetime.now().timestamp()) - max_age
+        rows = await self.queries.fetch(_Q_METRICS_SNAPSHOTS, since)
+        return [{'process': row['process'], **json.loads(row['data'])} for row in rows]
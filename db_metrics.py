@@ -0,0 +1,392 @@
+"""
+Метрики обращений к базе данных.
+
+Декоратор класса instrument_methods оборачивает публичные асинхронные методы Database:
+для каждого метода считаются вызовы и ошибки, гистограмма задержек (p50/p95/p99),
+количество возвращенных строк и время ожидания соединения (подключение, пул, блокировка записи).
+Слой запросов и соединения PostgreSQL сообщают о выполненных SQL-запросах в контекст текущего
+вызова, поэтому вызов дольше DB_SLOW_QUERY_MS попадает в журнал медленных запросов вместе
+с текстом SQL и формой параметров (типы и размеры, без значений).
+
+Метрики процесса отдаются HTTP-эндпоинтом (/metrics в формате Prometheus, /metrics.json)
+и периодически сохраняются в таблицу db_metrics, откуда их читает команда модераторского бота.
+"""
+import asyncio
+import bisect
+import contextvars
+import functools
+import inspect
+import logging
+import os
+import re
+import socket
+import time
+from collections import deque
+from dataclasses import dataclass, field
+from typing import Any, Optional
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+# Сбор метрик можно отключить; порог медленного вызова (мс) и размер журнала медленных вызовов
+DB_METRICS_ENABLED = os.getenv("DB_METRICS_ENABLED", "true").lower() == "true"
+DB_SLOW_QUERY_MS = float(os.getenv("DB_SLOW_QUERY_MS", "500"))
+DB_SLOW_QUERY_LOG_SIZE = int(os.getenv("DB_SLOW_QUERY_LOG_SIZE", "50"))
+
+# Границы корзин гистограммы (мс): геометрическая прогрессия от 0.1 мс до ~2 минут с шагом 20%,
+# поэтому ошибка оценки перцентиля не больше 20% при фиксированной памяти на метод
+BUCKET_BOUNDS = tuple(round(0.1 * 1.2 ** i, 4) for i in range(78))
+
+# Сколько SQL-запросов одного вызова сохраняется в журнале медленных вызовов
+_MAX_STATEMENTS_PER_CALL = 10
+
+_WHITESPACE = re.compile(r'\s+')
+
+
+class LatencyHistogram:
+    """Гистограмма задержек с фиксированными корзинами"""
+
+    __slots__ = ('counts',)
+
+    def __init__(self, counts: Optional[list[int]] = None):
+        self.counts = counts if counts is not None else [0] * (len(BUCKET_BOUNDS) + 1)
+
+    def observe(self, ms: float):
+        self.counts[bisect.bisect_left(BUCKET_BOUNDS, ms)] += 1
+
+    def merge(self, other: "LatencyHistogram"):
+        for index, count in enumerate(other.counts):
+            self.counts[index] += count
+
+    def percentile(self, p: float) -> float:
+        """Верхняя граница корзины, в которую попадает перцентиль p (0-100)"""
+        total = sum(self.counts)
+        if not total:
+            return 0.0
+        rank = total * p / 100
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank and count:
+                return BUCKET_BOUNDS[index] if index < len(BUCKET_BOUNDS) else float('inf')
+        return float('inf')
+
+
+@dataclass(slots=True)
+class MethodStats:
+    """Накопленные метрики одного метода"""
+    calls: int = 0
+    errors: int = 0
+    total_ms: float = 0.0
+    max_ms: float = 0.0
+    rows: int = 0
+    wait_ms: float = 0.0
+    histogram: LatencyHistogram = field(default_factory=LatencyHistogram)
+
+    def to_dict(self) -> dict:
+        return {
+            'calls': self.calls, 'errors': self.errors, 'total_ms': round(self.total_ms, 3),
+            'max_ms': round(self.max_ms, 3), 'rows': self.rows, 'wait_ms': round(self.wait_ms, 3),
+            'buckets': list(self.histogram.counts),
+        }
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "MethodStats":
+        return cls(data['calls'], data['errors'], data['total_ms'], data['max_ms'], data['rows'],
+                   data['wait_ms'], LatencyHistogram(list(data['buckets'])))
+
+    def merge(self, other: "MethodStats"):
+        self.calls += other.calls
+        self.errors += other.errors
+        self.total_ms += other.total_ms
+        self.max_ms = max(self.max_ms, other.max_ms)
+        self.rows += other.rows
+        self.wait_ms += other.wait_ms
+        self.histogram.merge(other.histogram)
+
+
+@dataclass(slots=True)
+class _CallRecord:
+    """Контекст текущего вызова метода: ожидание соединения и выполненные запросы"""
+    method: str
+    wait_ms: float = 0.0
+    statements: list = field(default_factory=list)
+
+
+_current_call: contextvars.ContextVar[Optional[_CallRecord]] = contextvars.ContextVar('db_call', default=None)
+
+
+def value_shape(value: Any) -> str:
+    """Форма значения без самого значения: тип, для коллекций - размер"""
+    if value is None:
+        return 'None'
+    if isinstance(value, (list, tuple, set, frozenset, dict)):
+        return f"{type(value).__name__}[{len(value)}]"
+    if isinstance(value, (str, bytes)):
+        return f"{type(value).__name__}({len(value)})"
+    return type(value).__name__
+
+
+def _normalize_sql(sql: str) -> str:
+    return _WHITESPACE.sub(' ', sql).strip()
+
+
+def note_connection_wait(seconds: float):
+    """Учет ожидания соединения в текущем вызове"""
+    record = _current_call.get()
+    if record is not None:
+        record.wait_ms += seconds * 1000
+
+
+def note_statement(sql: str, args: tuple, seconds: float):
+    """Учет выполненного SQL-запроса в текущем вызове (для журнала медленных вызовов)"""
+    record = _current_call.get()
+    if record is not None and len(record.statements) < _MAX_STATEMENTS_PER_CALL:
+        record.statements.append({
+            'sql': _normalize_sql(sql),
+            'params': [value_shape(arg) for arg in args],
+            'ms': round(seconds * 1000, 3),
+        })
+
+
+def log_postgres_query(query):
+    """Обработчик журнала запросов asyncpg (Connection.add_query_logger)"""
+    note_statement(query.query, query.args or (), query.elapsed)
+
+
+def count_rows(result: Any) -> int:
+    """Количество строк в результате метода"""
+    if result is None or isinstance(result, bool):
+        return 0
+    if isinstance(result, list):
+        return len(result)
+    return 1
+
+
+class DatabaseMetrics:
+    """Метрики обращений к базе данных в текущем процессе"""
+
+    def __init__(self, slow_query_ms: float = DB_SLOW_QUERY_MS, slow_log_size: int = DB_SLOW_QUERY_LOG_SIZE):
+        self.slow_query_ms = slow_query_ms
+        self.enabled = DB_METRICS_ENABLED
+        self.methods: dict[str, MethodStats] = {}
+        self.slow_queries: deque = deque(maxlen=slow_log_size)
+        self.started_at = int(time.time())
+
+    def record(self, call: _CallRecord, elapsed_ms: float, rows: int, error: Optional[BaseException],
+               args: tuple, kwargs: dict):
+        stats = self.methods.get(call.method)
+        if stats is None:
+            stats = self.methods[call.method] = MethodStats()
+        stats.calls += 1
+        stats.total_ms += elapsed_ms
+        stats.max_ms = max(stats.max_ms, elapsed_ms)
+        stats.rows += rows
+        stats.wait_ms += call.wait_ms
+        stats.histogram.observe(elapsed_ms)
+        if error is not None:
+            stats.errors += 1
+
+        if elapsed_ms >= self.slow_query_ms:
+            self.slow_queries.append({
+                'method': call.method,
+                'at': int(time.time()),
+                'ms': round(elapsed_ms, 3),
+                'wait_ms': round(call.wait_ms, 3),
+                'args': [value_shape(arg) for arg in args],
+                'kwargs': {name: value_shape(value) for name, value in kwargs.items()},
+                'error': type(error).__name__ if error is not None else None,
+                # Запросы PostgreSQL могут дописываться после завершения вызова (журнал asyncpg
+                # вызывается через call_soon), поэтому хранится сам список
+                'statements': call.statements,
+            })
+            logger.warning(
+                f"Медленный вызов БД {call.method}: {elapsed_ms:.1f} мс "
+                f"(ожидание соединения {call.wait_ms:.1f} мс, запросов {len(call.statements)})"
+            )
+
+    def reset(self):
+        self.methods.clear()
+        self.slow_queries.clear()
+        self.started_at = int(time.time())
+
+    def snapshot(self) -> dict:
+        """Метрики в виде, пригодном для JSON и для объединения с другими процессами"""
+        return {
+            'started_at': self.started_at,
+            'updated_at': int(time.time()),
+            'slow_query_ms': self.slow_query_ms,
+            'methods': {name: stats.to_dict() for name, stats in self.methods.items()},
+            'slow_queries': list(self.slow_queries),
+        }
+
+
+# Метрики процесса (одни на все экземпляры Database)
+DB_METRICS = DatabaseMetrics()
+
+
+def _instrumented(name: str, func):
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        metrics = DB_METRICS
+        if not metrics.enabled:
+            return await func(*args, **kwargs)
+        call = _CallRecord(name)
+        token = _current_call.set(call)
+        started = time.perf_counter()
+        result = None
+        error = None
+        try:
+            result = await func(*args, **kwargs)
+            return result
+        except Exception as e:
+            error = e
+            raise
+        finally:
+            _current_call.reset(token)
+            # Первый аргумент - self
+            metrics.record(call, (time.perf_counter() - started) * 1000, count_rows(result), error,
+                           args[1:], kwargs)
+    return wrapper
+
+
+def instrument_methods(exclude: tuple[str, ...] = ()):
+    """Декоратор класса: метрики для всех публичных корутин класса, кроме exclude"""
+    def decorate(cls):
+        for name, member in list(vars(cls).items()):
+            if name.startswith('_') or name in exclude or not inspect.iscoroutinefunction(member):
+                continue
+            setattr(cls, name, _instrumented(name, member))
+        return cls
+    return decorate
+
+
+def merge_snapshots(snapshots: list[dict]) -> dict[str, MethodStats]:
+    """Объединение метрик методов нескольких процессов"""
+    merged: dict[str, MethodStats] = {}
+    for snapshot in snapshots:
+        for name, data in snapshot.get('methods', {}).items():
+            stats = MethodStats.from_dict(data)
+            if name in merged:
+                merged[name].merge(stats)
+            else:
+                merged[name] = stats
+    return merged
+
+
+def summarize(methods: dict[str, MethodStats]) -> list[dict]:
+    """Сводка по методам с перцентилями, по убыванию суммарного времени"""
+    summary = []
+    for name, stats in methods.items():
+        summary.append({
+            'method': name,
+            'calls': stats.calls,
+            'errors': stats.errors,
+            'avg_ms': stats.total_ms / stats.calls if stats.calls else 0.0,
+            'p50_ms': stats.histogram.percentile(50),
+            'p95_ms': stats.histogram.percentile(95),
+            'p99_ms': stats.histogram.percentile(99),
+            'max_ms': stats.max_ms,
+            'total_ms': stats.total_ms,
+            'rows': stats.rows,
+            'wait_ms': stats.wait_ms,
+        })
+    summary.sort(key=lambda item: item['total_ms'], reverse=True)
+    return summary
+
+
+def render_prometheus(metrics: DatabaseMetrics = DB_METRICS) -> str:
+    """Метрики процесса в текстовом формате Prometheus"""
+    lines = [
+        '# HELP lvlbot_db_call_duration_milliseconds Длительность вызовов методов Database',
+        '# TYPE lvlbot_db_call_duration_milliseconds histogram',
+    ]
+    for name, stats in sorted(metrics.methods.items()):
+        cumulative = 0
+        for bound, count in zip(BUCKET_BOUNDS, stats.histogram.counts):
+            cumulative += count
+            lines.append(f'lvlbot_db_call_duration_milliseconds_bucket{{method="{name}",le="{bound}"}} {cumulative}')
+        lines.append(f'lvlbot_db_call_duration_milliseconds_bucket{{method="{name}",le="+Inf"}} {stats.calls}')
+        lines.append(f'lvlbot_db_call_duration_milliseconds_sum{{method="{name}"}} {stats.total_ms:.3f}')
+        lines.append(f'lvlbot_db_call_duration_milliseconds_count{{method="{name}"}} {stats.calls}')
+    for metric, help_text, attr in (
+        ('lvlbot_db_call_errors_total', 'Вызовы методов Database, завершившиеся ошибкой', 'errors'),
+        ('lvlbot_db_rows_total', 'Строки, возвращенные методами Database', 'rows'),
+        ('lvlbot_db_connection_wait_milliseconds_total', 'Ожидание соединения в методах Database', 'wait_ms'),
+    ):
+        lines.append(f'# HELP {metric} {help_text}')
+        lines.append(f'# TYPE {metric} counter')
+        for name, stats in sorted(metrics.methods.items()):
+            lines.append(f'{metric}{{method="{name}"}} {getattr(stats, attr)}')
+    lines.append('# HELP lvlbot_db_slow_calls Вызовы в журнале медленных вызовов')
+    lines.append('# TYPE lvlbot_db_slow_calls gauge')
+    lines.append(f'lvlbot_db_slow_calls {len(metrics.slow_queries)}')
+    return '\n'.join(lines) + '\n'
+
+
+def process_name(role: str) -> str:
+    """Имя процесса для сохраненных метрик: роль и хост (при перезапуске строка перезаписывается)"""
+    return f"{role}@{socket.gethostname()}"
+
+
+class MetricsReporter:
+    """
+    HTTP-эндпоинт метрик процесса (порт 0 - не запускается) и периодическое сохранение
+    метрик в таблицу db_metrics для команды модераторского бота.
+    """
+
+    def __init__(self, db, role: str, port: int = 0, host: str = '0.0.0.0', interval: float = 60):
+        self.db = db
+        self.process = process_name(role)
+        self.port = port
+        self.host = host
+        self.interval = interval
+        self._runner = None
+        self._task: Optional[asyncio.Task] = None
+
+    async def start(self):
+        if self.port:
+            from aiohttp import web
+
+            async def handle_metrics(request):
+                return web.Response(text=render_prometheus(), content_type='text/plain')
+
+            async def handle_metrics_json(request):
+                return web.json_response({'process': self.process, **DB_METRICS.snapshot()})
+
+            app = web.Application()
+            app.router.add_get('/metrics', handle_metrics)
+            app.router.add_get('/metrics.json', handle_metrics_json)
+            self._runner = web.AppRunner(app)
+            await self._runner.setup()
+            await web.TCPSite(self._runner, self.host, self.port).start()
+            logger.info(f"Метрики БД доступны на {self.host}:{self.port}/metrics")
+        if self.interval > 0 and self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            await self.save()
+
+    async def save(self):
+        try:
+            await self.db.save_metrics_snapshot(self.process, DB_METRICS.snapshot())
+        except Exception as e:
+            logger.error(f"Ошибка сохранения метрик БД: {e}")
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+            await self.save()
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
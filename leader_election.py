@@ -0,0 +1,230 @@
+"""
+Выбор ведущего процесса для фоновых задач.
+
+Если запущено несколько экземпляров bot.py, фоновые задачи (проверка платежей, сброс опыта,
+предупреждения) должны выполняться только в одном из них. Ведущим становится процесс,
+захвативший блокировку:
+- PostgreSQL: сессионная advisory-блокировка на отдельном соединении;
+- SQLite: fcntl-блокировка файла рядом с базой.
+Обе блокировки снимаются автоматически при завершении процесса (и при обрыве соединения
+с PostgreSQL), после чего ее захватывает один из остальных процессов.
+"""
+import asyncio
+import datetime
+import json
+import logging
+import os
+import socket
+import zlib
+from typing import Awaitable, Callable, Optional
+
+import asyncpg
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+from query_layer import Query
+
+logger = logging.getLogger(__name__)
+
+# Ключ advisory-блокировки (32 бита, чтобы в pg_locks он целиком попадал в objid)
+LEADER_LOCK_KEY = zlib.crc32(b"lvlbot:scheduler")
+
+_Q_ADVISORY_LOCK_HOLDER = Query('''
+    SELECT a.application_name, a.client_addr, a.backend_start
+    FROM pg_locks l
+    JOIN pg_stat_activity a ON a.pid = l.pid
+    WHERE l.locktype = 'advisory' AND l.classid = 0 AND l.objid = ? AND l.granted
+''')
+
+
+def leader_identity() -> str:
+    """Идентификатор процесса: хост и PID"""
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+def default_lock_file(db_path: str) -> str:
+    """Файл блокировки для SQLite - рядом с файлом базы"""
+    return f"{db_path}.leader.lock"
+
+
+class FileLeaderLock:
+    """Блокировка ведущего через fcntl.flock на файле"""
+
+    def __init__(self, path: str, identity: str):
+        self.path = path
+        self.identity = identity
+        self._file = None
+
+    async def try_acquire(self) -> bool:
+        if fcntl is None:
+            logger.warning("fcntl недоступен, процесс считается ведущим без блокировки")
+            return True
+        # Файл не обрезается до захвата блокировки, чтобы не стереть данные текущего ведущего
+        file = open(self.path, "a+")
+        try:
+            fcntl.flock(file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            file.close()
+            return False
+        file.seek(0)
+        file.truncate()
+        json.dump({'identity': self.identity, 'since': int(datetime.datetime.now().timestamp())}, file)
+        file.flush()
+        self._file = file
+        return True
+
+    async def is_held(self) -> bool:
+        # Блокировка файла не может быть потеряна, пока жив процесс
+        return True
+
+    async def release(self):
+        if self._file is not None:
+            self._file.truncate(0)
+            fcntl.flock(self._file.fileno(), fcntl.LOCK_UN)
+            self._file.close()
+            self._file = None
+
+
+class PostgresLeaderLock:
+    """Блокировка ведущего через pg_try_advisory_lock на отдельном соединении"""
+
+    def __init__(self, identity: str, key: int = LEADER_LOCK_KEY):
+        self.identity = identity
+        self.key = key
+        self._conn: Optional[asyncpg.Connection] = None
+
+    async def try_acquire(self) -> bool:
+        from postgres_config import get_postgres_connection_params
+
+        if self._conn is None or self._conn.is_closed():
+            self._conn = await asyncpg.connect(
+                **get_postgres_connection_params(),
+                server_settings={
+                    # По имени приложения команда статуса показывает, кто ведущий
+                    'application_name': f"lvlbot-leader {self.identity}"[:63],
+                    # Сервер быстрее замечает обрыв соединения и снимает блокировку
+                    'tcp_keepalives_idle': '10',
+                    'tcp_keepalives_interval': '5',
+                    'tcp_keepalives_count': '3',
+                },
+            )
+        acquired = await self._conn.fetchval('SELECT pg_try_advisory_lock($1)', self.key)
+        if not acquired:
+            await self._close()
+        return acquired
+
+    async def is_held(self) -> bool:
+        if self._conn is None or self._conn.is_closed():
+            return False
+        try:
+            await self._conn.fetchval('SELECT 1')
+            return True
+        except Exception as e:
+            logger.error(f"Соединение с блокировкой ведущего потеряно: {e}")
+            await self._close()
+            return False
+
+    async def release(self):
+        if self._conn is not None and not self._conn.is_closed():
+            try:
+                await self._conn.execute('SELECT pg_advisory_unlock($1)', self.key)
+            except Exception as e:
+                logger.error(f"Ошибка при снятии блокировки ведущего: {e}")
+        await self._close()
+
+    async def _close(self):
+        if self._conn is not None:
+            try:
+                await self._conn.close()
+            except Exception:
+                self._conn.terminate()
+            self._conn = None
+
+
+def create_leader_lock(db, lock_file: Optional[str] = None):
+    """Блокировка ведущего для бэкенда базы данных"""
+    identity = leader_identity()
+    if db.use_postgres:
+        return PostgresLeaderLock(identity)
+    return FileLeaderLock(lock_file or default_lock_file(db.db_path), identity)
+
+
+async def get_leader_info(db, lock_file: Optional[str] = None) -> Optional[dict]:
+    """Кто сейчас ведущий: {'identity', 'since'} или None, если ведущего нет"""
+    if db.use_postgres:
+        row = await db.queries.fetchrow(_Q_ADVISORY_LOCK_HOLDER, LEADER_LOCK_KEY)
+        if row is None:
+            return None
+        identity = row['application_name'].removeprefix("lvlbot-leader ")
+        if row['client_addr'] is not None:
+            identity += f" ({row['client_addr']})"
+        return {'identity': identity, 'since': int(row['backend_start'].timestamp())}
+
+    path = lock_file or default_lock_file(db.db_path)
+    if fcntl is None or not os.path.exists(path):
+        return None
+    with open(path, "r") as file:
+        try:
+            # Если блокировку удалось взять, ведущего нет
+            fcntl.flock(file.fileno(), fcntl.LOCK_SH | fcntl.LOCK_NB)
+            fcntl.flock(file.fileno(), fcntl.LOCK_UN)
+            return None
+        except BlockingIOError:
+            pass
+        try:
+            return json.loads(file.read())
+        except ValueError:
+            return {'identity': 'неизвестно', 'since': None}
+
+
+class LeaderElection:
+    """
+    Периодическая попытка стать ведущим. При избрании вызывается on_elected (запуск
+    планировщика), при потере блокировки или остановке - on_lost.
+    """
+
+    def __init__(self, lock, on_elected: Callable[[], Awaitable], on_lost: Callable[[], Awaitable],
+                 retry_interval: float = 10):
+        self.lock = lock
+        self.on_elected = on_elected
+        self.on_lost = on_lost
+        self.retry_interval = retry_interval
+        self.is_leader = False
+        self._task: Optional[asyncio.Task] = None
+
+    async def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def _run(self):
+        while True:
+            try:
+                if not self.is_leader:
+                    if await self.lock.try_acquire():
+                        self.is_leader = True
+                        logger.info(f"Процесс {leader_identity()} стал ведущим, запускаем фоновые задачи")
+                        await self.on_elected()
+                elif not await self.lock.is_held():
+                    self.is_leader = False
+                    logger.warning("Блокировка ведущего потеряна, останавливаем фоновые задачи")
+                    await self.on_lost()
+            except Exception as e:
+                logger.error(f"Ошибка выбора ведущего: {e}")
+            await asyncio.sleep(self.retry_interval)
+
+    async def stop(self):
+        """Остановка выборов; ведущий останавливает задачи и освобождает блокировку"""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        if self.is_leader:
+            await self.on_lost()
+            self.is_leader = False
+        await self.lock.release()
@@ -7,7 +7,7 @@ class PrizeType(Enum):
     ADMIN = "admin"        # призы от главного модератора
     BLOGGER = "blogger"    # призы от блогера
 
-@dataclass
+@dataclass(slots=True)
 class User:
     telegram_id: int
     language: Optional[str] = None
@@ -48,7 +48,7 @@ class SubscriptionStatus(Enum):
     CANCELLED = "cancelled"
     PENDING = "pending"
 
-@dataclass
+@dataclass(slots=True)
 class Payment:
     id: Optional[int] = None
     user_id: int = 0
@@ -66,7 +66,7 @@ class Payment:
     subscription_type: str = "standard"  # standard, premium, etc.
     subscription_level: int = 1  # уровень подписки (1, 2 или 3)
 
-@dataclass
+@dataclass(slots=True)
 class Subscription:
     id: Optional[int] = None
     user_id: int = 0
@@ -80,7 +80,7 @@ class Subscription:
     created_at: int = 0  # timestamp создания
     updated_at: int = 0  # timestamp обновления
 
-@dataclass
+@dataclass(slots=True)
 class PlayerStats:
     id: Optional[int] = None
     user_id: int = 0
@@ -113,7 +113,7 @@ class TaskStatus(Enum):
     REJECTED = "rejected"    # задание отклонено модератором
     EXPIRED = "expired"      # время на выполнение вышло
 
-@dataclass
+@dataclass(slots=True)
 class DailyTask:
     id: Optional[int] = None
     user_id: int = 0
@@ -125,7 +125,7 @@ class DailyTask:
     submitted_media_path: Optional[str] = None  # путь к загруженному медиафайлу
     moderator_comment: Optional[str] = None  # комментарий модератора
 
-@dataclass
+@dataclass(slots=True)
 class UserStats:
     user_id: int = 0
     level: int = 1
@@ -137,7 +137,7 @@ class UserStats:
     total_tasks_completed: int = 0
     last_task_date: Optional[int] = None  # timestamp последнего выполненного задания
 
-@dataclass
+@dataclass(slots=True)
 class Prize:
     id: Optional[int] = None
     prize_type: PrizeType = PrizeType.ADMIN  # тип приза: admin или blogger
@@ -1,4 +1,5 @@
 import asyncio
+import html
 import logging
 from datetime import datetime
 from typing import Optional, List, Dict
@@ -20,14 +21,18 @@ class ModerationStates(StatesGroup):
     choosing_task_action = State()
 from aiogram.types import (
     Message, ReplyKeyboardMarkup, KeyboardButton,
-    InlineKeyboardMarkup, InlineKeyboardButton, CallbackQuery
+    InlineKeyboardMarkup, InlineKeyboardButton, CallbackQuery,
+    InputMediaPhoto, InputMediaVideo
 )
 
 from moderator_config import (
     MODERATOR_BOT_TOKEN, ADMIN_TELEGRAM_IDS, BLOGGER_TELEGRAM_IDS, MODERATOR_TELEGRAM_IDS,
-    DATABASE_PATH, LOG_LEVEL, LOG_FILE
+    DATABASE_PATH, LOG_LEVEL, LOG_FILE, ROLE_CACHE_TTL, MODERATION_LEASE_SECONDS, LEADER_LOCK_FILE,
+    METRICS_SNAPSHOT_INTERVAL
 )
 from database import Database
+from db_metrics import MetricsReporter, merge_snapshots, summarize
+from leader_election import get_leader_info
 from models import Prize, PrizeType, Rank, Subscription, SubscriptionStatus
 from subscription_config import SUBSCRIPTION_LEVELS
 import datetime
@@ -54,6 +59,9 @@ dp = Dispatcher()
 
 # Отладка: логируем все callback запросы
 db = Database(DATABASE_PATH)
+db.role_cache_ttl = ROLE_CACHE_TTL
+# Метрики обращений к БД модераторского бота сохраняются рядом с метриками основного бота
+metrics_reporter = MetricsReporter(db, "moderator", interval=METRICS_SNAPSHOT_INTERVAL)
 
 class ModeratorRole:
     ADMIN = "admin"
@@ -62,29 +70,10 @@ class ModeratorRole:
 
 async def get_user_role(telegram_id: int) -> Optional[str]:
     """Определение роли пользователя по Telegram ID"""
-    # Проверяем админов
-    admin_ids = await db.get_admin_telegram_ids()
-    logger.info(f"Проверка роли для {telegram_id}: админы = {admin_ids}")
-    if telegram_id in admin_ids:
-        logger.info(f"Пользователь {telegram_id} определен как ADMIN")
-        return ModeratorRole.ADMIN
-
-    # Проверяем блогеров
-    blogger_ids = await db.get_blogger_telegram_ids()
-    logger.info(f"Проверка роли для {telegram_id}: блогеры = {blogger_ids}")
-    if telegram_id in blogger_ids:
-        logger.info(f"Пользователь {telegram_id} определен как BLOGGER")
-        return ModeratorRole.BLOGGER
-
-    # Проверяем модераторов
-    moderator_ids = await db.get_moderator_telegram_ids()
-    logger.info(f"Проверка роли для {telegram_id}: модераторы = {moderator_ids}")
-    if telegram_id in moderator_ids:
-        logger.info(f"Пользователь {telegram_id} определен как MODERATOR")
-        return ModeratorRole.MODERATOR
-
-    logger.info(f"Пользователь {telegram_id} не имеет роли")
-    return None
+    roles = await db.get_staff_roles()
+    role = roles.get(telegram_id)
+    logger.debug(f"Роль пользователя {telegram_id}: {role}")
+    return role
 
 async def is_authorized(telegram_id: int) -> bool:
     """Проверка авторизации пользователя"""
@@ -157,6 +146,7 @@ def create_moderator_keyboard() -> ReplyKeyboardMarkup:
     """Создание клавиатуры для обычного модератора"""
     keyboard = [
         [KeyboardButton(text="📋 Проверить задания")],
+        [KeyboardButton(text="🖼 Пакетная проверка")],
         [KeyboardButton(text="✅ Одобрить задание")],
         [KeyboardButton(text="❌ Отклонить задание")],
         [KeyboardButton(text="📊 Статистика модерации")]
@@ -219,8 +209,8 @@ async def handle_moderator_check_tasks(message: Message):
         logger.warning(f"Пользователь {user_id} попытался получить доступ к модерации без прав")
         return
 
-    # Получаем задания на модерацию
-    pending_tasks = await db.get_pending_tasks_for_moderation(limit=10)
+    # Берем задания в аренду, чтобы другие модераторы их не открывали
+    pending_tasks = await db.claim_tasks_for_moderation(user_id, limit=5, lease_seconds=MODERATION_LEASE_SECONDS)
 
     if not pending_tasks:
         await message.answer(
@@ -256,12 +246,32 @@ async def handle_moderator_check_tasks(message: Message):
     logger.info(f"Отправлено сообщение с клавиатурой модератору {user_id}")
     await message.answer(text, reply_markup=keyboard)
 
+async def ensure_task_lease(callback: CallbackQuery, task_id: int) -> bool:
+    """Продление аренды задания; если задание занято другим модератором - сообщаем об этом"""
+    if await db.renew_task_lease(task_id, callback.from_user.id, MODERATION_LEASE_SECONDS):
+        return True
+    await callback.answer("⏳ Задание уже проверяет другой модератор или оно уже проверено", show_alert=True)
+    return False
+
+async def review_failure_text(task_id: int, moderator_id: int, error_text: str) -> str:
+    """Текст для случая, когда approve_task/reject_task вернули None: задание могли
+    проверить или взять в работу другим модератором, пока истекала наша аренда"""
+    task = await db.get_task_details(task_id)
+    if task and task['status'] != 'submitted':
+        return f"⏳ Задание #{task_id} уже проверено другим модератором."
+    if (task and task['claimed_by'] not in (None, moderator_id)
+            and (task['claimed_until'] or 0) >= int(datetime.datetime.now().timestamp())):
+        return f"⏳ Задание #{task_id} сейчас проверяет другой модератор."
+    return error_text
+
 @dp.callback_query(lambda c: c.data.startswith("check_task_"))
 async def handle_check_task(callback: CallbackQuery, state: FSMContext):
     """Просмотр деталей задания"""
     logger.info(f"Вызван handle_check_task для task_id: {callback.data}")
-    await callback.answer()
     task_id = int(callback.data.replace("check_task_", ""))
+    if not await ensure_task_lease(callback, task_id):
+        return
+    await callback.answer()
 
     task_details = await db.get_task_details(task_id)
     if not task_details:
@@ -311,12 +321,22 @@ async def handle_check_task(callback: CallbackQuery, state: FSMContext):
 
         await callback.message.edit_text(text, reply_markup=keyboard)
 
+def format_notification_status(notification: Optional[dict]) -> str:
+    """Строка о состоянии уведомления пользователю о результате проверки"""
+    if not notification:
+        return ""
+    if notification.get('is_sent'):
+        return f"\n\n📨 Уведомление #{notification['id']} доставлено пользователю"
+    return f"\n\n📨 Уведомление #{notification['id']} поставлено в очередь на отправку"
+
 @dp.callback_query(lambda c: c.data.startswith("approve_task_"))
 async def handle_approve_task(callback: CallbackQuery, state: FSMContext):
     """Одобрение задания"""
     logger.info(f"Вызван handle_approve_task для task_id: {callback.data}")
-    await callback.answer()
     task_id = int(callback.data.replace("approve_task_", ""))
+    if not await ensure_task_lease(callback, task_id):
+        return
+    await callback.answer()
     moderator_id = callback.from_user.id
 
     # Сохраняем ID задания в состоянии
@@ -384,13 +404,14 @@ async def handle_no_stats_bonus(callback: CallbackQuery, state: FSMContext):
         return
 
     # Одобряем задание без бонусов
-    success = await db.approve_task(task_id, moderator_id, experience_reward=experience)
+    notification = await db.approve_task(task_id, moderator_id, experience_reward=experience)
 
-    if success:
+    if notification:
         await callback.message.edit_text(
             f"✅ <b>Задание #{task_id} одобрено!</b>\n\n"
             f"🎉 Начислено: {experience} опыта\n"
-            f"💪 Бонусы к характеристикам: нет",
+            f"💪 Бонусы к характеристикам: нет"
+            f"{format_notification_status(notification)}",
             reply_markup=InlineKeyboardMarkup(inline_keyboard=[
                 [InlineKeyboardButton(text="📋 К следующим заданиям", callback_data="back_to_task_list")],
                 [InlineKeyboardButton(text="⬅️ В меню", callback_data="back_to_moderator_menu")]
@@ -398,7 +419,7 @@ async def handle_no_stats_bonus(callback: CallbackQuery, state: FSMContext):
         )
     else:
         await callback.message.edit_text(
-            "❌ Ошибка при одобрении задания.",
+            await review_failure_text(task_id, moderator_id, "❌ Ошибка при одобрении задания."),
             reply_markup=InlineKeyboardMarkup(inline_keyboard=[
                 [InlineKeyboardButton(text="⬅️ Назад", callback_data="back_to_task_list")]
             ])
@@ -455,9 +476,9 @@ async def handle_stats_input(message: Message, state: FSMContext):
             return
 
         # Одобряем задание с бонусами
-        success = await db.approve_task(task_id, moderator_id, experience_reward=experience, stat_rewards=stat_rewards)
+        notification = await db.approve_task(task_id, moderator_id, experience_reward=experience, stat_rewards=stat_rewards)
 
-        if success:
+        if notification:
             bonus_text = ""
             for stat_name, value in stat_rewards.items():
                 if value > 0:
@@ -476,12 +497,13 @@ async def handle_stats_input(message: Message, state: FSMContext):
             await message.answer(
                 f"✅ <b>Задание #{task_id} одобрено!</b>\n\n"
                 f"🎉 Начислено: {experience} опыта\n"
-                f"💪 Бонусы к характеристикам:\n{bonus_text}",
+                f"💪 Бонусы к характеристикам:\n{bonus_text}"
+                f"{format_notification_status(notification)}",
                 reply_markup=create_moderator_keyboard()
             )
         else:
             await message.answer(
-                "❌ Ошибка при одобрении задания.",
+                await review_failure_text(task_id, moderator_id, "❌ Ошибка при одобрении задания."),
                 reply_markup=create_moderator_keyboard()
             )
 
@@ -497,8 +519,10 @@ async def handle_stats_input(message: Message, state: FSMContext):
 async def handle_reject_task(callback: CallbackQuery, state: FSMContext):
     """Отклонение задания"""
     logger.info(f"Вызван handle_reject_task для task_id: {callback.data}")
-    await callback.answer()
     task_id = int(callback.data.replace("reject_task_", ""))
+    if not await ensure_task_lease(callback, task_id):
+        return
+    await callback.answer()
 
     # Сохраняем ID задания в состоянии
     await state.update_data(task_id=task_id, moderator_id=callback.from_user.id)
@@ -538,12 +562,13 @@ async def handle_reject_no_reason(callback: CallbackQuery, state: FSMContext):
         await state.clear()
         return
 
-    success = await db.reject_task(task_id, moderator_id, "Без указания причины")
+    notification = await db.reject_task(task_id, moderator_id, "Без указания причины")
 
-    if success:
+    if notification:
         await callback.message.edit_text(
             f"❌ <b>Задание #{task_id} отклонено</b>\n\n"
-            f"Причина: Без указания причины",
+            f"Причина: Без указания причины"
+            f"{format_notification_status(notification)}",
             reply_markup=InlineKeyboardMarkup(inline_keyboard=[
                 [InlineKeyboardButton(text="📋 К следующим заданиям", callback_data="back_to_task_list")],
                 [InlineKeyboardButton(text="⬅️ В меню", callback_data="back_to_moderator_menu")]
@@ -551,7 +576,7 @@ async def handle_reject_no_reason(callback: CallbackQuery, state: FSMContext):
         )
     else:
         await callback.message.edit_text(
-            "❌ Ошибка при отклонении задания.",
+            await review_failure_text(task_id, moderator_id, "❌ Ошибка при отклонении задания."),
             reply_markup=InlineKeyboardMarkup(inline_keyboard=[
                 [InlineKeyboardButton(text="⬅️ Назад", callback_data="back_to_task_list")]
             ])
@@ -573,29 +598,167 @@ async def handle_rejection_reason(message: Message, state: FSMContext):
         await state.clear()
         return
 
-    success = await db.reject_task(task_id, moderator_id, reason)
+    notification = await db.reject_task(task_id, moderator_id, reason)
 
-    if success:
+    if notification:
         await message.answer(
             f"❌ <b>Задание #{task_id} отклонено</b>\n\n"
-            f"Причина: {reason}",
+            f"Причина: {reason}"
+            f"{format_notification_status(notification)}",
             reply_markup=create_moderator_keyboard()
         )
     else:
         await message.answer(
-            "❌ Ошибка при отклонении задания.",
+            await review_failure_text(task_id, moderator_id, "❌ Ошибка при отклонении задания."),
             reply_markup=create_moderator_keyboard()
         )
 
     await state.clear()
 
+# Опыт, начисляемый за задание при пакетной проверке
+ALBUM_EXPERIENCE_REWARD = 10
+
+def build_album_review_keyboard(task_ids: list[int]) -> InlineKeyboardMarkup:
+    """Клавиатура пакетной проверки: кнопки для каждого задания и «Одобрить все»"""
+    keyboard = InlineKeyboardMarkup(inline_keyboard=[])
+    for task_id in task_ids:
+        keyboard.inline_keyboard.append([
+            InlineKeyboardButton(text=f"✅ #{task_id}", callback_data=f"album_approve_{task_id}"),
+            InlineKeyboardButton(text=f"❌ #{task_id}", callback_data=f"album_reject_{task_id}")
+        ])
+    if task_ids:
+        keyboard.inline_keyboard.append([
+            InlineKeyboardButton(text=f"✅ Одобрить все ({len(task_ids)})", callback_data="album_approve_all")
+        ])
+    keyboard.inline_keyboard.append([
+        InlineKeyboardButton(text="🔄 Следующая пачка", callback_data="album_next"),
+        InlineKeyboardButton(text="⬅️ В меню", callback_data="back_to_moderator_menu")
+    ])
+    return keyboard
+
+async def send_album_review(message: Message, state: FSMContext, moderator_id: int):
+    """Отправка до 10 заданий на проверке одним альбомом с панелью управления"""
+    pending_tasks = await db.claim_tasks_for_moderation(moderator_id, limit=10, lease_seconds=MODERATION_LEASE_SECONDS)
+
+    if not pending_tasks:
+        await state.update_data(album_task_ids=[])
+        await message.answer(
+            "📋 <b>Пакетная проверка</b>\n\n"
+            "✅ Все задания проверены!\n"
+            "Новых заданий на модерацию нет.",
+            reply_markup=create_moderator_keyboard()
+        )
+        return
+
+    media = []
+    text = f"🖼 <b>Пакетная проверка</b> ({len(pending_tasks)} заданий)\n"
+    text += f"Опыт за одобрение: {ALBUM_EXPERIENCE_REWARD}\n\n"
+    for task_id, user_id, task_desc, media_path, user_name, nickname in pending_tasks:
+        player_name = nickname or user_name
+        short_desc = task_desc[:50] + "..." if len(task_desc) > 50 else task_desc
+        caption = f"#{task_id}: {player_name}\n{short_desc}"
+        text += f"🎯 <b>#{task_id}</b>: {player_name}\n   └ {short_desc}\n"
+
+        if not media_path or not os.path.exists(media_path):
+            text += "   └ 📎 Файл не прикреплен\n"
+        elif media_path.endswith(('.jpg', '.jpeg', '.png')):
+            media.append(InputMediaPhoto(media=FSInputFile(media_path), caption=caption))
+        elif media_path.endswith(('.mp4', '.avi', '.mov')):
+            media.append(InputMediaVideo(media=FSInputFile(media_path), caption=caption))
+        text += "\n"
+
+    try:
+        if len(media) > 1:
+            await message.answer_media_group(media)
+        elif media:
+            if isinstance(media[0], InputMediaPhoto):
+                await message.answer_photo(media[0].media, caption=media[0].caption)
+            else:
+                await message.answer_video(media[0].media, caption=media[0].caption)
+    except Exception as e:
+        logger.error(f"Ошибка отправки альбома заданий: {e}")
+        text += "❌ Ошибка загрузки файлов\n"
+
+    task_ids = [task[0] for task in pending_tasks]
+    await state.update_data(album_task_ids=task_ids)
+    await message.answer(text, reply_markup=build_album_review_keyboard(task_ids))
+
+@dp.message(F.text == "🖼 Пакетная проверка")
+async def handle_album_review(message: Message, state: FSMContext):
+    """Пакетная проверка заданий альбомом"""
+    if await get_user_role(message.from_user.id) != ModeratorRole.MODERATOR:
+        await message.answer("❌ У вас нет доступа к этой функции.")
+        return
+
+    await send_album_review(message, state, message.from_user.id)
+
+@dp.callback_query(lambda c: c.data == "album_next")
+async def handle_album_next(callback: CallbackQuery, state: FSMContext):
+    """Следующая пачка заданий"""
+    await callback.answer()
+    await send_album_review(callback.message, state, callback.from_user.id)
+
+@dp.callback_query(lambda c: c.data.startswith("album_approve_") or c.data.startswith("album_reject_"))
+async def handle_album_action(callback: CallbackQuery, state: FSMContext):
+    """Одобрение/отклонение заданий из пакетной проверки"""
+    moderator_id = callback.from_user.id
+    if await get_user_role(moderator_id) != ModeratorRole.MODERATOR:
+        await callback.answer("❌ Нет доступа", show_alert=True)
+        return
+
+    data = await state.get_data()
+    task_ids = data.get('album_task_ids') or []
+
+    if callback.data == "album_approve_all":
+        selected = list(task_ids)
+    else:
+        selected = [int(callback.data.rsplit("_", 1)[1])]
+
+    if not selected:
+        await callback.answer("Нет заданий для обработки")
+        return
+
+    # Аренда пачки могла истечь, а задания - достаться другому модератору: продлеваем аренду
+    # всех заданий пачки и убираем те, что продлить не удалось
+    candidates = list(dict.fromkeys(task_ids + selected))
+    leased = [task_id for task_id in candidates
+              if await db.renew_task_lease(task_id, moderator_id, MODERATION_LEASE_SECONDS)]
+    lost = len(candidates) - len(leased)
+    selected = [task_id for task_id in selected if task_id in leased]
+    remaining = [task_id for task_id in leased if task_id not in selected]
+    await state.update_data(album_task_ids=remaining)
+
+    notifications = []
+    action_text = "отклонено" if callback.data.startswith("album_reject_") else "одобрено"
+    if not selected:
+        await callback.answer("⏳ Задание уже проверяет другой модератор или оно уже проверено", show_alert=True)
+    elif callback.data.startswith("album_reject_"):
+        notifications = await db.reject_tasks_bulk(selected, moderator_id, "Без указания причины")
+    else:
+        notifications = await db.approve_tasks_bulk(selected, moderator_id, experience_reward=ALBUM_EXPERIENCE_REWARD)
+    if selected:
+        await callback.answer(f"Заданий {action_text}: {len(notifications)} из {len(selected)}")
+
+    status_text = f"\n\n✔️ Заданий {action_text}: {len(notifications)}, уведомления поставлены в очередь на отправку"
+    if lost:
+        status_text += f"\n⏳ Убрано заданий, взятых другим модератором или уже проверенных: {lost}"
+    if remaining:
+        text = f"🖼 <b>Пакетная проверка</b>\nОсталось заданий: {len(remaining)}{status_text}"
+    else:
+        text = f"🖼 <b>Пакетная проверка</b>\n✅ Все задания из пачки обработаны{status_text}"
+
+    try:
+        await callback.message.edit_text(text, reply_markup=build_album_review_keyboard(remaining))
+    except Exception as e:
+        logger.error(f"Ошибка обновления панели пакетной проверки: {e}")
+
 @dp.callback_query(lambda c: c.data == "back_to_task_list")
 async def handle_back_to_task_list(callback: CallbackQuery):
     """Возврат к списку заданий"""
     await callback.answer()
 
-    # Получаем задания на модерацию
-    pending_tasks = await db.get_pending_tasks_for_moderation(limit=10)
+    # Берем задания в аренду, чтобы другие модераторы их не открывали
+    pending_tasks = await db.claim_tasks_for_moderation(callback.from_user.id, limit=5, lease_seconds=MODERATION_LEASE_SECONDS)
 
     if not pending_tasks:
         await callback.message.edit_text(
@@ -643,7 +806,7 @@ async def handle_moderator_stats(message: Message):
     stats = await db.get_moderator_stats(user_id)
 
     # Получаем количество заданий на проверку
-    pending_count = len(await db.get_pending_tasks_for_moderation(limit=1000))
+    pending_count = await db.get_pending_tasks_count()
 
     text = "📊 <b>Статистика модерации</b>\n\n"
 
@@ -992,6 +1155,118 @@ async def handle_admin_general_stats(message: Message):
         [InlineKeyboardButton(text="⬅️ Назад", callback_data="back_to_admin_menu")]
     ]))
 
+@dp.message(Command("rebuild_stats"))
+async def cmd_rebuild_stats(message: Message):
+    """Пересчет счетчиков статистики по базовым таблицам (для исправления расхождений)"""
+    if await get_user_role(message.from_user.id) != ModeratorRole.ADMIN:
+        await message.answer("❌ У вас нет доступа к этой функции.")
+        return
+
+    await db.rebuild_stats_counters()
+    total_users = await db.get_total_users_count()
+    active_users = await db.get_active_users_count()
+    total_tasks = await db.get_total_completed_tasks()
+    await message.answer(
+        "🔄 <b>Счетчики статистики пересчитаны</b>\n\n"
+        f"👥 Пользователей: {total_users}\n"
+        f"✅ С активной подпиской: {active_users}\n"
+        f"🎯 Выполнено заданий: {total_tasks}"
+    )
+
+@dp.message(Command("rebuild_streaks"))
+async def cmd_rebuild_streaks(message: Message):
+    """Разовый пересчет стриков по истории одобренных заданий"""
+    if await get_user_role(message.from_user.id) != ModeratorRole.ADMIN:
+        await message.answer("❌ У вас нет доступа к этой функции.")
+        return
+
+    await message.answer("⏳ Пересчитываем стрики по истории заданий...")
+    updated = await db.backfill_streaks()
+    await message.answer(
+        "🔥 <b>Стрики пересчитаны</b>\n\n"
+        f"👥 Пользователей с выполненными заданиями: {updated}"
+    )
+
+@dp.message(Command("jobs"))
+async def cmd_jobs_status(message: Message):
+    """Статус фоновых задач основного бота: ведущий экземпляр и последние запуски"""
+    if await get_user_role(message.from_user.id) != ModeratorRole.ADMIN:
+        await message.answer("❌ У вас нет доступа к этой функции.")
+        return
+
+    leader = await get_leader_info(db, LEADER_LOCK_FILE or None)
+    jobs = await db.get_scheduler_jobs()
+
+    text = "🗓 <b>Фоновые задачи</b>\n\n"
+    if leader:
+        since = leader.get('since')
+        since_str = f" с {datetime.datetime.fromtimestamp(since).strftime('%d.%m.%Y %H:%M')}" if since else ""
+        text += f"👑 <b>Ведущий:</b> <code>{html.escape(str(leader['identity']))}</code>{since_str}\n\n"
+    else:
+        text += "⚠️ <b>Ведущий не выбран</b> - фоновые задачи не выполняются\n\n"
+
+    if not jobs:
+        text += "Задачи еще не запускались."
+    for job in jobs:
+        last_run = (
+            datetime.datetime.fromtimestamp(job['last_run_at']).strftime('%d.%m %H:%M:%S')
+            if job['last_run_at'] else "-"
+        )
+        text += (
+            f"• <b>{html.escape(job['name'])}</b>: {last_run}, {job['last_duration_ms'] or 0} мс, "
+            f"запусков {job['run_count']}, ошибок {job['failure_count']}\n"
+        )
+        if job['last_error']:
+            text += f"  ❗ {html.escape(job['last_error'])}\n"
+
+    await message.answer(text)
+
+@dp.message(Command("db_metrics"))
+async def cmd_db_metrics(message: Message):
+    """Метрики обращений к БД всех процессов: задержки методов и последние медленные вызовы"""
+    if await get_user_role(message.from_user.id) != ModeratorRole.ADMIN:
+        await message.answer("❌ У вас нет доступа к этой функции.")
+        return
+
+    # Свежие метрики этого процесса, остальные процессы сохраняют свои периодически
+    await metrics_reporter.save()
+    snapshots = await db.get_metrics_snapshots()
+    if not snapshots:
+        await message.answer("Метрики БД еще не собраны.")
+        return
+
+    text = "⏱ <b>Метрики БД</b>\n\n"
+    for snapshot in snapshots:
+        since = datetime.datetime.fromtimestamp(snapshot['started_at']).strftime('%d.%m %H:%M')
+        updated = datetime.datetime.fromtimestamp(snapshot['updated_at']).strftime('%H:%M:%S')
+        text += f"• <code>{html.escape(snapshot['process'])}</code>: с {since}, обновлено {updated}\n"
+
+    text += "\n<b>Методы по суммарному времени</b> (вызовы, p50/p95/p99 мс, строк в среднем, ожидание соединения мс):\n"
+    for item in summarize(merge_snapshots(snapshots))[:15]:
+        errors = f", ошибок {item['errors']}" if item['errors'] else ""
+        text += (
+            f"• <code>{item['method']}</code>: {item['calls']}, "
+            f"{item['p50_ms']:.1f}/{item['p95_ms']:.1f}/{item['p99_ms']:.1f}, "
+            f"{item['rows'] / item['calls']:.1f}, {item['wait_ms'] / item['calls']:.1f}{errors}\n"
+        )
+
+    slow_queries = sorted(
+        (entry for snapshot in snapshots for entry in snapshot['slow_queries']),
+        key=lambda entry: entry['at'], reverse=True
+    )[:5]
+    if slow_queries:
+        text += f"\n🐢 <b>Медленные вызовы</b> (порог {snapshots[0]['slow_query_ms']:.0f} мс):\n"
+    for entry in slow_queries:
+        at = datetime.datetime.fromtimestamp(entry['at']).strftime('%d.%m %H:%M:%S')
+        text += f"• {at} <code>{entry['method']}({', '.join(entry['args'])})</code> - {entry['ms']:.0f} мс\n"
+        for statement in entry['statements'][:2]:
+            text += f"  <code>{html.escape(statement['sql'][:200])}</code> [{', '.join(statement['params'])}]\n"
+
+    # Ограничение длины сообщения Telegram: обрезаем по целым строкам, чтобы не разорвать теги
+    if len(text) > 4000:
+        text = text[:4000].rsplit("\n", 1)[0]
+    await message.answer(text)
+
 # Обработчики для блогеров объявлены выше
 
 @dp.message(F.text == "📊 Статистика подписчиков")
@@ -3021,10 +3296,18 @@ async def main():
     # Инициализация базы данных
     await db.init_db()
 
+    # Загружаем роли персонала в кэш
+    await db.get_staff_roles()
+
+    await metrics_reporter.start()
     logger.info("Модераторский бот запущен")
 
     # Запуск бота
-    await dp.start_polling(bot)
+    try:
+        await dp.start_polling(bot)
+    finally:
+        await metrics_reporter.stop()
+        await db.close()
 
 if __name__ == "__main__":
     asyncio.run(main())
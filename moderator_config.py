@@ -36,6 +36,18 @@ if not ADMIN_TELEGRAM_IDS:
 # Настройки базы данных (используем ту же базу данных)
 DATABASE_PATH = "bot_database.db"
 
+# Время жизни кэша ролей (секунд) - за это время подхватываются изменения из других процессов
+ROLE_CACHE_TTL = int(os.getenv("ROLE_CACHE_TTL", "60"))
+
+# Период сохранения метрик обращений к БД модераторского бота (секунды)
+METRICS_SNAPSHOT_INTERVAL = int(os.getenv("METRICS_SNAPSHOT_INTERVAL", "60"))
+
+# Файл блокировки ведущего экземпляра bot.py (для команды /jobs), по умолчанию <DATABASE_PATH>.leader.lock
+LEADER_LOCK_FILE = os.getenv("LEADER_LOCK_FILE", "")
+
+# Время аренды задания модератором (секунд): пока аренда действует, задание не выдается другим
+MODERATION_LEASE_SECONDS = int(os.getenv("MODERATION_LEASE_SECONDS", "300"))
+
 # Настройки логирования
 LOG_LEVEL = "INFO"
 LOG_FILE = "moderator_bot.log"
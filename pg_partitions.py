@@ -0,0 +1,269 @@
+"""
+Секционирование таблиц PostgreSQL по месяцам (daily_tasks, notifications).
+
+Таблица объявляется как PARTITION BY RANGE (created_at) с секцией на каждый календарный
+месяц (<таблица>_pYYYYMM) и секцией по умолчанию для строк вне диапазонов. Секции на
+несколько месяцев вперед создаются заранее, поэтому вставка никогда не попадает в
+несуществующий диапазон. Запросы с условием по created_at читают только нужные секции,
+а срок хранения соблюдается отсоединением и удалением старых секций вместо массовых DELETE:
+строки отсоединенной секции одним запросом копируются в архивную таблицу. Секция, в которой
+остались незавершенные строки (задания на проверке, неотправленные уведомления), не удаляется
+до их завершения; из секции по умолчанию старые завершенные строки переносятся построчно.
+"""
+import datetime
+import logging
+import re
+from dataclasses import dataclass
+from typing import Optional
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass(frozen=True, slots=True)
+class PartitionedTable:
+    """Описание секционируемой таблицы"""
+    name: str
+    epoch_key: bool  # created_at хранится как unix timestamp (BIGINT), а не TIMESTAMP
+    archive: str  # архивная таблица для строк удаляемых секций
+    archive_columns: tuple[str, ...]
+    archivable: str  # условие на строку, которую можно переносить в архив (завершенное задание и т.п.)
+    dependent_views: tuple[str, ...] = ()  # представления, пересоздаваемые в init_db
+
+
+PARTITIONED_TABLES = (
+    PartitionedTable(
+        name='daily_tasks',
+        epoch_key=False,
+        archive='daily_tasks_archive',
+        archive_columns=('id', 'user_id', 'task_description', 'created_at', 'expires_at', 'status',
+                         'completed_at', 'moderator_comment'),
+        # Как в построчном архивировании: истекшие задания ждут удаления медиафайла
+        archivable="status IN ('approved', 'rejected', 'expired') "
+                   "AND NOT (status = 'expired' AND submitted_media_path IS NOT NULL)",
+        dependent_views=('daily_tasks_history',),
+    ),
+    PartitionedTable(
+        name='notifications',
+        epoch_key=True,
+        archive='notifications_archive',
+        archive_columns=('id', 'user_id', 'type', 'title', 'message', 'data', 'created_at', 'sent_at'),
+        archivable='is_sent = TRUE',
+    ),
+)
+
+_PARTITION_SUFFIX = re.compile(r'_p(\d{4})(\d{2})$')
+
+
+class _PartitionInUse(Exception):
+    """В отсоединенной секции остались строки, которые еще нельзя архивировать"""
+
+
+def month_start(moment) -> datetime.date:
+    """Первое число месяца"""
+    return datetime.date(moment.year, moment.month, 1)
+
+
+def add_months(month: datetime.date, count: int) -> datetime.date:
+    index = month.year * 12 + month.month - 1 + count
+    return datetime.date(index // 12, index % 12 + 1, 1)
+
+
+def partition_name(table: PartitionedTable, month: datetime.date) -> str:
+    return f"{table.name}_p{month:%Y%m}"
+
+
+def _bound(table: PartitionedTable, month: datetime.date) -> str:
+    """Граница диапазона секции в виде SQL-литерала"""
+    if table.epoch_key:
+        return str(int(datetime.datetime(month.year, month.month, 1, tzinfo=datetime.timezone.utc).timestamp()))
+    return f"'{month.isoformat()}'"
+
+
+def _key_month(table: PartitionedTable, value) -> datetime.date:
+    """Месяц значения created_at"""
+    if table.epoch_key:
+        return month_start(datetime.datetime.fromtimestamp(value, datetime.timezone.utc))
+    return month_start(value)
+
+
+async def is_partitioned(conn, table: PartitionedTable) -> bool:
+    return bool(await conn.fetchval(
+        "SELECT relkind = 'p' FROM pg_class WHERE oid = to_regclass($1)", table.name
+    ))
+
+
+async def list_partitions(conn, table: PartitionedTable) -> dict[datetime.date, str]:
+    """Месячные секции таблицы: {первое число месяца: имя секции}"""
+    rows = await conn.fetch('''
+        SELECT c.relname FROM pg_inherits i
+        JOIN pg_class c ON c.oid = i.inhrelid
+        WHERE i.inhparent = to_regclass($1)
+    ''', table.name)
+    partitions = {}
+    for row in rows:
+        match = _PARTITION_SUFFIX.search(row['relname'])
+        if match:
+            partitions[datetime.date(int(match[1]), int(match[2]), 1)] = row['relname']
+    return partitions
+
+
+async def create_partition(conn, table: PartitionedTable, month: datetime.date):
+    await conn.execute(f'''
+        CREATE TABLE IF NOT EXISTS {partition_name(table, month)} PARTITION OF {table.name}
+        FOR VALUES FROM ({_bound(table, month)}) TO ({_bound(table, add_months(month, 1))})
+    ''')
+
+
+async def ensure_partitions(conn, table: PartitionedTable, months_ahead: int,
+                            today: Optional[datetime.date] = None) -> list[str]:
+    """Создание секций текущего месяца и months_ahead следующих; возвращает имена новых секций"""
+    existing = await list_partitions(conn, table)
+    current = month_start(today or datetime.date.today())
+    created = []
+    for offset in range(months_ahead + 1):
+        month = add_months(current, offset)
+        if month not in existing:
+            await create_partition(conn, table, month)
+            created.append(partition_name(table, month))
+    if created:
+        logger.info(f"Созданы секции {table.name}: {', '.join(created)}")
+    return created
+
+
+async def migrate_to_partitioned(conn, table: PartitionedTable, months_ahead: int) -> bool:
+    """
+    Однократный перевод обычной таблицы в секционированную с переносом данных.
+    Выполняется в одной транзакции под исключительной блокировкой таблицы: старая таблица
+    переименовывается, создается секционированная с теми же колонками, значениями по
+    умолчанию, последовательностью id, индексами и внешними ключами, данные копируются
+    в секции, старая таблица удаляется. Возвращает False, если таблица уже секционирована.
+    """
+    if await is_partitioned(conn, table):
+        return False
+
+    name = table.name
+    legacy = f"{name}_unpartitioned"
+    async with conn.transaction():
+        await conn.execute(f'LOCK TABLE {name} IN ACCESS EXCLUSIVE MODE')
+
+        columns = [row['column_name'] for row in await conn.fetch('''
+            SELECT column_name FROM information_schema.columns
+            WHERE table_schema = current_schema() AND table_name = $1
+            ORDER BY ordinal_position
+        ''', name)]
+        indexes = await conn.fetch('''
+            SELECT i.indexname, i.indexdef FROM pg_indexes i
+            WHERE i.schemaname = current_schema() AND i.tablename = $1
+            AND NOT EXISTS (
+                SELECT 1 FROM pg_constraint c
+                WHERE c.conindid = to_regclass(i.indexname) AND c.contype = 'p'
+            )
+        ''', name)
+        foreign_keys = await conn.fetch('''
+            SELECT conname, pg_get_constraintdef(oid) AS definition
+            FROM pg_constraint WHERE conrelid = to_regclass($1) AND contype = 'f'
+        ''', name)
+        sequence = await conn.fetchval("SELECT pg_get_serial_sequence($1, 'id')", name)
+
+        for view in table.dependent_views:
+            await conn.execute(f'DROP VIEW IF EXISTS {view}')
+        if sequence:
+            # Иначе последовательность будет удалена вместе со старой таблицей
+            await conn.execute(f'ALTER SEQUENCE {sequence} OWNED BY NONE')
+        await conn.execute(f'ALTER TABLE {name} RENAME TO {legacy}')
+
+        # Ключ секционирования не может быть NULL и должен входить в первичный ключ
+        await conn.execute(f'''
+            CREATE TABLE {name} (LIKE {legacy} INCLUDING DEFAULTS INCLUDING CONSTRAINTS)
+            PARTITION BY RANGE (created_at)
+        ''')
+        await conn.execute(f'ALTER TABLE {name} ALTER COLUMN created_at SET NOT NULL')
+        await conn.execute(f'CREATE TABLE {name}_default PARTITION OF {name} DEFAULT')
+
+        # Секции на весь диапазон существующих данных и на months_ahead месяцев вперед
+        first = await conn.fetchval(f'SELECT MIN(created_at) FROM {legacy}')
+        current = month_start(datetime.date.today())
+        month = min(_key_month(table, first), current) if first is not None else current
+        while month <= add_months(current, months_ahead):
+            await create_partition(conn, table, month)
+            month = add_months(month, 1)
+
+        created_at = 'created_at' if table.epoch_key else 'COALESCE(created_at, expires_at, CURRENT_TIMESTAMP)'
+        select_list = ', '.join(created_at if column == 'created_at' else column for column in columns)
+        status = await conn.execute(
+            f'INSERT INTO {name} ({", ".join(columns)}) SELECT {select_list} FROM {legacy}'
+        )
+        await conn.execute(f'DROP TABLE {legacy}')
+
+        # Имя индекса первичного ключа освобождается только после удаления старой таблицы
+        await conn.execute(f'ALTER TABLE {name} ADD PRIMARY KEY (id, created_at)')
+        if sequence:
+            await conn.execute(f'ALTER SEQUENCE {sequence} OWNED BY {name}.id')
+        for index in indexes:
+            if 'UNIQUE' in index['indexdef']:
+                # Уникальный индекс секционированной таблицы обязан включать created_at
+                logger.warning(f"Уникальный индекс {index['indexname']} не перенесен в секционированную {name}")
+                continue
+            await conn.execute(index['indexdef'])
+        for foreign_key in foreign_keys:
+            await conn.execute(f"ALTER TABLE {name} ADD CONSTRAINT {foreign_key['conname']} {foreign_key['definition']}")
+
+    logger.info(f"Таблица {name} переведена в секционированную по месяцам, перенесено строк: {status.split()[-1]}")
+    return True
+
+
+async def drop_expired_partitions(conn, table: PartitionedTable, cutoff: datetime.datetime,
+                                  archived_at: int) -> int:
+    """
+    Отсоединение и удаление секций, целиком лежащих раньше cutoff. Строки секции перед
+    удалением копируются в архивную таблицу. Секция с незавершенными строками остается
+    на месте до следующего запуска. Из секции по умолчанию завершенные строки старше cutoff
+    переносятся в архив построчно. Возвращает количество перенесенных строк.
+    """
+    limit = month_start(cutoff)
+    columns = ', '.join(table.archive_columns)
+    moved = 0
+    for month, partition in sorted((await list_partitions(conn, table)).items()):
+        if add_months(month, 1) > limit:
+            break
+        try:
+            async with conn.transaction():
+                await conn.execute(f'ALTER TABLE {table.name} DETACH PARTITION {partition}')
+                # Проверка после отсоединения: новые строки в секцию уже не попадут
+                live = await conn.fetchval(
+                    f'SELECT COUNT(*) FROM {partition} WHERE ({table.archivable}) IS NOT TRUE'
+                )
+                if live:
+                    raise _PartitionInUse(live)
+                status = await conn.execute(f'''
+                    INSERT INTO {table.archive} ({columns}, archived_at)
+                    SELECT {columns}, $1 FROM {partition}
+                    ON CONFLICT (id) DO NOTHING
+                ''', archived_at)
+                await conn.execute(f'DROP TABLE {partition}')
+        except _PartitionInUse as e:
+            logger.warning(f"Секция {partition} не удалена: незавершенных строк {e.args[0]}")
+            continue
+        count = int(status.split()[-1])
+        moved += count
+        logger.info(f"Секция {partition} отсоединена и удалена, в архив перенесено строк: {count}")
+
+    default = f'{table.name}_default'
+    if await conn.fetchval('SELECT to_regclass($1) IS NOT NULL', default):
+        key = int(cutoff.timestamp()) if table.epoch_key else cutoff
+        condition = f'created_at < $1 AND {table.archivable}'
+        async with conn.transaction():
+            status = await conn.execute(f'''
+                INSERT INTO {table.archive} ({columns}, archived_at)
+                SELECT {columns}, $2 FROM {default} WHERE {condition}
+                ON CONFLICT (id) DO NOTHING
+            ''', key, archived_at)
+            await conn.execute(f'''
+                DELETE FROM {default} d WHERE {condition}
+                AND EXISTS (SELECT 1 FROM {table.archive} a WHERE a.id = d.id)
+            ''', key)
+        count = int(status.split()[-1])
+        if count:
+            moved += count
+            logger.info(f"Из секции {default} в архив перенесено строк: {count}")
+    return moved
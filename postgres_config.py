@@ -22,6 +22,12 @@ POSTGRES_SSL_ROOT_CERT = os.getenv("POSTGRES_SSL_ROOT_CERT", "~/.cloud-certs/roo
 # URL для скачивания сертификата Timeweb
 TIMEWEB_CERT_URL = "https://st.timeweb.com/cloud-static/ca.crt"
 
+# Секционирование daily_tasks и notifications по месяцам created_at (см. pg_partitions.py):
+# существующие таблицы переводятся при запуске, секции создаются на POSTGRES_PARTITION_PREMAKE_MONTHS
+# месяцев вперед, старые секции удаляются фоновой задачей архивации
+POSTGRES_PARTITIONING = os.getenv("POSTGRES_PARTITIONING", "false").lower() == "true"
+POSTGRES_PARTITION_PREMAKE_MONTHS = int(os.getenv("POSTGRES_PARTITION_PREMAKE_MONTHS", "3"))
+
 # Преобразуем порт в int, если он указан
 try:
     POSTGRES_PORT = int(POSTGRES_PORT) if POSTGRES_PORT else 5432
@@ -0,0 +1,81 @@
+# Движок выдачи призов за достижения
+# Для каждого типа достижения хранится отсортированный список порогов активных призов.
+# При изменении показателя пользователя (опыт, уровень, стрик, задания, ранг) проверяются
+# только пороги, пересеченные между старым и новым значением (бинарный поиск).
+
+from bisect import bisect_right
+from typing import Optional
+
+from models import Prize, PrizeType, Rank
+from rank_config import RANK_NAMES
+
+# Типы достижений, которые проверяются автоматически (custom проверяется модератором вручную)
+AUTO_ACHIEVEMENT_TYPES = ('streak', 'rank', 'level', 'tasks', 'experience')
+
+# Порядок рангов: achievement_value для типа rank - это номер ранга (1 = F, ..., 8 = S+)
+_RANK_ORDER = list(RANK_NAMES.keys())
+
+
+def rank_to_value(rank: Optional[str]) -> int:
+    """Номер ранга для сравнения с порогом приза типа rank"""
+    try:
+        return _RANK_ORDER.index(Rank(rank)) + 1
+    except ValueError:
+        return 0
+
+
+class PrizeThresholdIndex:
+    """Индекс порогов активных призов по типам достижений"""
+
+    def __init__(self, prizes: list[Prize]):
+        self._thresholds: dict[str, list[int]] = {}
+        self._prizes: dict[str, list[Prize]] = {}
+
+        by_type: dict[str, list[Prize]] = {}
+        for prize in prizes:
+            if prize.is_active and prize.achievement_type in AUTO_ACHIEVEMENT_TYPES:
+                by_type.setdefault(prize.achievement_type, []).append(prize)
+
+        for achievement_type, type_prizes in by_type.items():
+            type_prizes.sort(key=lambda p: p.achievement_value)
+            self._prizes[achievement_type] = type_prizes
+            self._thresholds[achievement_type] = [p.achievement_value for p in type_prizes]
+
+    def crossed(self, achievement_type: str, old_value: int, new_value: int) -> list[Prize]:
+        """Призы с порогом в интервале (old_value, new_value]"""
+        thresholds = self._thresholds.get(achievement_type)
+        if not thresholds or new_value <= old_value:
+            return []
+        start = bisect_right(thresholds, old_value)
+        end = bisect_right(thresholds, new_value)
+        return self._prizes[achievement_type][start:end]
+
+    def crossed_by_changes(self, old_values: dict, new_values: dict) -> list[Prize]:
+        """Призы, пороги которых пересечены хотя бы одним из изменившихся показателей"""
+        result = []
+        for achievement_type in AUTO_ACHIEVEMENT_TYPES:
+            if achievement_type in old_values and achievement_type in new_values:
+                result.extend(self.crossed(achievement_type, old_values[achievement_type], new_values[achievement_type]))
+        return result
+
+
+def is_prize_available_for_user(prize: Prize, referral_code: Optional[str], subscription_level: Optional[int]) -> bool:
+    """Проверка, доступен ли приз пользователю (блогер и уровень подписки)"""
+    if prize.prize_type == PrizeType.BLOGGER and (not referral_code or prize.referral_code != referral_code):
+        return False
+    if prize.subscription_level and prize.subscription_level != subscription_level:
+        return False
+    return True
+
+
+def render_prize_award_message(prize: Prize) -> tuple[str, str]:
+    """Заголовок и текст уведомления о полученном призе"""
+    title = "🏆 Новый приз!"
+    message = (
+        f"🏆 <b>Поздравляем! Вы получили приз!</b>\n\n"
+        f"{prize.emoji} <b>{prize.title}</b>\n"
+    )
+    if prize.description:
+        message += f"└ {prize.description}\n"
+    message += "\n<i>Подробности получения приза уточняйте в поддержке.</i>"
+    return title, message
@@ -0,0 +1,505 @@
+"""
+Общий слой запросов для SQLite и PostgreSQL.
+
+Запрос объявляется один раз в синтаксисе SQLite (плейсхолдеры ?) и переводится
+под нужный диалект при первом использовании (для PostgreSQL ? -> $1, $2, ...).
+Текст запроса должен быть совместим с обеими БД: TRUE/FALSE вместо 1/0,
+стандартные функции, одинаковые типы параметров.
+
+Запросы выполняются на долгоживущих соединениях с кэшем подготовленных выражений:
+пул asyncpg с statement_cache_size (каждое соединение один раз делает prepare и дальше
+переиспользует план) и соединение aiosqlite с cached_statements.
+
+В профиле производительности SQLite (SQLITE_PERFORMANCE_PROFILE) чтение идет через пул
+соединений только для чтения, а все изменения - через единственную задачу записи, которая
+собирает изменения из очереди и фиксирует их группой одной транзакцией.
+
+Время ожидания соединения и выполненные запросы передаются в метрики текущего вызова
+Database (db_metrics).
+
+С PostgreSQL чтение, допускающее небольшое отставание (replica=True), может выполняться
+на реплике (replica_dsn). При недоступности реплики запрос выполняется на основном сервере.
+"""
+import asyncio
+import logging
+import time
+from contextlib import asynccontextmanager
+from typing import Any, AsyncIterator, Optional
+
+import aiosqlite
+import asyncpg
+
+from db_metrics import log_postgres_query, note_connection_wait, note_statement
+from sqlite_config import (
+    SQLITE_PERFORMANCE_PROFILE, SQLITE_READ_POOL_SIZE, SQLITE_GROUP_COMMIT_MS, SQLITE_GROUP_COMMIT_MAX,
+    get_sqlite_pragmas
+)
+
+logger = logging.getLogger(__name__)
+
+
+@asynccontextmanager
+async def sqlite_connect(db_path: str, **kwargs) -> AsyncIterator[aiosqlite.Connection]:
+    """Соединение с SQLite; в профиле производительности - с настроенными PRAGMA"""
+    started = time.perf_counter()
+    async with aiosqlite.connect(db_path, **kwargs) as conn:
+        if SQLITE_PERFORMANCE_PROFILE:
+            await conn.executescript(";".join(get_sqlite_pragmas()))
+        note_connection_wait(time.perf_counter() - started)
+        yield conn
+
+
+async def init_postgres_connection(conn: asyncpg.Connection):
+    """Настройка нового соединения PostgreSQL: журнал запросов для метрик"""
+    conn.add_query_logger(log_postgres_query)
+
+
+@asynccontextmanager
+async def _acquire_timed(pool: asyncpg.Pool) -> AsyncIterator[asyncpg.Connection]:
+    """Соединение из пула с учетом времени ожидания в метриках"""
+    started = time.perf_counter()
+    async with pool.acquire() as conn:
+        note_connection_wait(time.perf_counter() - started)
+        yield conn
+
+
+async def _open_sqlite(db_path: str, read_only: bool = False, **kwargs) -> aiosqlite.Connection:
+    """Долгоживущее соединение с SQLite с настроенными PRAGMA"""
+    conn = aiosqlite.connect(db_path, **kwargs)
+    # Поток соединения не должен мешать завершению процесса, если close() не был вызван
+    conn.daemon = True
+    conn = await conn
+    conn.row_factory = aiosqlite.Row
+    await conn.executescript(";".join(get_sqlite_pragmas(read_only)))
+    return conn
+
+def _to_postgres_placeholders(text: str) -> str:
+    """Замена ? на $1, $2, ... вне строковых литералов"""
+    result = []
+    index = 0
+    in_string = False
+    for char in text:
+        if char == "'":
+            in_string = not in_string
+        elif char == "?" and not in_string:
+            index += 1
+            result.append(f"${index}")
+            continue
+        result.append(char)
+    return "".join(result)
+
+
+class Query:
+    """SQL-запрос, объявленный один раз и переводимый под диалект"""
+
+    __slots__ = ("text", "_compiled")
+
+    def __init__(self, text: str):
+        self.text = text
+        self._compiled: dict[bool, str] = {}
+
+    def sql(self, use_postgres: bool) -> str:
+        """Текст запроса для SQLite (False) или PostgreSQL (True)"""
+        compiled = self._compiled.get(use_postgres)
+        if compiled is None:
+            compiled = _to_postgres_placeholders(self.text) if use_postgres else self.text
+            self._compiled[use_postgres] = compiled
+        return compiled
+
+
+class QueryExecutor:
+    """Выполнение объявленных запросов на настроенной БД через кэш подготовленных выражений"""
+
+    # Пауза перед повторной попыткой подключиться к недоступной реплике (секунды)
+    REPLICA_RETRY_DELAY = 30
+
+    def __init__(self, db_path: str, use_postgres: bool, statement_cache_size: int = 100, pool_size: int = 10,
+                 replica_dsn: Optional[str] = None):
+        self.db_path = db_path
+        self.use_postgres = use_postgres
+        self.statement_cache_size = statement_cache_size
+        self.pool_size = pool_size
+        self.replica_dsn = replica_dsn
+        self.sqlite_profile = SQLITE_PERFORMANCE_PROFILE
+        self._pool: Optional[asyncpg.Pool] = None
+        self._replica_pool: Optional[asyncpg.Pool] = None
+        self._replica_failed_at = 0.0
+        self._sqlite: Optional[aiosqlite.Connection] = None
+        self._read_pool: Optional[SqliteReadPool] = None
+        self._writer: Optional[SqliteWriter] = None
+        self._connect_lock = asyncio.Lock()
+        # Записи через общее соединение SQLite выполняются по одной (execute + commit)
+        self._write_lock = asyncio.Lock()
+
+    async def _get_pool(self) -> asyncpg.Pool:
+        if self._pool is None:
+            async with self._connect_lock:
+                if self._pool is None:
+                    from postgres_config import get_postgres_connection_params
+                    self._pool = await asyncpg.create_pool(
+                        **get_postgres_connection_params(),
+                        min_size=1,
+                        max_size=self.pool_size,
+                        statement_cache_size=self.statement_cache_size,
+                        init=init_postgres_connection,
+                    )
+                    logger.info(f"Создан пул соединений PostgreSQL (до {self.pool_size} соединений)")
+        return self._pool
+
+    async def _get_replica_pool(self) -> Optional[asyncpg.Pool]:
+        """Пул реплики или None, если реплика не настроена или недавно была недоступна"""
+        if not self.replica_dsn or time.monotonic() - self._replica_failed_at < self.REPLICA_RETRY_DELAY:
+            return None
+        if self._replica_pool is None:
+            async with self._connect_lock:
+                if self._replica_pool is None:
+                    try:
+                        self._replica_pool = await asyncpg.create_pool(
+                            dsn=self.replica_dsn,
+                            min_size=1,
+                            max_size=self.pool_size,
+                            statement_cache_size=self.statement_cache_size,
+                            init=init_postgres_connection,
+                        )
+                        logger.info(f"Создан пул соединений реплики PostgreSQL (до {self.pool_size} соединений)")
+                    except (OSError, asyncpg.PostgresError) as e:
+                        self._replica_unavailable(e)
+                        return None
+        return self._replica_pool
+
+    def _replica_unavailable(self, error: Exception):
+        self._replica_failed_at = time.monotonic()
+        logger.warning(f"Реплика PostgreSQL недоступна, чтение идет с основного сервера: {error}")
+
+    @asynccontextmanager
+    async def acquire(self, replica: bool = False) -> AsyncIterator[asyncpg.Connection]:
+        """Соединение PostgreSQL из пула: реплики (если replica и она доступна) или основного сервера"""
+        pool = await self._get_replica_pool() if replica else None
+        if pool is not None:
+            started = time.perf_counter()
+            try:
+                conn = await pool.acquire()
+                note_connection_wait(time.perf_counter() - started)
+            except (OSError, asyncpg.PostgresConnectionError) as e:
+                self._replica_unavailable(e)
+            else:
+                try:
+                    yield conn
+                finally:
+                    await pool.release(conn)
+                return
+        pool = await self._get_pool()
+        async with _acquire_timed(pool) as conn:
+            yield conn
+
+    async def _postgres_read(self, method: str, query: Query, args: tuple, replica: bool):
+        """Чтение на реплике с повтором на основном сервере при обрыве соединения с репликой"""
+        pool = await self._get_replica_pool() if replica else None
+        if pool is not None:
+            try:
+                async with _acquire_timed(pool) as conn:
+                    return await getattr(conn, method)(query.sql(True), *args)
+            except (OSError, asyncpg.PostgresConnectionError, asyncpg.InterfaceError) as e:
+                self._replica_unavailable(e)
+        pool = await self._get_pool()
+        async with _acquire_timed(pool) as conn:
+            return await getattr(conn, method)(query.sql(True), *args)
+
+    async def _get_sqlite(self) -> aiosqlite.Connection:
+        if self._sqlite is None:
+            async with self._connect_lock:
+                if self._sqlite is None:
+                    conn = aiosqlite.connect(self.db_path, cached_statements=self.statement_cache_size)
+                    # Поток соединения не должен мешать завершению процесса, если close() не был вызван
+                    conn.daemon = True
+                    conn = await conn
+                    conn.row_factory = aiosqlite.Row
+                    self._sqlite = conn
+        return self._sqlite
+
+    def _get_read_pool(self) -> "SqliteReadPool":
+        if self._read_pool is None:
+            self._read_pool = SqliteReadPool(self.db_path, SQLITE_READ_POOL_SIZE, self.statement_cache_size)
+        return self._read_pool
+
+    def _get_writer(self) -> "SqliteWriter":
+        if self._writer is None:
+            self._writer = SqliteWriter(
+                self.db_path, SQLITE_GROUP_COMMIT_MS, SQLITE_GROUP_COMMIT_MAX, self.statement_cache_size
+            )
+        return self._writer
+
+    @asynccontextmanager
+    async def _sqlite_reader(self) -> AsyncIterator[aiosqlite.Connection]:
+        """Соединение SQLite для чтения: из пула в профиле производительности, иначе общее"""
+        started = time.perf_counter()
+        if self.sqlite_profile:
+            async with self._get_read_pool().acquire() as conn:
+                note_connection_wait(time.perf_counter() - started)
+                yield conn
+        else:
+            conn = await self._get_sqlite()
+            note_connection_wait(time.perf_counter() - started)
+            yield conn
+
+    async def fetch(self, query: Query, *args, replica: bool = False) -> list:
+        """Все строки результата; replica=True - допускается чтение с реплики"""
+        if self.use_postgres:
+            return await self._postgres_read('fetch', query, args, replica)
+        async with self._sqlite_reader() as conn:
+            started = time.perf_counter()
+            # Курсор закрывается сразу, чтобы не удерживать блокировку чтения
+            async with conn.execute(query.sql(False), args) as cursor:
+                rows = await cursor.fetchall()
+            note_statement(query.text, args, time.perf_counter() - started)
+            return rows
+
+    async def fetchrow(self, query: Query, *args, replica: bool = False) -> Optional[Any]:
+        """Первая строка результата или None"""
+        if self.use_postgres:
+            return await self._postgres_read('fetchrow', query, args, replica)
+        async with self._sqlite_reader() as conn:
+            started = time.perf_counter()
+            async with conn.execute(query.sql(False), args) as cursor:
+                row = await cursor.fetchone()
+            note_statement(query.text, args, time.perf_counter() - started)
+            return row
+
+    async def fetchval(self, query: Query, *args, replica: bool = False) -> Any:
+        """Первое значение первой строки результата или None"""
+        row = await self.fetchrow(query, *args, replica=replica)
+        return row[0] if row is not None else None
+
+    async def execute(self, query: Query, *args) -> int:
+        """Выполнение изменяющего запроса с фиксацией, возвращает количество затронутых строк"""
+        if self.use_postgres:
+            pool = await self._get_pool()
+            async with _acquire_timed(pool) as conn:
+                status = await conn.execute(query.sql(True), *args)
+            # Статус вида "UPDATE 3" / "INSERT 0 1"
+            try:
+                return int(status.split()[-1])
+            except (ValueError, IndexError):
+                return 0
+        started = time.perf_counter()
+        if self.sqlite_profile:
+            # Время ожидания групповой фиксации входит во время запроса
+            rowcount = await self._get_writer().submit([(query, args)])
+            note_statement(query.text, args, time.perf_counter() - started)
+            return rowcount
+        conn = await self._get_sqlite()
+        async with self._write_lock:
+            note_connection_wait(time.perf_counter() - started)
+            started = time.perf_counter()
+            cursor = await conn.execute(query.sql(False), args)
+            await conn.commit()
+            note_statement(query.text, args, time.perf_counter() - started)
+            return cursor.rowcount
+
+    async def execute_many(self, statements: list[tuple]) -> int:
+        """
+        Выполнение нескольких изменяющих запросов [(query, args), ...] в одной транзакции.
+        Возвращает количество строк, затронутых последним запросом.
+        """
+        if self.use_postgres:
+            pool = await self._get_pool()
+            status = ''
+            async with _acquire_timed(pool) as conn:
+                async with conn.transaction():
+                    for query, args in statements:
+                        status = await conn.execute(query.sql(True), *args)
+            try:
+                return int(status.split()[-1])
+            except (ValueError, IndexError):
+                return 0
+        started = time.perf_counter()
+        if self.sqlite_profile:
+            rowcount = await self._get_writer().submit(statements)
+            elapsed = time.perf_counter() - started
+            for query, args in statements:
+                note_statement(query.text, args, elapsed)
+            return rowcount
+        conn = await self._get_sqlite()
+        async with self._write_lock:
+            note_connection_wait(time.perf_counter() - started)
+            try:
+                rowcount = 0
+                for query, args in statements:
+                    started = time.perf_counter()
+                    cursor = await conn.execute(query.sql(False), args)
+                    note_statement(query.text, args, time.perf_counter() - started)
+                    rowcount = cursor.rowcount
+                await conn.commit()
+                return rowcount
+            except Exception:
+                await conn.rollback()
+                raise
+
+    async def close(self):
+        """Закрытие соединений"""
+        if self._pool is not None:
+            await self._pool.close()
+            self._pool = None
+        if self._replica_pool is not None:
+            await self._replica_pool.close()
+            self._replica_pool = None
+        if self._writer is not None:
+            await self._writer.close()
+            self._writer = None
+        if self._read_pool is not None:
+            await self._read_pool.close()
+            self._read_pool = None
+        if self._sqlite is not None:
+            await self._sqlite.close()
+            self._sqlite = None
+
+
+class SqliteReadPool:
+    """Пул соединений SQLite только для чтения"""
+
+    def __init__(self, db_path: str, size: int, statement_cache_size: int = 100):
+        self.db_path = db_path
+        self.size = max(1, size)
+        self.statement_cache_size = statement_cache_size
+        self._idle: Optional[asyncio.Queue] = None
+        self._connections: list[aiosqlite.Connection] = []
+        self._open_lock = asyncio.Lock()
+
+    async def _open(self):
+        async with self._open_lock:
+            if self._idle is not None:
+                return
+            idle = asyncio.Queue()
+            for _ in range(self.size):
+                conn = await _open_sqlite(self.db_path, read_only=True, cached_statements=self.statement_cache_size)
+                self._connections.append(conn)
+                idle.put_nowait(conn)
+            self._idle = idle
+
+    @asynccontextmanager
+    async def acquire(self) -> AsyncIterator[aiosqlite.Connection]:
+        if self._idle is None:
+            await self._open()
+        conn = await self._idle.get()
+        try:
+            yield conn
+        finally:
+            self._idle.put_nowait(conn)
+
+    async def close(self):
+        for conn in self._connections:
+            await conn.close()
+        self._connections = []
+        self._idle = None
+
+
+class SqliteWriter:
+    """
+    Единственная задача записи в SQLite с групповой фиксацией.
+
+    Изменения ставятся в очередь; задача берет первое, ждет group_commit_ms, забирает
+    накопившиеся (не больше max_batch) и выполняет их одной транзакцией. Каждое изменение
+    выполняется в своей точке сохранения, поэтому ошибка одного не отменяет остальные.
+    """
+
+    def __init__(self, db_path: str, group_commit_ms: int = 5, max_batch: int = 100, statement_cache_size: int = 100):
+        self.db_path = db_path
+        self.group_commit_ms = group_commit_ms
+        self.max_batch = max(1, max_batch)
+        self.statement_cache_size = statement_cache_size
+        self._queue: Optional[asyncio.Queue] = None
+        self._task: Optional[asyncio.Task] = None
+
+    def _ensure_started(self):
+        if self._task is None:
+            self._queue = asyncio.Queue()
+            self._task = asyncio.create_task(self._run())
+
+    async def submit(self, statements: list[tuple]) -> int:
+        """Выполнение изменений [(query, args), ...] атомарно; возвращает rowcount последнего"""
+        self._ensure_started()
+        future = asyncio.get_running_loop().create_future()
+        self._queue.put_nowait((statements, future))
+        return await future
+
+    async def _run(self):
+        queue = self._queue
+        batch = []
+        conn = None
+        try:
+            # Транзакциями управляем сами (isolation_level=None)
+            conn = await _open_sqlite(self.db_path, isolation_level=None, cached_statements=self.statement_cache_size)
+            stopping = False
+            while not stopping:
+                item = await queue.get()
+                if item is None:
+                    break
+                batch = [item]
+                if self.group_commit_ms > 0 and queue.empty():
+                    await asyncio.sleep(self.group_commit_ms / 1000)
+                while len(batch) < self.max_batch and not queue.empty():
+                    item = queue.get_nowait()
+                    if item is None:
+                        stopping = True
+                        break
+                    batch.append(item)
+                await self._commit_batch(conn, batch)
+                batch = []
+        except Exception as e:
+            # Ожидающие изменения завершаются с ошибкой, а следующий submit() запустит задачу заново
+            logger.error(f"Задача записи SQLite остановлена из-за ошибки: {e}")
+            self._fail_pending(queue, batch, e)
+        finally:
+            if conn is not None:
+                await conn.close()
+
+    def _fail_pending(self, queue: asyncio.Queue, batch: list, error: Exception):
+        if self._queue is queue:
+            self._task = None
+            self._queue = None
+        while not queue.empty():
+            item = queue.get_nowait()
+            if item is not None:
+                batch.append(item)
+        for _, future in batch:
+            if not future.done():
+                future.set_exception(error)
+
+    async def _commit_batch(self, conn: aiosqlite.Connection, batch: list):
+        results = []
+        try:
+            await conn.execute("BEGIN IMMEDIATE")
+            for statements, future in batch:
+                await conn.execute("SAVEPOINT mutation")
+                try:
+                    rowcount = 0
+                    for query, args in statements:
+                        cursor = await conn.execute(query.sql(False), args)
+                        rowcount = cursor.rowcount
+                    await conn.execute("RELEASE mutation")
+                    results.append((future, rowcount, None))
+                except Exception as e:
+                    await conn.execute("ROLLBACK TO mutation")
+                    await conn.execute("RELEASE mutation")
+                    results.append((future, None, e))
+            await conn.execute("COMMIT")
+        except Exception as e:
+            logger.error(f"Ошибка групповой фиксации ({len(batch)} изменений): {e}")
+            if conn.in_transaction:
+                await conn.execute("ROLLBACK")
+            results = [(future, None, e) for _, future in batch]
+
+        for future, rowcount, error in results:
+            if future.done():
+                continue
+            if error is not None:
+                future.set_exception(error)
+            else:
+                future.set_result(rowcount)
+
+    async def close(self):
+        """Завершение задачи записи после обработки очереди"""
+        if self._task is not None:
+            self._queue.put_nowait(None)
+            await self._task
+            self._task = None
@@ -0,0 +1,230 @@
+"""
+Преобразование строк БД в модели.
+
+Для каждой модели описано, какой конвертер применяется к колонке с тем же именем.
+По списку колонок результата (он зависит от бэкенда и версии схемы) один раз
+генерируется функция-декодер, которая читает значения по индексам и сразу создает
+модель - без dict(row), row.get() и проверок наличия колонок для каждой строки.
+Колонки, которых нет в модели, пропускаются; поля, для которых нет колонки,
+получают значение по умолчанию из dataclass.
+"""
+import datetime
+import logging
+from datetime import date
+from typing import Any, AsyncIterator, Callable, Iterable, Optional
+
+from models import (
+    User, Payment, PaymentStatus, Subscription, SubscriptionStatus, PlayerStats,
+    DailyTask, TaskStatus, UserStats, Rank, Prize, PrizeType
+)
+
+logger = logging.getLogger(__name__)
+
+
+def to_timestamp(value) -> int:
+    """TIMESTAMP (PostgreSQL) или INTEGER (SQLite) -> unix timestamp, NULL -> 0"""
+    if value is None:
+        return 0
+    if isinstance(value, datetime.datetime):
+        return int(value.timestamp())
+    if isinstance(value, date):
+        return int(datetime.datetime(value.year, value.month, value.day).timestamp())
+    return int(value)
+
+
+def to_optional_timestamp(value) -> Optional[int]:
+    """Как to_timestamp, но NULL остается None"""
+    if value is None:
+        return None
+    return to_timestamp(value)
+
+
+def to_date(value) -> Optional[date]:
+    """DATE (PostgreSQL) или строка ISO (SQLite) -> date"""
+    if isinstance(value, date):
+        return value
+    if isinstance(value, str) and value:
+        try:
+            return date.fromisoformat(value)
+        except ValueError:
+            logger.warning(f"Неверный формат даты: {value}")
+    return None
+
+
+def to_float(value) -> float:
+    """DECIMAL (PostgreSQL) или REAL (SQLite) -> float"""
+    return float(value) if value is not None else 0.0
+
+
+def or_default(default) -> Callable[[Any], Any]:
+    """Конвертер, заменяющий пустое значение на default"""
+    def convert(value):
+        return value or default
+    return convert
+
+
+def optional_enum(enum_cls) -> Callable[[Any], Any]:
+    """Конвертер в Enum, пустое значение -> None"""
+    def convert(value):
+        return enum_cls(value) if value else None
+    return convert
+
+
+# Модель -> {колонка: конвертер}; None означает значение без преобразования
+MODEL_COLUMNS: dict[type, dict[str, Optional[Callable]]] = {
+    User: {
+        'telegram_id': None,
+        'language': None,
+        'name': None,
+        'birth_date': to_date,
+        'height': None,
+        'weight': None,
+        'city': None,
+        'referral_code': None,
+        'goal': None,
+        'subscription_active': bool,
+        'subscription_start': to_optional_timestamp,
+        'subscription_end': to_optional_timestamp,
+        'referral_count': None,
+    },
+    Payment: {
+        'id': None,
+        'user_id': None,
+        'payment_id': None,
+        'order_id': None,
+        'amount': to_float,
+        'months': None,
+        'status': PaymentStatus,
+        'created_at': to_timestamp,
+        'paid_at': to_optional_timestamp,
+        'currency': None,
+        'payment_method': None,
+        'discount_code': None,
+        'referral_used': None,
+        'subscription_type': None,
+        'subscription_level': or_default(1),
+    },
+    Subscription: {
+        'id': None,
+        'user_id': None,
+        'payment_id': None,
+        'start_date': to_timestamp,
+        'end_date': to_timestamp,
+        'months': None,
+        'subscription_level': or_default(1),
+        'status': SubscriptionStatus,
+        'auto_renew': bool,
+        'created_at': to_timestamp,
+        'updated_at': to_timestamp,
+    },
+    PlayerStats: {
+        'id': None,
+        'user_id': None,
+        'nickname': None,
+        'experience': or_default(0),
+        'strength': None,
+        'agility': None,
+        'endurance': None,
+        'intelligence': None,
+        'charisma': None,
+        'photo_path': None,
+        'card_image_path': None,
+        'created_at': to_timestamp,
+        'updated_at': to_timestamp,
+    },
+    DailyTask: {
+        'id': None,
+        'user_id': None,
+        'task_description': or_default(''),
+        'created_at': to_timestamp,
+        'expires_at': to_optional_timestamp,
+        'status': TaskStatus,
+        'completed_at': to_optional_timestamp,
+        'submitted_media_path': None,
+        'moderator_comment': None,
+    },
+    UserStats: {
+        'user_id': None,
+        'level': None,
+        'experience': None,
+        'rank': Rank,
+        'referral_rank': optional_enum(Rank),
+        'current_streak': None,
+        'best_streak': None,
+        'total_tasks_completed': None,
+        'last_task_date': to_optional_timestamp,
+    },
+    Prize: {
+        'id': None,
+        'prize_type': PrizeType,
+        'referral_code': None,
+        'title': None,
+        'description': None,
+        'achievement_type': None,
+        'achievement_value': None,
+        'custom_condition': or_default(None),
+        'subscription_level': or_default(None),
+        'emoji': None,
+        'is_active': bool,
+        'created_at': to_timestamp,
+        'updated_at': to_timestamp,
+    },
+}
+
+# (модель, колонки результата) -> декодер
+_decoders: dict[tuple, Callable[[Any], Any]] = {}
+
+
+def _compile_decoder(model: type, columns: tuple) -> Callable[[Any], Any]:
+    """Генерация функции row -> model для заданного порядка колонок"""
+    converters = MODEL_COLUMNS[model]
+    # При повторяющихся именах колонок берется последняя (SELECT *, expr AS column)
+    positions = {name: index for index, name in enumerate(columns)}
+
+    namespace: dict[str, Any] = {'_model': model}
+    arguments = []
+    for name, converter in converters.items():
+        index = positions.get(name)
+        if index is None:
+            continue
+        if converter is None:
+            arguments.append(f"{name}=row[{index}]")
+        else:
+            namespace[f"_convert_{name}"] = converter
+            arguments.append(f"{name}=_convert_{name}(row[{index}])")
+
+    source = f"def decode(row):\n    return _model({', '.join(arguments)})\n"
+    exec(source, namespace)
+    return namespace['decode']
+
+
+def get_decoder(model: type, columns: Iterable[str]) -> Callable[[Any], Any]:
+    """Декодер строк с указанными колонками (генерируется один раз)"""
+    key = (model, tuple(columns))
+    decoder = _decoders.get(key)
+    if decoder is None:
+        decoder = _compile_decoder(model, key[1])
+        _decoders[key] = decoder
+    return decoder
+
+
+def decode_row(model: type, row):
+    """Преобразование одной строки (asyncpg.Record или sqlite Row) в модель"""
+    return get_decoder(model, row.keys())(row)
+
+
+def decode_rows(model: type, rows: list) -> list:
+    """Преобразование списка строк с одинаковыми колонками в список моделей"""
+    if not rows:
+        return []
+    decoder = get_decoder(model, rows[0].keys())
+    return [decoder(row) for row in rows]
+
+
+async def decode_stream(model: type, rows: AsyncIterator) -> AsyncIterator:
+    """Преобразование потока строк в поток моделей"""
+    decoder = None
+    async for row in rows:
+        if decoder is None:
+            decoder = get_decoder(model, row.keys())
+        yield decoder(row)
@@ -0,0 +1,300 @@
+"""
+Планировщик фоновых задач.
+
+Задачи описываются декларативно (Job): интервал или cron-выражение, случайный разброс
+запуска, таймаут и лимит одновременных запусков. Все задачи обслуживает один цикл:
+он спит до ближайшего срока и запускает наступившие задачи. Если предыдущий запуск
+задачи еще не завершился и лимит исчерпан, очередной запуск пропускается, а не
+накладывается. Время последнего запуска сохраняется в БД (scheduler_jobs), поэтому
+после перезапуска бота задача не выполняется повторно раньше срока и не пропускается,
+если срок наступил во время простоя.
+"""
+import asyncio
+import datetime
+import logging
+import random
+import time
+from dataclasses import dataclass, field
+from typing import Any, Awaitable, Callable, Optional
+
+logger = logging.getLogger(__name__)
+
+# Максимальный сон цикла планировщика (секунды), чтобы не зависеть от перевода часов
+MAX_SLEEP = 60
+
+
+class CronSchedule:
+    """
+    Cron-выражение из пяти полей: минута, час, день месяца, месяц, день недели (0 - воскресенье).
+    Поддерживаются *, */n, a-b, a-b/n и списки через запятую. Время - локальное.
+    """
+
+    _RANGES = ((0, 59), (0, 23), (1, 31), (1, 12), (0, 7))
+
+    def __init__(self, expression: str):
+        parts = expression.split()
+        if len(parts) != 5:
+            raise ValueError(f"Cron-выражение должно содержать 5 полей: {expression}")
+        self.expression = expression
+        self.minutes, self.hours, self.days, self.months, self.weekdays = (
+            self._parse_field(part, low, high) for part, (low, high) in zip(parts, self._RANGES)
+        )
+        # 7 в дне недели - тоже воскресенье
+        if 7 in self.weekdays:
+            self.weekdays = (self.weekdays - {7}) | {0}
+        # Как в cron: если ограничены и день месяца, и день недели, достаточно совпадения одного
+        self._day_or = parts[2] != '*' and parts[4] != '*'
+
+    @staticmethod
+    def _parse_field(part: str, low: int, high: int) -> frozenset[int]:
+        values = set()
+        for item in part.split(','):
+            step = 1
+            if '/' in item:
+                item, step_text = item.split('/', 1)
+                step = int(step_text)
+            if item == '*':
+                start, end = low, high
+            elif '-' in item:
+                start_text, end_text = item.split('-', 1)
+                start, end = int(start_text), int(end_text)
+            else:
+                start = end = int(item)
+            if start < low or end > high or step < 1:
+                raise ValueError(f"Значение вне диапазона {low}-{high}: {part}")
+            values.update(range(start, end + 1, step))
+        return frozenset(values)
+
+    def _day_matches(self, moment: datetime.datetime) -> bool:
+        day_ok = moment.day in self.days
+        weekday_ok = (moment.isoweekday() % 7) in self.weekdays
+        return (day_ok or weekday_ok) if self._day_or else (day_ok and weekday_ok)
+
+    def next_after(self, timestamp: float) -> float:
+        """Ближайший момент срабатывания строго после timestamp"""
+        moment = datetime.datetime.fromtimestamp(timestamp).replace(second=0, microsecond=0)
+        moment += datetime.timedelta(minutes=1)
+        # Больше четырех лет без совпадения - выражение не срабатывает никогда (например, 31 февраля)
+        limit = moment + datetime.timedelta(days=4 * 366)
+        while moment < limit:
+            if moment.month not in self.months:
+                month = moment.month % 12 + 1
+                moment = moment.replace(year=moment.year + (month == 1), month=month, day=1, hour=0, minute=0)
+                continue
+            if not self._day_matches(moment):
+                moment = (moment + datetime.timedelta(days=1)).replace(hour=0, minute=0)
+                continue
+            if moment.hour not in self.hours:
+                moment = (moment + datetime.timedelta(hours=1)).replace(minute=0)
+                continue
+            if moment.minute not in self.minutes:
+                moment += datetime.timedelta(minutes=1)
+                continue
+            return moment.timestamp()
+        raise ValueError(f"Cron-выражение никогда не срабатывает: {self.expression}")
+
+
+@dataclass(slots=True)
+class Job:
+    """Описание фоновой задачи"""
+    name: str
+    func: Callable[[], Awaitable[Any]]
+    interval: Optional[float] = None  # секунды между запусками
+    cron: Optional[str] = None  # или расписание в формате cron
+    jitter: float = 0  # случайная задержка запуска 0..jitter секунд
+    timeout: Optional[float] = None  # запуск отменяется, если длится дольше
+    max_concurrency: int = 1  # сколько запусков задачи может выполняться одновременно
+    schedule: Optional[CronSchedule] = field(default=None, init=False)
+
+    def __post_init__(self):
+        if (self.interval is None) == (self.cron is None):
+            raise ValueError(f"Для задачи {self.name} нужно указать либо interval, либо cron")
+        if self.cron is not None:
+            self.schedule = CronSchedule(self.cron)
+
+    def next_run(self, last_run: Optional[float], now: float) -> float:
+        """Следующий срок запуска по времени последнего запуска"""
+        if self.schedule is not None:
+            due = self.schedule.next_after(last_run if last_run is not None else now)
+        elif last_run is None:
+            due = now
+        else:
+            due = last_run + self.interval
+        # Пропущенные во время простоя запуски сводятся к одному ближайшему
+        return max(due, now) + random.uniform(0, self.jitter)
+
+
+@dataclass(slots=True)
+class JobStats:
+    """Метрики запусков задачи"""
+    runs: int = 0
+    failures: int = 0
+    timeouts: int = 0
+    skipped: int = 0  # запуски, пропущенные из-за незавершенного предыдущего
+    running: int = 0
+    last_started_at: Optional[float] = None
+    last_duration: Optional[float] = None
+    max_duration: float = 0.0
+    total_duration: float = 0.0
+    last_error: Optional[str] = None
+    next_run_at: Optional[float] = None
+
+    @property
+    def avg_duration(self) -> float:
+        return self.total_duration / self.runs if self.runs else 0.0
+
+
+class Scheduler:
+    """Планировщик фоновых задач с сохранением времени последнего запуска в БД"""
+
+    def __init__(self, db):
+        self.db = db
+        self.jobs: dict[str, Job] = {}
+        self.stats: dict[str, JobStats] = {}
+        self._next_run: dict[str, float] = {}
+        self._runs: set[asyncio.Task] = set()
+        self._loop_task: Optional[asyncio.Task] = None
+        self._wakeup: Optional[asyncio.Event] = None
+
+    def add_job(self, job: Job) -> Job:
+        """Регистрация задачи (можно и после запуска планировщика)"""
+        if job.name in self.jobs:
+            raise ValueError(f"Задача {job.name} уже зарегистрирована")
+        self.jobs[job.name] = job
+        self.stats[job.name] = JobStats()
+        if self._loop_task is not None:
+            self._set_next_run(job, None)
+            self._wakeup.set()
+        return job
+
+    def job(self, name: Optional[str] = None, **options) -> Callable:
+        """Декоратор для регистрации корутины как задачи: @scheduler.job(interval=30)"""
+        def decorator(func):
+            self.add_job(Job(name=name or func.__name__, func=func, **options))
+            return func
+        return decorator
+
+    def _set_next_run(self, job: Job, last_run: Optional[float]):
+        due = job.next_run(last_run, time.time())
+        self._next_run[job.name] = due
+        self.stats[job.name].next_run_at = due
+
+    async def start(self):
+        """Загрузка времени последних запусков и запуск цикла планировщика"""
+        if self._loop_task is not None:
+            return
+        try:
+            last_runs = await self.db.get_scheduler_last_runs()
+        except Exception as e:
+            logger.error(f"Не удалось загрузить время последних запусков задач: {e}")
+            last_runs = {}
+        for job in self.jobs.values():
+            self._set_next_run(job, last_runs.get(job.name))
+        self._wakeup = asyncio.Event()
+        self._loop_task = asyncio.create_task(self._run_loop())
+        logger.info(f"Планировщик запущен, задач: {len(self.jobs)}")
+
+    async def stop(self, timeout: float = 30):
+        """Остановка цикла и ожидание завершения выполняющихся задач"""
+        if self._loop_task is None:
+            return
+        self._loop_task.cancel()
+        try:
+            await self._loop_task
+        except asyncio.CancelledError:
+            pass
+        self._loop_task = None
+        if self._runs:
+            _, pending = await asyncio.wait(self._runs, timeout=timeout)
+            for task in pending:
+                task.cancel()
+            if pending:
+                await asyncio.wait(pending)
+        logger.info("Планировщик остановлен")
+
+    async def _run_loop(self):
+        while True:
+            now = time.time()
+            for name, due in list(self._next_run.items()):
+                if due <= now:
+                    self._launch(self.jobs[name], now)
+            delay = min(self._next_run.values(), default=now + MAX_SLEEP) - time.time()
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=min(max(delay, 0), MAX_SLEEP))
+            except asyncio.TimeoutError:
+                pass
+
+    def _launch(self, job: Job, now: float):
+        stats = self.stats[job.name]
+        self._set_next_run(job, now)
+        if stats.running >= job.max_concurrency:
+            stats.skipped += 1
+            logger.warning(f"Задача {job.name} пропущена: предыдущий запуск еще выполняется")
+            return
+        stats.running += 1
+        task = asyncio.create_task(self._run_job(job, now))
+        self._runs.add(task)
+        task.add_done_callback(self._runs.discard)
+
+    async def _run_job(self, job: Job, started_at: float):
+        stats = self.stats[job.name]
+        stats.last_started_at = started_at
+        error = None
+        try:
+            await self.db.save_scheduler_job_start(job.name, int(started_at))
+        except Exception as e:
+            logger.error(f"Не удалось сохранить время запуска задачи {job.name}: {e}")
+
+        start = time.monotonic()
+        try:
+            if job.timeout:
+                await asyncio.wait_for(job.func(), timeout=job.timeout)
+            else:
+                await job.func()
+        except asyncio.TimeoutError:
+            stats.timeouts += 1
+            error = f"превышен таймаут {job.timeout} с"
+            logger.error(f"[{job.name}] {error}")
+        except asyncio.CancelledError:
+            error = "отменена"
+            raise
+        except Exception as e:
+            error = str(e) or e.__class__.__name__
+            logger.error(f"[{job.name}] Error: {e}")
+        finally:
+            duration = time.monotonic() - start
+            stats.running -= 1
+            stats.runs += 1
+            stats.last_duration = duration
+            stats.total_duration += duration
+            stats.max_duration = max(stats.max_duration, duration)
+            stats.last_error = error
+            if error is not None:
+                stats.failures += 1
+            try:
+                await self.db.save_scheduler_job_result(job.name, int(duration * 1000), error)
+            except Exception as e:
+                logger.error(f"Не удалось сохранить результат задачи {job.name}: {e}")
+
+    def get_metrics(self) -> list[dict]:
+        """Метрики всех задач для статуса и мониторинга"""
+        return [
+            {
+                'name': name,
+                'schedule': job.cron or f"каждые {job.interval:g} с",
+                'runs': stats.runs,
+                'failures': stats.failures,
+                'timeouts': stats.timeouts,
+                'skipped': stats.skipped,
+                'running': stats.running,
+                'last_started_at': stats.last_started_at,
+                'last_duration': stats.last_duration,
+                'avg_duration': stats.avg_duration,
+                'max_duration': stats.max_duration,
+                'last_error': stats.last_error,
+                'next_run_at': stats.next_run_at,
+            }
+            for name, job in self.jobs.items()
+            for stats in (self.stats[name],)
+        ]
@@ -0,0 +1,35 @@
+import os
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# Профиль производительности SQLite: WAL, настройки PRAGMA, единый поток записи с групповой
+# фиксацией и пул соединений только для чтения. Рекомендуется, когда оба бота работают
+# с одним файлом базы.
+SQLITE_PERFORMANCE_PROFILE = os.getenv("SQLITE_PERFORMANCE_PROFILE", "false").lower() == "true"
+
+# Ожидание снятия блокировки другим процессом вместо немедленной ошибки "database is locked"
+SQLITE_BUSY_TIMEOUT_MS = int(os.getenv("SQLITE_BUSY_TIMEOUT_MS", "5000"))
+# Размер кэша страниц на соединение (в КБ) и объем файла, отображаемого в память (в МБ)
+SQLITE_CACHE_SIZE_KB = int(os.getenv("SQLITE_CACHE_SIZE_KB", "16384"))
+SQLITE_MMAP_SIZE_MB = int(os.getenv("SQLITE_MMAP_SIZE_MB", "256"))
+# Количество соединений только для чтения в пуле
+SQLITE_READ_POOL_SIZE = int(os.getenv("SQLITE_READ_POOL_SIZE", "4"))
+# Окно накопления записей перед общей фиксацией (мс) и максимальный размер группы
+SQLITE_GROUP_COMMIT_MS = int(os.getenv("SQLITE_GROUP_COMMIT_MS", "5"))
+SQLITE_GROUP_COMMIT_MAX = int(os.getenv("SQLITE_GROUP_COMMIT_MAX", "100"))
+
+
+def get_sqlite_pragmas(read_only: bool = False) -> list[str]:
+    """PRAGMA, выполняемые при открытии соединения в профиле производительности"""
+    pragmas = [
+        f"PRAGMA busy_timeout = {SQLITE_BUSY_TIMEOUT_MS}",
+        # В режиме WAL synchronous=NORMAL не теряет целостность, но не делает fsync на каждую фиксацию
+        "PRAGMA synchronous = NORMAL",
+        f"PRAGMA cache_size = -{SQLITE_CACHE_SIZE_KB}",
+        f"PRAGMA mmap_size = {SQLITE_MMAP_SIZE_MB * 1024 * 1024}",
+        "PRAGMA temp_store = MEMORY",
+    ]
+    if read_only:
+        pragmas.append("PRAGMA query_only = ON")
+    return pragmas
@@ -0,0 +1,88 @@
+"""
+Серии выполнения заданий (стрики).
+
+Стрик ведется инкрементально при одобрении задания: день задания (по времени его создания)
+сравнивается с днем последнего выполненного задания в часовом поясе пользователя.
+Следующий календарный день продлевает серию, тот же день ее не меняет, пропуск начинает
+серию заново. Прерванная серия обнуляется при чтении (effective_streak), поэтому
+периодический пересчет всех пользователей не нужен.
+"""
+import datetime
+import logging
+import os
+from dataclasses import dataclass
+from functools import lru_cache
+from typing import Optional
+from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+# Часовой пояс по умолчанию для пользователей, у которых он не указан
+STREAK_TIMEZONE = os.getenv("STREAK_TIMEZONE", "Europe/Moscow")
+
+
+@lru_cache(maxsize=64)
+def get_timezone(name: Optional[str]) -> ZoneInfo:
+    """Часовой пояс по имени IANA; при пустом или неизвестном имени - STREAK_TIMEZONE"""
+    if name:
+        try:
+            return ZoneInfo(name)
+        except (ZoneInfoNotFoundError, ValueError):
+            logger.warning(f"Неизвестный часовой пояс {name}, используется {STREAK_TIMEZONE}")
+    return ZoneInfo(STREAK_TIMEZONE)
+
+
+def is_valid_timezone(name: str) -> bool:
+    """Известно ли имя часового пояса IANA"""
+    try:
+        ZoneInfo(name)
+    except (ZoneInfoNotFoundError, ValueError):
+        return False
+    return True
+
+
+def local_day(timestamp: int, timezone: Optional[str] = None) -> datetime.date:
+    """Календарный день момента timestamp в часовом поясе пользователя"""
+    return datetime.datetime.fromtimestamp(timestamp, get_timezone(timezone)).date()
+
+
+@dataclass(slots=True)
+class StreakState:
+    """Состояние серии пользователя (поля user_stats)"""
+    current: int = 0
+    best: int = 0
+    last_task_date: Optional[int] = None  # timestamp последнего выполненного задания
+
+    def advance(self, task_time: int, timezone: Optional[str] = None):
+        """Учет выполненного задания, созданного в момент task_time"""
+        if self.last_task_date is None:
+            self.current = 1
+        else:
+            days = (local_day(task_time, timezone) - local_day(self.last_task_date, timezone)).days
+            if days == 1:
+                self.current += 1
+            elif days > 1 or self.current == 0:
+                self.current = 1
+            # days == 0 - задание того же дня; days < 0 - старое задание одобрено позже новых
+        self.best = max(self.best, self.current)
+        self.last_task_date = max(self.last_task_date or task_time, task_time)
+
+
+def effective_streak(current: int, last_task_date, timezone: Optional[str] = None,
+                     now: Optional[int] = None) -> int:
+    """
+    Текущая серия с учетом пропуска: если вчера и сегодня заданий не было, серия прервана.
+    last_task_date - timestamp (SQLite) или уже локальная дата (DATE в PostgreSQL).
+    """
+    if not current or last_task_date is None:
+        return 0
+    if now is None:
+        now = int(datetime.datetime.now().timestamp())
+    if not isinstance(last_task_date, datetime.date):
+        last_task_date = local_day(last_task_date, timezone)
+    days = (local_day(now, timezone) - last_task_date).days
+    return current if days <= 1 else 0
@@ -0,0 +1,74 @@
+"""
+Контекст пользователя на время обработки одного обновления.
+
+Middleware создает UserContext для каждого обновления и передает его в handlers
+как аргумент user_ctx. Данные пользователя загружаются лениво при первом
+обращении и дальше берутся из кэша, поэтому повторные запросы к БД в рамках
+одного обновления (проверка подписки + профиль + статистика) не выполняются.
+"""
+from typing import Any, Awaitable, Callable, Dict, Optional
+
+from aiogram import BaseMiddleware
+from aiogram.types import TelegramObject, User as TelegramUser
+
+from models import User, Subscription, UserStats, PlayerStats
+
+_MISSING = object()
+
+
+class UserContext:
+    """Лениво заполняемый кэш данных пользователя в рамках одного обновления"""
+
+    def __init__(self, db, user_id: int):
+        self.db = db
+        self.user_id = user_id
+        self._cache: Dict[str, Any] = {}
+
+    async def _load(self, name: str, loader: Callable[[int], Awaitable[Any]]) -> Any:
+        value = self._cache.get(name, _MISSING)
+        if value is _MISSING:
+            value = await loader(self.user_id)
+            self._cache[name] = value
+        return value
+
+    async def get_user(self) -> Optional[User]:
+        """Пользователь из таблицы users"""
+        return await self._load("user", self.db.get_user)
+
+    async def get_active_subscription(self) -> Optional[Subscription]:
+        """Активная подписка пользователя"""
+        return await self._load("active_subscription", self.db.get_active_subscription)
+
+    async def get_user_stats(self) -> Optional[UserStats]:
+        """Статистика пользователя (опыт, уровень, стрики)"""
+        return await self._load("user_stats", self.db.get_user_stats)
+
+    async def get_player_stats(self) -> Optional[PlayerStats]:
+        """Карточка игрока"""
+        return await self._load("player_stats", self.db.get_player_stats)
+
+    def invalidate(self, *names: str):
+        """Сброс закэшированных данных (всех или указанных) после изменения в БД"""
+        if not names:
+            self._cache.clear()
+            return
+        for name in names:
+            self._cache.pop(name, None)
+
+
+class UserContextMiddleware(BaseMiddleware):
+    """Создание UserContext для каждого обновления от пользователя"""
+
+    def __init__(self, db):
+        self.db = db
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any],
+    ) -> Any:
+        from_user: Optional[TelegramUser] = data.get("event_from_user")
+        if from_user is not None:
+            data["user_ctx"] = UserContext(self.db, from_user.id)
+        return await handler(event, data)
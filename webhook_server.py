@@ -0,0 +1,151 @@
+"""
+Приём обновлений Telegram через webhook с распределением по процессам-обработчикам.
+
+Фронтальный процесс принимает HTTP-запросы от Telegram, проверяет секретный токен
+и складывает обновление в очередь процесса, который "владеет" пользователем
+(выбирается по user_id). Благодаря этому все обновления одного пользователя
+обрабатываются в одном процессе и строго по порядку, а FSM-состояние в памяти
+остаётся согласованным.
+"""
+import asyncio
+import logging
+from typing import Any, Dict, List, Optional
+
+from aiohttp import web
+from aiogram import Bot, Dispatcher
+from aiogram.fsm.storage.base import StorageKey
+
+logger = logging.getLogger(__name__)
+
+SECRET_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+
+# Типы обновлений, в которых отправитель лежит в поле "from"
+_USER_UPDATE_TYPES = (
+    "message",
+    "edited_message",
+    "callback_query",
+    "inline_query",
+    "chosen_inline_result",
+    "shipping_query",
+    "pre_checkout_query",
+    "poll_answer",
+    "my_chat_member",
+    "chat_member",
+    "chat_join_request",
+    "message_reaction",
+)
+
+# Типы обновлений, в которых есть только чат
+_CHAT_UPDATE_TYPES = (
+    "channel_post",
+    "edited_channel_post",
+    "message_reaction_count",
+    "chat_boost",
+    "removed_chat_boost",
+)
+
+
+def extract_user_id(update: Dict[str, Any]) -> int:
+    """Определение ID пользователя (или чата) из сырого обновления Telegram"""
+    for update_type in _USER_UPDATE_TYPES:
+        payload = update.get(update_type)
+        if not payload:
+            continue
+        sender = payload.get("from") or payload.get("user")
+        if sender and "id" in sender:
+            return sender["id"]
+        chat = payload.get("chat") or (payload.get("message") or {}).get("chat")
+        if chat and "id" in chat:
+            return chat["id"]
+
+    for update_type in _CHAT_UPDATE_TYPES:
+        payload = update.get(update_type)
+        if payload and payload.get("chat"):
+            return payload["chat"]["id"]
+
+    return 0
+
+
+def get_worker_index(user_id: int, workers: int) -> int:
+    """Номер процесса-обработчика, которому принадлежит пользователь"""
+    return abs(user_id) % workers
+
+
+def create_webhook_app(queues: List[Any], path: str, secret: str = "") -> web.Application:
+    """Создание aiohttp-приложения, раскладывающего обновления по очередям процессов"""
+
+    async def handle_update(request: web.Request) -> web.Response:
+        if secret and request.headers.get(SECRET_HEADER) != secret:
+            logger.warning("Отклонен webhook-запрос с неверным секретным токеном")
+            return web.Response(status=401)
+
+        try:
+            update = await request.json()
+        except Exception:
+            return web.Response(status=400)
+
+        user_id = extract_user_id(update)
+        queues[get_worker_index(user_id, len(queues))].put(("update", update))
+        # Отвечаем сразу, обработка идет асинхронно в процессе-обработчике
+        return web.Response()
+
+    async def handle_health(request: web.Request) -> web.Response:
+        return web.json_response({"status": "ok", "workers": len(queues)})
+
+    app = web.Application()
+    app.router.add_post(path, handle_update)
+    app.router.add_get("/health", handle_health)
+    return app
+
+
+async def process_worker_queue(dp: Dispatcher, bot: Bot, queue: Any) -> None:
+    """
+    Цикл процесса-обработчика: читает очередь и передает обновления диспетчеру.
+
+    Обновления разных пользователей обрабатываются параллельно, обновления одного
+    пользователя - последовательно, в порядке поступления.
+    Элементы очереди:
+      ("update", update_dict) - обновление Telegram
+      ("set_state", user_id, state) - установка FSM-состояния пользователя
+      None - завершение работы
+    """
+    loop = asyncio.get_running_loop()
+    user_tasks: Dict[int, asyncio.Task] = {}
+    bot_id = bot.id
+
+    async def run_in_order(user_id: int, previous: Optional[asyncio.Task], item: tuple) -> None:
+        if previous is not None:
+            try:
+                await previous
+            except Exception:
+                pass
+        try:
+            if item[0] == "update":
+                await dp.feed_raw_update(bot, item[1])
+            elif item[0] == "set_state":
+                storage_key = StorageKey(bot_id=bot_id, chat_id=user_id, user_id=user_id)
+                await dp.storage.set_state(storage_key, item[2])
+        except Exception as e:
+            logger.error(f"Ошибка обработки обновления пользователя {user_id}: {e}")
+
+    def forget(user_id: int, task: asyncio.Task) -> None:
+        if user_tasks.get(user_id) is task:
+            del user_tasks[user_id]
+
+    while True:
+        item = await loop.run_in_executor(None, queue.get)
+        if item is None:
+            break
+
+        if item[0] == "update":
+            user_id = extract_user_id(item[1])
+        else:
+            user_id = item[1]
+
+        task = asyncio.create_task(run_in_order(user_id, user_tasks.get(user_id), item))
+        user_tasks[user_id] = task
+        task.add_done_callback(lambda t, uid=user_id: forget(uid, t))
+
+    # Дожидаемся обработки уже принятых обновлений
+    if user_tasks:
+        await asyncio.gather(*user_tasks.values(), return_exceptions=True)